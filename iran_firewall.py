@@ -22,6 +22,9 @@ import urllib.request
 import json
 import time
 import webbrowser
+import base64
+import socket
+import tempfile
 
 RULE_PREFIX = "IranConduit"
 CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.json")
@@ -38,6 +41,13 @@ DNS_SERVERS = [
     "10.202.10.202", "10.202.10.102",    # 403.online DNS (Iran)
 ]
 
+# Windows Firewall rejects rules with more than 1000 -RemoteAddress entries
+MAX_REMOTE_ADDRESSES = 1000
+
+# Persistent PowerShell session (see ps_session_start)
+PS_SESSION = None
+PS_MARKER = "__IRANFW_DONE__"
+
 # Iran IP sources
 IP_SOURCES = [
     "https://www.ipdeny.com/ipblocks/data/countries/ir.zone",
@@ -88,7 +98,73 @@ def save_config(config):
         pass
 
 
+def ps_session_start():
+    """Start one long-lived PowerShell process that reads commands on stdin
+    
+    Every PowerShell spawn costs hundreds of milliseconds, so run_ps()
+    sends its commands here while the session is open.
+    """
+    global PS_SESSION
+    if PS_SESSION is None:
+        try:
+            PS_SESSION = subprocess.Popen(
+                ["powershell", "-NoProfile", "-NonInteractive", "-Command", "-"],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                text=True, encoding="utf-8", errors="replace", bufsize=1
+            )
+        except Exception:
+            PS_SESSION = None
+    return PS_SESSION is not None
+
+
+def ps_session_stop():
+    """Close the persistent PowerShell session"""
+    global PS_SESSION
+    if PS_SESSION is not None:
+        try:
+            PS_SESSION.stdin.close()
+            PS_SESSION.wait(timeout=5)
+        except Exception:
+            PS_SESSION.kill()
+        PS_SESSION = None
+
+
+def ps_session_run(cmd):
+    """Run one command in the persistent session
+    
+    The command is sent base64-encoded on a single line, so multi-line
+    scripts survive stdin framing, and is followed by a marker line that
+    carries the success flag.
+    """
+    encoded = base64.b64encode(cmd.encode("utf-8")).decode("ascii")
+    line = ("$iranfwOk = $true; try { Invoke-Expression ([Text.Encoding]::UTF8.GetString("
+            f"[Convert]::FromBase64String('{encoded}'))); if (-not $?) {{ $iranfwOk = $false }} }} "
+            "catch { $iranfwOk = $false; Write-Output $_ }; "
+            f"Write-Output \"{PS_MARKER}$iranfwOk\"\n")
+    PS_SESSION.stdin.write(line)
+    PS_SESSION.stdin.flush()
+    
+    output = []
+    while True:
+        out_line = PS_SESSION.stdout.readline()
+        if not out_line:
+            raise EOFError("PowerShell session ended")
+        if out_line.startswith(PS_MARKER):
+            return out_line.strip().endswith("True"), "".join(output)
+        output.append(out_line)
+
+
 def run_ps(cmd, check=False):
+    if PS_SESSION is not None:
+        try:
+            success, out = ps_session_run(cmd)
+            if check and not success:
+                print(f"   ⚠️  Command failed: {out[:100]}")
+            return success, out, "" if success else out
+        except Exception:
+            # Session died - fall back to one process per command
+            ps_session_stop()
+    
     result = subprocess.run(
         ["powershell", "-NoProfile", "-Command", cmd],
         capture_output=True, text=True
@@ -259,6 +335,201 @@ def download_iran_ips():
     return sorted(list(all_ips))
 
 
+def run_ps_script(script):
+    """Run a long generated script
+    
+    Scripts go through the session when it is open. Otherwise they are
+    written to a temporary .ps1 and run with -File, since a script passed
+    with -Command can exceed the 32767-character command line limit.
+    """
+    if PS_SESSION is not None:
+        return run_ps(script)
+    fd, path = tempfile.mkstemp(suffix=".ps1", prefix="iranfw_")
+    try:
+        # BOM so Windows PowerShell 5 reads the file as UTF-8
+        with os.fdopen(fd, 'w', encoding='utf-8-sig') as f:
+            f.write(script)
+        result = subprocess.run(
+            ["powershell", "-NoProfile", "-ExecutionPolicy", "Bypass", "-File", path],
+            capture_output=True, text=True
+        )
+        return result.returncode == 0, result.stdout, result.stderr
+    except Exception as e:
+        return False, "", str(e)
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def get_rule_batch_size():
+    """Ranges per rule, from config (capped at MAX_REMOTE_ADDRESSES)"""
+    try:
+        size = int(load_config().get('rule_batch_size', MAX_REMOTE_ADDRESSES))
+    except (TypeError, ValueError):
+        size = MAX_REMOTE_ADDRESSES
+    return max(1, min(size, MAX_REMOTE_ADDRESSES))
+
+
+def build_iran_rule(conduit_escaped, batch_num, ip_list):
+    """PowerShell command that creates one Iran allow rule"""
+    return (f'New-NetFirewallRule -DisplayName "{RULE_PREFIX}-Iran-{batch_num}" '
+            f'-Description "Allow Iran IPs - IranFirewall v{VERSION}" '
+            f'-Direction Inbound -Action Allow -Enabled True '
+            f"-Program '{conduit_escaped}' -RemoteAddress {ip_list}")
+
+
+def build_iran_rules_script(conduit_escaped, batches):
+    """Generate one script that creates every Iran rule in a single pass
+    
+    Each rule is wrapped in try/catch so one bad batch doesn't stop the
+    rest; the script prints how many failed.
+    """
+    lines = ["$failed = 0"]
+    for batch_num, batch in enumerate(batches):
+        rule = build_iran_rule(conduit_escaped, batch_num, ",".join(batch))
+        lines.append(f"try {{ {rule} -ErrorAction Stop | Out-Null }} catch {{ $failed++ }}")
+    lines.append('Write-Output "FAILED=$failed"')
+    return "\n".join(lines)
+
+
+def create_iran_rules(conduit_escaped, iran_ips, batch_size=None, one_pass=True, progress=True,
+                      runner=None):
+    """Create the Iran allow rules
+    
+    one_pass sends a single generated script (see run_ps_script());
+    otherwise (or if that script can't run at all) each batch is its own
+    run_ps_script() call. A one-pass script that died partway may have
+    created some rules, so they are removed before the per-batch pass.
+    runner replaces run_ps_script() for every PowerShell call.
+    
+    Returns:
+        (rule_count, failed_batches)
+    """
+    runner = runner or run_ps_script
+    batch_size = batch_size or get_rule_batch_size()
+    batches = [iran_ips[i:i+batch_size] for i in range(0, len(iran_ips), batch_size)]
+    
+    if one_pass:
+        success, out, _ = runner(build_iran_rules_script(conduit_escaped, batches))
+        for line in out.split('\n'):
+            if line.strip().startswith("FAILED="):
+                return len(batches), int(line.strip().split('=')[1])
+        print("   ⚠️  Bulk rule script failed, creating rules one by one...")
+        runner(f'Get-NetFirewallRule -DisplayName "{RULE_PREFIX}-Iran-*" -ErrorAction SilentlyContinue | Remove-NetFirewallRule')
+    
+    failed_batches = 0
+    for batch_num, batch in enumerate(batches):
+        done = min((batch_num + 1) * batch_size, len(iran_ips))
+        pct = int(done / len(iran_ips) * 100)
+        if progress:
+            print(f"\r   Progress: [{('█' * (pct//5)).ljust(20)}] {pct}% ({done}/{len(iran_ips)})", end="", flush=True)
+        
+        # A single batch can hold more addresses than fit on a command line
+        success, _, _ = runner(build_iran_rule(conduit_escaped, batch_num, ",".join(batch)))
+        if not success:
+            failed_batches += 1
+    if progress:
+        print()
+    return len(batches), failed_batches
+
+
+def benchmark_rule_creation(range_count=7000, spawn_cost=0.35, session_cost=0.02, rule_cost=0.05):
+    """Compare rule creation strategies with a recording runner
+    
+    Nothing is executed. create_iran_rules() runs for real against a
+    runner that records each PowerShell call, so the time spent building
+    batches and scripts is measured. The PowerShell side is modelled: a
+    cost per spawn (or per command when a session is open) plus per rule.
+    """
+    ips = [f"10.{i // 256 % 256}.{i % 256}.0/24" for i in range(range_count)]
+    scenarios = [
+        ("Per-batch spawn, 200/rule (old)", False, 200, False),
+        (f"Per-batch spawn, {MAX_REMOTE_ADDRESSES}/rule", False, MAX_REMOTE_ADDRESSES, False),
+        (f"Session + one script, {MAX_REMOTE_ADDRESSES}/rule", True, MAX_REMOTE_ADDRESSES, True),
+    ]
+    
+    print(f"\n⏱️  Rule creation for {range_count} ranges "
+          f"(modelled: spawn {spawn_cost}s, session call {session_cost}s, rule {rule_cost}s):")
+    results = []
+    for label, one_pass, batch_size, use_session in scenarios:
+        calls = []
+        
+        def runner(script):
+            calls.append(script)
+            return True, ("FAILED=0\n" if script.count("New-NetFirewallRule") > 1 else ""), ""
+        
+        start = time.perf_counter()
+        create_iran_rules("C:\\conduit.exe", ips, batch_size=batch_size,
+                          one_pass=one_pass, progress=False, runner=runner)
+        measured = time.perf_counter() - start
+        rules = sum(script.count("New-NetFirewallRule") for script in calls)
+        script_bytes = sum(len(script) for script in calls)
+        # Opening the session costs one spawn
+        modelled = (spawn_cost + len(calls) * session_cost if use_session
+                    else len(calls) * spawn_cost) + rules * rule_cost
+        results.append((label, measured, modelled, len(calls), rules, script_bytes))
+        print(f"   {label:<36} built in {measured * 1000:6.1f}ms, "
+              f"{script_bytes // 1024}KB in {len(calls)} PowerShell calls, {rules} rules "
+              f"-> {modelled:.2f}s modelled")
+    return results
+
+
+def cidr_to_interval(cidr):
+    """Parse an IPv4 CIDR (or single address) into an integer (start, end)
+    
+    Returns None for IPv6 or malformed entries.
+    """
+    addr, _, plen = cidr.strip().partition('/')
+    try:
+        value = int.from_bytes(socket.inet_aton(addr), 'big') if addr.count('.') == 3 else None
+        prefix = int(plen) if plen else 32
+    except (OSError, ValueError):
+        return None
+    if value is None or not 0 <= prefix <= 32:
+        return None
+    host = (1 << (32 - prefix)) - 1
+    start = value & ~host & 0xFFFFFFFF
+    return start, start | host
+
+
+def format_interval(start, end):
+    """Format an interval as the shortest RemoteAddress entry"""
+    first = socket.inet_ntoa(start.to_bytes(4, 'big'))
+    if start == end:
+        return first
+    size = end - start + 1
+    if size & (size - 1) == 0 and start % size == 0:
+        return f"{first}/{32 - size.bit_length() + 1}"
+    return f"{first}-{socket.inet_ntoa(end.to_bytes(4, 'big'))}"
+
+
+def merge_to_ranges(cidrs):
+    """Merge CIDRs into the fewest contiguous `start-end` IPv4 ranges
+    
+    Windows Firewall accepts ranges in -RemoteAddress, so overlapping and
+    adjacent prefixes from both feeds collapse into one entry each.
+    IPv6 entries are passed through unchanged; malformed ones are dropped.
+    """
+    intervals = []
+    passthrough = []
+    for cidr in cidrs:
+        parsed = cidr_to_interval(cidr)
+        if parsed:
+            intervals.append(parsed)
+        elif ':' in cidr:
+            passthrough.append(cidr.strip())
+    
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [format_interval(start, end) for start, end in merged] + passthrough
+
+
 def enable_iran_only():
     """Enable Iran-only mode"""
     print("\n" + "=" * 50)
@@ -290,6 +561,11 @@ def enable_iran_only():
         input("   Press Enter to go back...")
         return False
     
+    # Fewer entries means fewer rules for WFP to evaluate per packet
+    cidr_count = len(iran_ips)
+    iran_ips = merge_to_ranges(iran_ips)
+    print(f"   🗜️  Merged {cidr_count} CIDRs into {len(iran_ips)} contiguous ranges")
+    
     # Remove existing rules
     print("\n🧹 Cleaning up old rules...")
     disable_iran_only(quiet=True)
@@ -323,37 +599,14 @@ def enable_iran_only():
     
     # Allow Iran IPs
     print(f"🇮🇷 Adding {len(iran_ips)} Iran IP ranges...")
-    batch_size = 200
-    total_batches = (len(iran_ips) + batch_size - 1) // batch_size
-    failed_batches = 0
-    
-    for i in range(0, len(iran_ips), batch_size):
-        batch = iran_ips[i:i+batch_size]
-        ip_list = ",".join(batch)
-        batch_num = i // batch_size
-        
-        progress = min(i + batch_size, len(iran_ips))
-        pct = int(progress / len(iran_ips) * 100)
-        print(f"\r   Progress: [{('█' * (pct//5)).ljust(20)}] {pct}% ({progress}/{len(iran_ips)})", end="", flush=True)
-        
-        success, _, _ = run_ps(f"""
-            New-NetFirewallRule -DisplayName "{RULE_PREFIX}-Iran-{batch_num}" `
-                -Description "Allow Iran IPs - IranFirewall v{VERSION}" `
-                -Direction Inbound -Action Allow -Enabled True `
-                -Program '{conduit_escaped}' -RemoteAddress {ip_list}
-        """)
-        
-        if not success:
-            failed_batches += 1
-    
-    print()
+    total_batches, failed_batches = create_iran_rules(conduit_escaped, iran_ips)
     
     # Summary
     print("\n" + "=" * 50)
     print("✅ IRAN-ONLY MODE ENABLED!")
     print("=" * 50)
     print(f"\n   📁 Conduit: {conduit_path}")
-    print(f"   🇮🇷 Iran IPs: {len(iran_ips)} ranges allowed")
+    print(f"   🇮🇷 Iran IPs: {len(iran_ips)} ranges allowed (from {cidr_count} CIDRs)")
     print(f"   🌐 DNS servers: {len(DNS_SERVERS)} whitelisted")
     print(f"   📦 Firewall rules: {total_batches + 2} created")
     
@@ -497,6 +750,9 @@ def main():
         sys.exit(1)
     
     print("✅ Running as Administrator")
+    
+    # One PowerShell process for the whole run instead of one per command
+    ps_session_start()
     time.sleep(1)
     
     while True:
@@ -528,10 +784,14 @@ def main():
             clear_screen()
             print("\n👋 Thank you for helping Iran!")
             print("   Share this tool to help more people.\n")
+            ps_session_stop()
             break
         else:
             print("   Invalid choice. Enter 0-5.")
 
 
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) > 1 and sys.argv[1] == "benchmark":
+        benchmark_rule_creation(int(sys.argv[2]) if len(sys.argv) > 2 else 7000)
+    else:
+        main()
@@ -25,16 +25,41 @@
 VERSION = "1.1.1-linux"
 
 import subprocess
+import shlex
+import shutil
 import sys
 import os
 import urllib.request
+import urllib.error
 import json
 import time
 import logging
+import socket
+import errno
+import concurrent.futures
+import struct
+import threading
+import http.server
+import gzip
+import heapq
+import random
+import signal
+import hashlib
+import mmap
+import bisect
+import functools
+import itertools
+import collections
+import re
+import operator
 
 RULE_PREFIX = "IRAN_CONDUIT"
+NFT_TABLE = "iran_conduit"
 CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.json")
 LOG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "firewall.log")
+FEED_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "feed_cache")
+SNAPSHOT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "snapshot.json")
+COMPILED_FEED_FILE = os.path.join(FEED_CACHE_DIR, "iran_ranges.bin")
 CONDUIT_URL = "https://conduit.psiphon.ca/"
 
 # DNS servers to whitelist (IPv4)
@@ -67,6 +92,130 @@ IP_SOURCES_V6 = [
     "https://raw.githubusercontent.com/herrbischoff/country-ip-blocks/master/ipv6/ir.cidr",
 ]
 
+# Upper bounds (seconds) of the per-command latency histogram buckets
+CMD_LATENCY_BUCKETS = [0.005, 0.01, 0.05, 0.1, 0.5, 1, 5]
+
+# Per-command latency stats collected by run_cmd()
+CMD_STATS = {}
+
+SYS_CLASS_NET = "/sys/class/net"
+
+# ipset over netlink (NFNL_SUBSYS_IPSET), see linux/netfilter/ipset/ip_set.h
+NETLINK_NETFILTER = 12
+NFNL_SUBSYS_IPSET = 6
+IPSET_PROTOCOL = 6
+IPSET_CMD_LIST = 7
+IPSET_CMD_ADD = 9
+IPSET_CMD_DEL = 10
+IPSET_ATTR_PROTOCOL = 1
+IPSET_ATTR_SETNAME = 2
+IPSET_ATTR_TYPENAME = 3
+IPSET_ATTR_REVISION = 4
+IPSET_ATTR_FAMILY = 5
+IPSET_ATTR_FLAGS = 6
+IPSET_ATTR_DATA = 7
+IPSET_ATTR_ADT = 8
+IPSET_ATTR_LINENO = 9
+IPSET_ATTR_IP = 1
+IPSET_ATTR_CIDR = 3
+IPSET_ATTR_HASHSIZE = 18
+IPSET_ATTR_MAXELEM = 19
+IPSET_ATTR_ELEMENTS = 24
+IPSET_ATTR_REFERENCES = 25
+IPSET_ATTR_MEMSIZE = 26
+IPSET_ATTR_IPADDR_IPV4 = 1
+IPSET_ATTR_IPADDR_IPV6 = 2
+IPSET_FLAG_LIST_HEADER = 1 << 2
+NLA_F_NESTED = 1 << 15
+NLA_F_NET_BYTEORDER = 1 << 14
+NLA_TYPE_MASK = ~(NLA_F_NESTED | NLA_F_NET_BYTEORDER)
+NLM_F_REQUEST = 0x1
+NLM_F_ACK = 0x4
+NLM_F_DUMP = 0x300
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+
+# Elements per netlink message. The ADT attribute length is a u16, so one
+# message must stay below 64 KiB (IPv6 elements take 44 bytes each).
+NETLINK_BATCH_ELEMENTS = 1024
+
+# ipset sizing: room for growth between refreshes ("ipset_headroom" in
+# config) and the kernel defaults we never go below
+IPSET_HEADROOM = 0.5
+IPSET_MIN_HASHSIZE = 1024
+IPSET_MIN_MAXELEM = 65536
+
+# Pre-conntrack filtering ("raw_mode" in config): off, notrack or drop
+RAW_MODES = ('off', 'notrack', 'drop')
+
+# Where non-Iran packets to the VPN port are dropped ("drop_stage" in
+# config): filter INPUT (default), raw PREROUTING, nft netdev ingress on
+# the VPN interface, or a tc ingress filter
+DROP_STAGES = ('filter', 'raw', 'ingress', 'tc')
+NFT_INGRESS_TABLE = "iran_conduit_ingress"
+TC_PRIO_BASE = 4900
+
+# hash:net prefix layout ("ipset_prefix_layout" in config): "auto", "off"
+# or explicit prefix lengths per family ({"v4": [...], "v6": [...]}, a
+# plain list is IPv4 only); no layout may grow the element count by more
+# than "ipset_max_expansion" times
+PREFIX_LAYOUT_DEFAULT = 'auto'
+PREFIX_MAX_EXPANSION = 2.0
+
+# Block logging ("block_log" in config.json): off, limit, hashlimit or nflog
+BLOCK_LOG_MODES = ('off', 'limit', 'hashlimit', 'nflog')
+BLOCK_LOG_DEFAULT = 'limit'
+BLOCK_LOG_RATE = "10/minute"
+BLOCK_LOG_BURST = 20
+NFLOG_GROUP = 5
+
+# NFLOG over netlink (NFNL_SUBSYS_ULOG), see linux/netfilter/nfnetlink_log.h
+NFNL_SUBSYS_ULOG = 4
+NFULNL_MSG_PACKET = 0
+NFULNL_MSG_CONFIG = 1
+NFULNL_CFG_CMD_BIND = 1
+NFULNL_CFG_CMD_UNBIND = 2
+NFULNL_COPY_PACKET = 2
+NFULA_CFG_CMD = 1
+NFULA_CFG_MODE = 2
+NFULA_PAYLOAD = 9
+NFULA_PREFIX = 10
+
+# Compiled feed file: header, source hashes, then sorted big-endian
+# (start, end) pairs - 2x32 bit for IPv4, 2x128 bit for IPv6
+COMPILED_MAGIC = b"IRFB"
+COMPILED_VERSION = 1
+COMPILED_HEADER = struct.Struct("!4sHHQHII6x")   # magic, version, flags, created, sources, v4, v6
+COMPILED_V4 = struct.Struct("!II")
+
+# Daemon / CLI mode (no prompts, everything from config.json)
+HEADLESS = False
+REFRESH_INTERVAL = 6 * 3600
+REFRESH_JITTER = 0.1
+
+# Drop-log analytics
+KERN_LOG_FILES = ("/var/log/kern.log", "/var/log/messages")
+ANALYZE_CAPACITY = 5000
+ANALYZE_TOP = 20
+ANALYZE_CHUNK = 4 << 20
+# One kernel LOG line of ours: source (IPv4 as its first three octets),
+# protocol and destination port. The [^X\n]*(?:X(?!...)[^X\n]*)* runs skip
+# to the next field without backtracking and never cross a line end
+BLOCK_LINE = re.compile(rb"IRAN-BLOCK-[^S\n]*(?:S(?!RC=)[^S\n]*)*SRC=(\d+\.\d+\.\d+|[0-9a-fA-F:]+)\S* "
+                        rb"[^P\n]*(?:P(?!ROTO=)[^P\n]*)*PROTO=(\w+)(?: SPT=\d+ DPT=(\d+))?")
+
+# Prometheus exporter defaults (overridable in config.json)
+METRICS_ADDR = "127.0.0.1"
+METRICS_PORT = 9781
+METRICS_CACHE_SECONDS = 15
+
+# Per-source socket timeout and overall deadline for fetching all feeds (seconds)
+FETCH_TIMEOUT = 30
+FETCH_DEADLINE = 45
+
+# Cached feeds older than this are flagged as stale when used offline (seconds)
+FEED_STALE_AFTER = 7 * 24 * 3600
+
 
 def setup_logging():
     """Setup logging to file and console"""
@@ -112,6 +261,19 @@ def is_root():
     return os.geteuid() == 0
 
 
+def pause(message="\n   Press Enter to go back..."):
+    """Wait for Enter in the menu; no-op for CLI/daemon runs"""
+    if not HEADLESS:
+        input(message)
+
+
+def ask(prompt, default=""):
+    """Prompt for a value in the menu; CLI/daemon runs get the default"""
+    if HEADLESS:
+        return default
+    return input(prompt).strip()
+
+
 def load_config():
     """Load configuration from JSON file"""
     try:
@@ -132,11 +294,57 @@ def save_config(config):
         pass
 
 
-def run_cmd(cmd, check=False, shell=True):
-    """Run shell command"""
+def record_cmd_latency(name, elapsed):
+    """Add one command run to the latency histogram"""
+    stats = CMD_STATS.setdefault(name, {
+        'count': 0,
+        'total': 0.0,
+        'max': 0.0,
+        'buckets': [0] * (len(CMD_LATENCY_BUCKETS) + 1),
+    })
+    stats['count'] += 1
+    stats['total'] += elapsed
+    stats['max'] = max(stats['max'], elapsed)
+    for i, bound in enumerate(CMD_LATENCY_BUCKETS):
+        if elapsed <= bound:
+            stats['buckets'][i] += 1
+            break
+    else:
+        stats['buckets'][-1] += 1
+
+
+def format_cmd_stats():
+    """Format the latency histogram, slowest commands (by total time) first"""
+    if not CMD_STATS:
+        return "   (no commands run)"
+    labels = [f"≤{int(b * 1000)}ms" if b < 1 else f"≤{b}s" for b in CMD_LATENCY_BUCKETS] + ["more"]
+    lines = []
+    for name, stats in sorted(CMD_STATS.items(), key=lambda item: -item[1]['total']):
+        hist = " ".join(f"{label}:{n}" for label, n in zip(labels, stats['buckets']) if n)
+        lines.append(f"   {name:<28} n={stats['count']:<5} total={stats['total']:.3f}s "
+                     f"max={stats['max']:.3f}s  {hist}")
+    return "\n".join(lines)
+
+
+def run_cmd(cmd, check=False, shell=False, input=None):
+    """Run a command directly, without a shell
+
+    Args:
+        cmd: argv list, or a string that is split like a shell would
+        check: Print a warning if the command fails
+        shell: Run through /bin/sh (only for pipelines that need it)
+        input: Text to feed to the command on stdin
+    """
+    argv = cmd if shell or isinstance(cmd, list) else shlex.split(cmd)
+    if shell:
+        name = "sh -c"
+    else:
+        name = os.path.basename(argv[0]) + (f" {argv[1]}" if len(argv) > 1 else "")
+    start = time.time()
     try:
         result = subprocess.run(
-            cmd if shell else cmd.split(),
+            argv,
+            input=input,
             capture_output=True,
             text=True,
             shell=shell
@@ -149,6 +357,95 @@ def run_cmd(cmd, check=False, shell=True):
         if check:
             print(f"   ⚠️  Command error: {str(e)[:100]}")
         return False, "", str(e)
+    finally:
+        record_cmd_latency(name, time.time() - start)
+
+
+def list_interfaces():
+    """List network interface names from /sys/class/net"""
+    try:
+        return sorted(os.listdir(SYS_CLASS_NET))
+    except OSError:
+        return []
+
+
+def interface_state(iface):
+    """Return 'up', 'down' or None (missing) for an interface
+
+    Reads the IFF_UP flag rather than operstate, since tun devices
+    usually report operstate 'unknown' even when they are up.
+    """
+    try:
+        with open(os.path.join(SYS_CLASS_NET, iface, "flags")) as f:
+            flags = int(f.read().strip(), 16)
+    except (OSError, ValueError):
+        return None
+    return 'up' if flags & 0x1 else 'down'
+
+
+def parse_proc_addr(hex_addr):
+    """Decode an 'ADDR:PORT' field from /proc/net/{tcp,udp}[6]"""
+    addr, port = hex_addr.split(':')
+    raw = bytes.fromhex(addr)
+    # The kernel prints each 32-bit word in host (little-endian) order
+    raw = b"".join(raw[i:i + 4][::-1] for i in range(0, len(raw), 4))
+    family = socket.AF_INET if len(raw) == 4 else socket.AF_INET6
+    return socket.inet_ntop(family, raw), int(port, 16)
+
+
+def read_proc_sockets(proto):
+    """Yield (local_addr, local_port, state) for /proc/net/<proto> and <proto>6"""
+    for path in (f"/proc/net/{proto}", f"/proc/net/{proto}6"):
+        try:
+            with open(path) as f:
+                next(f, None)
+                for line in f:
+                    fields = line.split()
+                    if len(fields) < 4:
+                        continue
+                    addr, port = parse_proc_addr(fields[1])
+                    yield addr, port, fields[3]
+        except OSError:
+            continue
+
+
+def list_udp_listeners():
+    """Return sorted (addr, port) of unconnected UDP sockets, excluding loopback"""
+    listeners = set()
+    for addr, port, state in read_proc_sockets("udp"):
+        # TCP_CLOSE (07) is what unconnected UDP sockets report
+        if state == "07" and addr not in ("127.0.0.1", "::1"):
+            listeners.add((addr, port))
+    return sorted(listeners, key=lambda item: (item[1], item[0]))
+
+
+def count_established():
+    """Count established TCP and connected UDP sockets (like `ss -tun | grep ESTAB`)"""
+    return sum(1 for proto in ("tcp", "udp")
+               for _, _, state in read_proc_sockets(proto) if state == "01")
+
+
+def get_ipset_header(name):
+    """Read an ipset header with `ipset list -t` (no members listed)
+
+    Returns:
+        Dict of header fields (e.g. 'Number of entries', 'Size in memory'),
+        or None if the set does not exist
+    """
+    if get_ipset_backend() == 'netlink':
+        header = netlink_ipset_header(name)
+        if header is not None:
+            return header
+
+    success, out, _ = run_cmd(["ipset", "list", "-t", name])
+    if not success:
+        return None
+    header = {}
+    for line in out.split('\n'):
+        key, sep, value = line.partition(':')
+        if sep and key.strip() != 'Members':
+            header[key.strip()] = value.strip()
+    return header
 
 
 def detect_vpn_interface():
@@ -158,31 +455,28 @@ def detect_vpn_interface():
 
     if saved_iface:
         # Verify it still exists
-        success, out, _ = run_cmd(f"ip link show {saved_iface}")
-        if success:
+        if interface_state(saved_iface):
             return saved_iface
 
     # Auto-detect common VPN interfaces
     print("🔍 Detecting VPN interface...")
-    success, out, _ = run_cmd("ip link show")
+    interfaces = list_interfaces()
 
     # Look for common VPN interface patterns
     vpn_patterns = ['tun', 'tap', 'wg', 'ppp', 'ipsec']
-    for line in out.split('\n'):
-        for pattern in vpn_patterns:
-            if pattern in line and 'state' in line:
-                iface = line.split(':')[1].strip().split('@')[0]
-                print(f"   ✓ Found VPN interface: {iface}")
-                config['vpn_interface'] = iface
-                save_config(config)
-                return iface
+    for iface in interfaces:
+        if any(iface.startswith(pattern) for pattern in vpn_patterns):
+            print(f"   ✓ Found VPN interface: {iface}")
+            config['vpn_interface'] = iface
+            save_config(config)
+            return iface
 
     # Manual input
     print("   ✗ No VPN interface detected automatically")
     print("\n   Available interfaces:")
-    run_cmd("ip link show | grep -E '^[0-9]+:' | cut -d: -f2")
-    # iface = input("\n   Enter VPN interface name (e.g., tun0): ").strip()
-    iface = "enp0s6"
+    for iface in interfaces:
+        print(f"      • {iface}")
+    iface = ask("\n   Enter VPN interface name (e.g., tun0): ")
 
     if iface:
         config['vpn_interface'] = iface
@@ -208,12 +502,13 @@ def detect_vpn_port():
 
     # Try to detect listening ports
     print("\n   Checking listening UDP ports...")
-    success, out, _ = run_cmd("ss -lunp | grep -v '127.0.0.1'")
-    if success and out:
-        print(f"\n{out}")
+    listeners = list_udp_listeners()
+    for addr, port in listeners:
+        print(f"      • {addr}:{port}")
+    if not listeners:
+        print("      (none found)")
 
-    # port = input("\n   Enter VPN port (or press Enter to skip port-based filtering): ").strip()
-    port = ""
+    port = ask("\n   Enter VPN port (or press Enter to skip port-based filtering): ")
 
     if port and port.isdigit():
         config['vpn_port'] = port
@@ -223,85 +518,2159 @@ def detect_vpn_port():
     return None
 
 
-def download_iran_ips(include_ipv6=True):
-    """Download Iran IP ranges (IPv4 and optionally IPv6)"""
-    print("📥 Downloading Iran IP ranges...")
+def cidr_to_range(cidr):
+    """Parse a CIDR string into an integer interval
 
-    ipv4_ips = set()
-    ipv6_ips = set()
+    Host bits are masked off, like ipaddress.ip_network(strict=False).
+
+    Returns:
+        (start, end, bits) where bits is 32 or 128, or None if invalid
+    """
+    addr, _, plen = cidr.strip().partition('/')
+    family, bits = (socket.AF_INET6, 128) if ':' in addr else (socket.AF_INET, 32)
+    try:
+        value = int.from_bytes(socket.inet_pton(family, addr), 'big')
+        prefix = int(plen) if plen else bits
+    except (OSError, ValueError):
+        return None
+    if not 0 <= prefix <= bits:
+        return None
+    host = (1 << (bits - prefix)) - 1
+    start = value & ~host
+    return start, start | host, bits
+
+
+def merge_intervals(intervals):
+    """Merge overlapping and adjacent (start, end) intervals
+
+    Returns:
+        Sorted list of disjoint (start, end) intervals
+    """
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1] + 1:
+            if end > merged[-1][1]:
+                merged[-1][1] = end
+        else:
+            merged.append([start, end])
+    return [(start, end) for start, end in merged]
+
+
+def range_to_prefixes(start, end, bits):
+    """Split an integer interval into the minimal list of (network, prefixlen)"""
+    prefixes = []
+    while start <= end:
+        # Largest block aligned at start that still fits before end
+        size = (start & -start).bit_length() - 1 if start else bits
+        size = min(size, (end - start + 1).bit_length() - 1)
+        prefixes.append((start, bits - size))
+        start += 1 << size
+    return prefixes
+
+
+def format_prefix(network, prefixlen, bits):
+    """Format an integer network address as a CIDR string"""
+    if bits == 32:
+        addr = socket.inet_ntop(socket.AF_INET, network.to_bytes(4, 'big'))
+    else:
+        addr = socket.inet_ntop(socket.AF_INET6, network.to_bytes(16, 'big'))
+    return f"{addr}/{prefixlen}"
+
+
+def cidrs_to_intervals(cidrs, bits=32):
+    """Parse CIDR strings of one family into merged (start, end) intervals"""
+    intervals = []
+    for cidr in cidrs:
+        parsed = cidr_to_range(cidr)
+        if parsed and parsed[2] == bits:
+            intervals.append((parsed[0], parsed[1]))
+    return merge_intervals(intervals)
+
+
+def intervals_to_cidrs(intervals, bits=32):
+    """Format sorted disjoint intervals as the minimal CIDR list"""
+    result = []
+    for start, end in intervals:
+        for network, prefixlen in range_to_prefixes(start, end, bits):
+            result.append(format_prefix(network, prefixlen, bits))
+    return result
+
+
+def feed_cache_path(url):
+    """Return the cache file path for a feed url"""
+    name = url.split('://', 1)[-1].replace('/', '_').replace(':', '_')
+    return os.path.join(FEED_CACHE_DIR, name + ".json")
+
+
+def load_feed_cache(url):
+    """Load a cached feed entry (body, etag, last_modified, fetched_at)"""
+    try:
+        with open(feed_cache_path(url), 'r') as f:
+            return json.load(f)
+    except:
+        return None
+
+
+def save_feed_cache(url, body, etag=None, last_modified=None):
+    """Store a feed body with its validators next to config.json"""
+    try:
+        os.makedirs(FEED_CACHE_DIR, exist_ok=True)
+        path = feed_cache_path(url)
+        tmp = path + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump({
+                'url': url,
+                'body': body,
+                'etag': etag,
+                'last_modified': last_modified,
+                'fetched_at': time.time(),
+            }, f)
+        os.replace(tmp, path)
+    except:
+        pass
+
+
+def fetch_source(url, timeout=FETCH_TIMEOUT):
+    """Fetch one feed and return its body as text
+
+    Sends If-None-Match / If-Modified-Since from the feed cache and reuses
+    the cached body on 304. If the network fails, falls back to the cached
+    copy and warns when it is older than FEED_STALE_AFTER.
+    """
+    cached = load_feed_cache(url)
+    headers = {'User-Agent': 'IranFirewall/1.1'}
+    if cached:
+        if cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+
+    req = urllib.request.Request(url, headers=headers)
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            body = resp.read().decode('utf-8')
+            save_feed_cache(url, body, resp.headers.get('ETag'), resp.headers.get('Last-Modified'))
+            return body
+    except urllib.error.HTTPError as e:
+        if e.code == 304 and cached:
+            # Unchanged upstream - refresh the timestamp and reuse our copy
+            save_feed_cache(url, cached['body'], cached.get('etag'), cached.get('last_modified'))
+            logging.info(f"Feed {url} not modified, using cache")
+            return cached['body']
+        if not cached:
+            raise
+        error = e
+    except Exception as e:
+        if not cached:
+            raise
+        error = e
+    return use_cached_feed(url, cached, error)
 
-    # Download IPv4
-    print("\n   IPv4 ranges:")
-    for url in IP_SOURCES_V4:
-        source_name = url.split('/')[-1]
+
+def use_cached_feed(url, cached, error):
+    """Return the cached body of an unreachable feed, warning when it is stale"""
+    age = time.time() - cached.get('fetched_at', 0)
+    logging.warning(f"Feed {url} unreachable ({str(error)[:50]}), using cached copy from {age / 3600:.1f}h ago")
+    if age > FEED_STALE_AFTER:
+        print(f"\n   ⚠️  Using stale cached copy of {url.split('/')[-1]} ({age / 86400:.0f} days old)")
+    return cached['body']
+
+
+def parse_feed(data, ipv6=False):
+    """Extract CIDR lines of one address family from a zone file"""
+    return [line.strip() for line in data.split('\n')
+            if line.strip() and '/' in line and not line.startswith('#')
+            and (':' in line) == ipv6]
+
+
+def fetch_sources(urls, deadline=FETCH_DEADLINE):
+    """Fetch all urls concurrently under one overall deadline
+
+    Returns:
+        Dict of url -> (body or None, elapsed seconds, error or None).
+        Sources still running when the deadline passes fall back to their
+        cached copy, or are reported as timed out without one.
+    """
+    results = {}
+    if not urls:
+        return results
+
+    def timed_fetch(url):
+        start = time.time()
         try:
-            print(f"   Fetching {source_name}...", end=" ", flush=True)
-            req = urllib.request.Request(url, headers={'User-Agent': 'IranFirewall/1.1'})
-            with urllib.request.urlopen(req, timeout=30) as resp:
-                data = resp.read().decode('utf-8')
-                ips = [line.strip() for line in data.split('\n')
-                       if line.strip() and '/' in line and not line.startswith('#') and ':' not in line]
-                ipv4_ips.update(ips)
-                print(f"✓ {len(ips)} ranges")
+            return fetch_source(url, timeout=min(FETCH_TIMEOUT, deadline)), time.time() - start, None
         except Exception as e:
-            print(f"✗ {str(e)[:50]}")
+            return None, time.time() - start, str(e)[:50]
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(urls))
+    futures = {executor.submit(timed_fetch, url): url for url in urls}
+    done, _ = concurrent.futures.wait(futures, timeout=deadline)
+    for future, url in futures.items():
+        if future in done:
+            results[url] = future.result()
+        else:
+            error = f"deadline of {deadline}s exceeded"
+            cached = load_feed_cache(url)
+            body = use_cached_feed(url, cached, error) if cached else None
+            results[url] = (body, deadline, None if cached else error)
+    # Don't block on stalled mirrors; their sockets time out on their own
+    executor.shutdown(wait=False)
+    return results
+
+
+# ═══════════════════════════════════════════════════════════════
+# COMPILED FEED (binary ranges, loaded with mmap)
+# ═══════════════════════════════════════════════════════════════
+
+def feed_source_hashes(urls, results):
+    """SHA-256 of each source (url + body) in source order; failed ones hash the url only"""
+    hashes = []
+    for url in urls:
+        body = results.get(url, (None,))[0] or ""
+        hashes.append(hashlib.sha256((url + "\n" + body).encode()).digest())
+    return hashes
+
+
+def write_compiled_feed(source_hashes, v4_intervals, v6_intervals, path=None):
+    """Write merged intervals to the binary feed file (atomic replace)"""
+    path = path or COMPILED_FEED_FILE
+    parts = [COMPILED_HEADER.pack(COMPILED_MAGIC, COMPILED_VERSION, 0, int(time.time()),
+                                  len(source_hashes), len(v4_intervals), len(v6_intervals))]
+    parts += source_hashes
+    parts += [COMPILED_V4.pack(start, end) for start, end in v4_intervals]
+    parts += [start.to_bytes(16, 'big') + end.to_bytes(16, 'big') for start, end in v6_intervals]
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + ".tmp"
+        with open(tmp, 'wb') as f:
+            f.write(b"".join(parts))
+        os.replace(tmp, path)
+        return True
+    except OSError as e:
+        logging.warning(f"Could not write compiled feed: {e}")
+        return False
 
-    # Download IPv6
-    if include_ipv6:
-        print("\n   IPv6 ranges:")
-        for url in IP_SOURCES_V6:
-            source_name = url.split('/')[-1]
+
+def load_compiled_feed(path=None):
+    """Map the binary feed file read-only
+
+    Returns:
+        Dict with 'created', 'sources' (list of hashes), 'digest', and
+        'v4'/'v6' memoryviews over the raw interval arrays (no copy), or
+        None if the file is missing or malformed
+    """
+    path = path or COMPILED_FEED_FILE
+    try:
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    if len(mm) < COMPILED_HEADER.size:
+        return None
+    magic, version, _, created, n_sources, n_v4, n_v6 = COMPILED_HEADER.unpack_from(mm)
+    v4_offset = COMPILED_HEADER.size + 32 * n_sources
+    v6_offset = v4_offset + 8 * n_v4
+    if magic != COMPILED_MAGIC or version != COMPILED_VERSION or len(mm) != v6_offset + 32 * n_v6:
+        return None
+
+    view = memoryview(mm)
+    sources = [bytes(view[offset:offset + 32]) for offset in range(COMPILED_HEADER.size, v4_offset, 32)]
+    return {
+        'created': created,
+        'sources': sources,
+        'digest': hashlib.sha256(b"".join(sources)).hexdigest(),
+        'v4': view[v4_offset:v6_offset],
+        'v6': view[v6_offset:],
+    }
+
+
+def compiled_intervals(feed, bits=32):
+    """Iterate (start, end) integer intervals of one family from a loaded feed"""
+    if bits == 32:
+        return COMPILED_V4.iter_unpack(feed['v4'])
+    data = feed['v6']
+    return ((int.from_bytes(data[i:i + 16], 'big'), int.from_bytes(data[i + 16:i + 32], 'big'))
+            for i in range(0, len(data), 32))
+
+
+def compiled_find(feed, value, bits=32):
+    """Binary search the mapped intervals for an address
+
+    Reads only the O(log n) entries it touches straight from the mapping.
+
+    Returns:
+        (start, end) of the covering interval, or None
+    """
+    data, width = (feed['v4'], 8) if bits == 32 else (feed['v6'], 32)
+    lo, hi = 0, len(data) // width
+    while lo < hi:
+        mid = (lo + hi) // 2
+        offset = mid * width
+        if bits == 32:
+            start, end = COMPILED_V4.unpack_from(data, offset)
+        else:
+            start = int.from_bytes(data[offset:offset + 16], 'big')
+            end = int.from_bytes(data[offset + 16:offset + 32], 'big')
+        if value < start:
+            hi = mid
+        elif value > end:
+            lo = mid + 1
+        else:
+            return start, end
+    return None
+
+
+def source_segments(per_source):
+    """Split per-source interval lists into disjoint segments with a source mask
+
+    Args:
+        per_source: list of interval lists, one per source
+
+    Returns:
+        Sorted list of (start, end, mask) where bit i of mask is set when
+        source i covers the whole segment
+    """
+    events = []
+    for i, intervals in enumerate(per_source):
+        for start, end in intervals:
+            events.append((start, 1 << i))
+            events.append((end + 1, -(1 << i)))
+    events.sort()
+
+    segments = []
+    mask = 0
+    prev = None
+    for pos, change in events:
+        if mask and prev is not None and pos > prev:
+            if segments and segments[-1][2] == mask and segments[-1][1] == prev - 1:
+                segments[-1] = (segments[-1][0], pos - 1, mask)
+            else:
+                segments.append((prev, pos - 1, mask))
+        mask += change
+        prev = pos
+    return segments
+
+
+def build_lookup_index(sources_v4=None, sources_v6=None):
+    """Build an offline lookup index from the compiled feed and the feed cache
+
+    Nothing is downloaded and no root is needed. The merged ranges are
+    searched in place in the mapped compiled feed file (or merged from the
+    cached feeds if it is missing);
+    per-source segments from the cached feed bodies let lookups name the
+    feeds that list an address.
+
+    Returns:
+        {32: family index, 128: family index}, or None without any cached data
+    """
+    index = {}
+    compiled = load_compiled_feed()
+    for bits, urls in ((32, IP_SOURCES_V4 if sources_v4 is None else sources_v4),
+                       (128, IP_SOURCES_V6 if sources_v6 is None else sources_v6)):
+        per_source, names = [], []
+        for url in urls:
+            cached = load_feed_cache(url)
+            if cached:
+                per_source.append(cidrs_to_intervals(parse_feed(cached['body'], ipv6=bits == 128), bits))
+                names.append(url)
+        if compiled:
+            merged = []
+            count = len(compiled['v4']) // 8 if bits == 32 else len(compiled['v6']) // 32
+        else:
+            merged = merge_intervals(interval for intervals in per_source for interval in intervals)
+            count = len(merged)
+        segments = source_segments(per_source)
+        index[bits] = {
+            'feed': compiled,
+            'count': count,
+            'starts': [start for start, _ in merged],
+            'ends': [end for _, end in merged],
+            'seg_starts': [start for start, _, _ in segments],
+            'seg_ends': [end for _, end, _ in segments],
+            'seg_masks': [mask for _, _, mask in segments],
+            'sources': names,
+        }
+    if not index[32]['count'] and not index[128]['count']:
+        return None
+    return index
+
+
+def index_intervals(index, bits):
+    """Iterate the (start, end) ranges of one family of a lookup index"""
+    family = index[bits]
+    if family['feed']:
+        return compiled_intervals(family['feed'], bits)
+    return zip(family['starts'], family['ends'])
+
+
+def index_find(index, value, bits):
+    """(start, end) of the range covering an address, or None
+
+    With a compiled feed the search runs on the mapped file through
+    compiled_find(); otherwise on the merged lists.
+    """
+    family = index[bits]
+    if family['feed']:
+        return compiled_find(family['feed'], value, bits)
+    i = bisect.bisect_right(family['starts'], value) - 1
+    if i < 0 or family['ends'][i] < value:
+        return None
+    return family['starts'][i], family['ends'][i]
+
+
+def parse_ip(text):
+    """Parse an address into (integer, bits), or None if invalid"""
+    family, bits = (socket.AF_INET6, 128) if ':' in text else (socket.AF_INET, 32)
+    try:
+        return int.from_bytes(socket.inet_pton(family, text), 'big'), bits
+    except (OSError, ValueError):
+        return None
+
+
+def lookup_ip(index, ip):
+    """Check whether an address is covered by the Iran ranges
+
+    Returns:
+        Dict with 'ip', 'covered', 'prefix' (the CIDR of the collapsed
+        ranges that covers ip; with the prefix layout on, the live hash:net
+        set may hold it split into longer prefixes), 'range' and 'sources'
+        (feed urls listing it), or None if ip is not a valid address
+    """
+    parsed = parse_ip(ip.strip())
+    if parsed is None:
+        return None
+    value, bits = parsed
+    family = index[bits]
+    result = {'ip': ip.strip(), 'covered': False, 'prefix': None, 'range': None, 'sources': []}
+
+    found = index_find(index, value, bits)
+    if found is None:
+        return result
+    start, end = found
+    for network, prefixlen in range_to_prefixes(start, end, bits):
+        if network <= value < network + (1 << (bits - prefixlen)):
+            result['prefix'] = format_prefix(network, prefixlen, bits)
+            break
+    result['covered'] = True
+    result['range'] = (f"{format_prefix(start, bits, bits).split('/')[0]}-"
+                       f"{format_prefix(end, bits, bits).split('/')[0]}")
+
+    j = bisect.bisect_right(family['seg_starts'], value) - 1
+    if j >= 0 and family['seg_ends'][j] >= value:
+        mask = family['seg_masks'][j]
+        result['sources'] = [url for k, url in enumerate(family['sources']) if mask >> k & 1]
+    return result
+
+
+def lookup_regions(index, bits):
+    """Flatten the ranges into boundary points with one answer per gap
+
+    bisect_right(points, value) is the gap an address falls in and
+    labels[gap] is its covering prefix, or '-' outside the ranges.
+    """
+    points, labels = [], ["-"]
+    for start, end in index_intervals(index, bits):
+        for network, prefixlen in range_to_prefixes(start, end, bits):
+            if points and points[-1] == network:
+                labels[-1] = format_prefix(network, prefixlen, bits)
+            else:
+                points.append(network)
+                labels.append(format_prefix(network, prefixlen, bits))
+            points.append(network + (1 << (bits - prefixlen)))
+            labels.append("-")
+    return points, labels
+
+
+def lookup_stream(index, lines, out, chunk_size=65536):
+    """Batch lookup: write 'ip<TAB>prefix' per input line ('-' = not covered)
+
+    Pure-IPv4 chunks are parsed, searched and formatted with map() over C
+    functions only, with no Python code per address. Chunks containing IPv6
+    or invalid lines ('?') take the per-line path.
+    """
+    regions = {bits: lookup_regions(index, bits) for bits in (32, 128)}
+    v4_points, v4_labels = regions[32]
+    find_v4 = functools.partial(bisect.bisect_right, v4_points)
+    pton_v4 = functools.partial(socket.inet_pton, socket.AF_INET)
+
+    def answer(ip):
+        parsed = parse_ip(ip)
+        if parsed is None:
+            return "?"
+        points, labels = regions[parsed[1]]
+        return labels[bisect.bisect_right(points, parsed[0])]
+
+    lines = iter(lines)
+    while True:
+        raw = list(itertools.islice(lines, chunk_size))
+        if not raw:
+            break
+        chunk = list(filter(None, map(str.strip, raw)))
+        if not chunk:
+            continue
+        answers = None
+        if ":" not in "".join(chunk):
             try:
-                print(f"   Fetching {source_name}...", end=" ", flush=True)
-                req = urllib.request.Request(url, headers={'User-Agent': 'IranFirewall/1.1'})
-                with urllib.request.urlopen(req, timeout=30) as resp:
-                    data = resp.read().decode('utf-8')
-                    ips = [line.strip() for line in data.split('\n')
-                           if line.strip() and '/' in line and not line.startswith('#') and ':' in line]
-                    ipv6_ips.update(ips)
-                    print(f"✓ {len(ips)} ranges")
-            except Exception as e:
-                print(f"✗ {str(e)[:50]}")
+                packed = b"".join(map(pton_v4, chunk))
+                values = struct.unpack(f"!{len(chunk)}I", packed)
+                answers = map(v4_labels.__getitem__, map(find_v4, values))
+            except OSError:
+                answers = None
+        if answers is None:
+            answers = map(answer, chunk)
+        out.write("\n".join(map("\t".join, zip(chunk, answers))) + "\n")
+
+
+def show_lookup(args):
+    """`lookup <ip>...` report, or batch mode with `lookup -` reading stdin"""
+    start = time.time()
+    index = build_lookup_index()
+    if index is None:
+        print("❌ No cached feeds - run enable or refresh once (with network) first")
+        return 1
+    logging.debug(f"Lookup index built in {time.time() - start:.2f}s")
+
+    if args == ["-"]:
+        lookup_stream(index, sys.stdin, sys.stdout)
+        return 0
+
+    status = 0
+    for ip in args:
+        result = lookup_ip(index, ip)
+        if result is None:
+            print(f"❓ {ip}: not a valid IP address")
+            status = 2
+        elif result['covered']:
+            print(f"🇮🇷 {ip}: in collapsed prefix {result['prefix']} (merged range {result['range']})")
+            for url in result['sources']:
+                print(f"      listed in {url}")
+        else:
+            print(f"🚫 {ip}: NOT in the Iran ranges - it would be blocked on UDP")
+            status = 1
+    return status
+
+
+def download_iran_ips(include_ipv6=True, sources_v4=None, sources_v6=None, deadline=None):
+    """Download Iran IP ranges (IPv4 and optionally IPv6)
+
+    All sources are fetched in parallel. Results are merged in source
+    order, so the output does not depend on which mirror answered first.
+    """
+    print("📥 Downloading Iran IP ranges...")
+
+    sources_v4 = IP_SOURCES_V4 if sources_v4 is None else sources_v4
+    sources_v6 = (IP_SOURCES_V6 if sources_v6 is None else sources_v6) if include_ipv6 else []
+    if deadline is None:
+        deadline = load_config().get('fetch_deadline', FETCH_DEADLINE)
+
+    start = time.time()
+    results = fetch_sources(list(sources_v4) + list(sources_v6), deadline=deadline)
+    logging.info(f"Fetched {len(results)} IP sources in {time.time() - start:.2f}s")
+
+    # Unchanged sources: reuse the compiled ranges instead of re-parsing
+    hashes = feed_source_hashes(list(sources_v4) + list(sources_v6), results)
+    compiled = load_compiled_feed()
+    if compiled and compiled['sources'] == hashes and len(compiled['v4']):
+        iran_v4 = intervals_to_cidrs(compiled_intervals(compiled, 32), 32)
+        iran_v6 = intervals_to_cidrs(compiled_intervals(compiled, 128), 128)
+        print(f"   ✓ Sources unchanged since {time.strftime('%Y-%m-%d %H:%M', time.localtime(compiled['created']))}"
+              f" - using compiled ranges")
+        print(f"\n   📊 Total: {len(iran_v4)} IPv4 + {len(iran_v6)} IPv6 ranges")
+        return iran_v4, iran_v6
+
+    ipv4_ips = set()
+    ipv6_ips = set()
+
+    for label, urls, target, ipv6 in (("IPv4", sources_v4, ipv4_ips, False),
+                                      ("IPv6", sources_v6, ipv6_ips, True)):
+        if not urls:
+            continue
+        print(f"\n   {label} ranges:")
+        for url in urls:
+            source_name = url.split('/')[-1]
+            data, elapsed, error = results[url]
+            if data is None:
+                print(f"   Fetching {source_name}... ✗ {error}")
+                logging.warning(f"Fetch {url} failed after {elapsed:.2f}s: {error}")
+                continue
+            ips = parse_feed(data, ipv6=ipv6)
+            target.update(ips)
+            print(f"   Fetching {source_name}... ✓ {len(ips)} ranges ({elapsed:.2f}s)")
+            logging.info(f"Fetch {url}: {len(ips)} ranges in {elapsed:.2f}s")
 
     if len(ipv4_ips) == 0:
         print("   ❌ All IPv4 downloads failed!")
         return None, None
 
-    print(f"\n   📊 Total: {len(ipv4_ips)} IPv4 + {len(ipv6_ips)} IPv6 ranges")
-    return sorted(list(ipv4_ips)), sorted(list(ipv6_ips))
+    # Collapse overlapping and adjacent prefixes across both feeds
+    v4_intervals = cidrs_to_intervals(ipv4_ips, bits=32)
+    v6_intervals = cidrs_to_intervals(ipv6_ips, bits=128)
+    write_compiled_feed(hashes, v4_intervals, v6_intervals)
+    iran_v4 = intervals_to_cidrs(v4_intervals, bits=32)
+    iran_v6 = intervals_to_cidrs(v6_intervals, bits=128)
+    removed = len(ipv4_ips) - len(iran_v4) + len(ipv6_ips) - len(iran_v6)
+    print(f"\n   🗜️  Collapsed {len(ipv4_ips)} → {len(iran_v4)} IPv4, "
+          f"{len(ipv6_ips)} → {len(iran_v6)} IPv6 ({removed} entries removed)")
+
+    print(f"\n   📊 Total: {len(iran_v4)} IPv4 + {len(iran_v6)} IPv6 ranges")
+    return iran_v4, iran_v6
+
+
+# ═══════════════════════════════════════════════════════════════
+# NETLINK IPSET BACKEND (optional, "ipset_backend": "netlink")
+# ═══════════════════════════════════════════════════════════════
+
+def nla(attr_type, payload):
+    """Encode one netlink attribute (padded to 4 bytes)"""
+    length = 4 + len(payload)
+    return struct.pack("=HH", length, attr_type) + payload + b"\0" * (-length % 4)
+
+
+def nla_u8(attr_type, value):
+    return nla(attr_type, struct.pack("B", value))
+
+
+def nla_u32be(attr_type, value):
+    return nla(attr_type | NLA_F_NET_BYTEORDER, struct.pack(">I", value))
+
+
+def nla_str(attr_type, value):
+    return nla(attr_type, value.encode() + b"\0")
+
+
+def nla_nested(attr_type, *attrs):
+    return nla(attr_type | NLA_F_NESTED, b"".join(attrs))
+
+
+def nlmsg(msg_type, flags, seq, payload):
+    """Encode a netlink message header plus payload"""
+    return struct.pack("=IHHII", 16 + len(payload), msg_type, flags, seq, 0) + payload
+
+
+def ipset_msg(cmd, flags, seq, *attrs):
+    """Encode an nfnetlink ipset message (nfgenmsg + protocol + attrs)"""
+    payload = struct.pack("=BBH", socket.AF_INET, 0, 0) + nla_u8(IPSET_ATTR_PROTOCOL, IPSET_PROTOCOL)
+    return nlmsg((NFNL_SUBSYS_IPSET << 8) | cmd, flags, seq, payload + b"".join(attrs))
+
+
+def encode_ipset_element(cidr, lineno):
+    """Encode one hash:net element as an IPSET_ATTR_DATA attribute"""
+    addr, _, plen = cidr.partition('/')
+    if ':' in addr:
+        ip = nla(IPSET_ATTR_IPADDR_IPV6 | NLA_F_NET_BYTEORDER, socket.inet_pton(socket.AF_INET6, addr))
+        bits = 128
+    else:
+        ip = nla(IPSET_ATTR_IPADDR_IPV4 | NLA_F_NET_BYTEORDER, socket.inet_pton(socket.AF_INET, addr))
+        bits = 32
+    return nla_nested(
+        IPSET_ATTR_DATA,
+        nla_nested(IPSET_ATTR_IP, ip),
+        nla_u8(IPSET_ATTR_CIDR, int(plen) if plen else bits),
+        nla_u32be(IPSET_ATTR_LINENO, lineno),
+    )
+
+
+def encode_ipset_adt(cmd, setname, cidrs, seq):
+    """Encode an ADD/DEL message carrying many elements
+
+    Each element carries its 1-based position as LINENO. If one is
+    rejected, the kernel copies that number into the top-level LINENO of
+    the request echoed back in the error, so we know which one failed.
+    """
+    elements = b"".join(encode_ipset_element(cidr, i) for i, cidr in enumerate(cidrs, 1))
+    return ipset_msg(cmd, NLM_F_REQUEST | NLM_F_ACK, seq,
+                     nla_str(IPSET_ATTR_SETNAME, setname),
+                     nla_u32be(IPSET_ATTR_LINENO, 0),
+                     nla(IPSET_ATTR_ADT | NLA_F_NESTED, elements))
+
+
+def encode_ipset_list_header(setname, seq):
+    """Encode a terse LIST request (header only, no members)"""
+    return ipset_msg(IPSET_CMD_LIST, NLM_F_REQUEST | NLM_F_DUMP, seq,
+                     nla_str(IPSET_ATTR_SETNAME, setname),
+                     nla_u32be(IPSET_ATTR_FLAGS, IPSET_FLAG_LIST_HEADER))
+
+
+def parse_nlattrs(data):
+    """Decode netlink attributes into a dict of type -> raw payload"""
+    attrs = {}
+    offset = 0
+    while offset + 4 <= len(data):
+        length, attr_type = struct.unpack_from("=HH", data, offset)
+        if length < 4:
+            break
+        attrs[attr_type & NLA_TYPE_MASK] = data[offset + 4:offset + length]
+        offset += (length + 3) & ~3
+    return attrs
+
+
+def parse_nlmsgs(data):
+    """Split a netlink datagram into (type, flags, seq, payload) tuples"""
+    msgs = []
+    offset = 0
+    while offset + 16 <= len(data):
+        length, msg_type, flags, seq, _ = struct.unpack_from("=IHHII", data, offset)
+        if length < 16:
+            break
+        msgs.append((msg_type, flags, seq, data[offset + 16:offset + length]))
+        offset += (length + 3) & ~3
+    return msgs
+
+
+def parse_nlmsg_error(payload):
+    """Decode an NLMSG_ERROR payload into (errno, failed LINENO or None)"""
+    error = -struct.unpack_from("=i", payload)[0]
+    lineno = None
+    # The original request follows: nlmsghdr (16) + nfgenmsg (4) + attrs
+    echo = payload[4 + 16 + 4:]
+    attr = parse_nlattrs(echo).get(IPSET_ATTR_LINENO)
+    if attr and len(attr) == 4:
+        lineno = struct.unpack(">I", attr)[0] or None
+    return error, lineno
+
+
+def netlink_open():
+    """Open an nfnetlink socket, or return None if unavailable"""
+    try:
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_NETFILTER)
+        sock.bind((0, 0))
+        sock.settimeout(5)
+        return sock
+    except (OSError, AttributeError):
+        return None
+
+
+def get_ipset_backend():
+    """Return the configured ipset backend ('cli' or 'netlink')"""
+    return 'netlink' if load_config().get('ipset_backend') == 'netlink' else 'cli'
+
+
+def netlink_ipset_adt(cmd, setname, cidrs):
+    """Add or delete many elements over netlink in batched messages
+
+    Like ipset restore, a batch stops at the first rejected element; it is
+    recorded and the batch resumes after it.
+
+    Returns:
+        List of (index, cidr, error) failures, or None if netlink is unavailable
+    """
+    sock = netlink_open()
+    if sock is None:
+        return None
+
+    failures = []
+    offset = 0
+    seq = int(time.time())
+    start = time.time()
+    try:
+        while offset < len(cidrs):
+            chunk = cidrs[offset:offset + NETLINK_BATCH_ELEMENTS]
+            seq += 1
+            sock.send(encode_ipset_adt(cmd, setname, chunk, seq))
+            error, lineno = 0, None
+            for msg_type, _, msg_seq, payload in parse_nlmsgs(sock.recv(1 << 20)):
+                if msg_type == NLMSG_ERROR and msg_seq == seq:
+                    error, lineno = parse_nlmsg_error(payload)
+            if not error:
+                offset += len(chunk)
+            elif lineno and lineno <= len(chunk):
+                failures.append((offset + lineno - 1, chunk[lineno - 1], os.strerror(error)))
+                offset += lineno
+            else:
+                failures.extend((offset + i, cidr, os.strerror(error)) for i, cidr in enumerate(chunk))
+                offset += len(chunk)
+    except OSError as e:
+        failures.append((offset, cidrs[offset], str(e)[:100]))
+    finally:
+        sock.close()
+        name = "netlink add" if cmd == IPSET_CMD_ADD else "netlink del"
+        record_cmd_latency(name, time.time() - start)
+    return failures
+
+
+def netlink_ipset_header(setname):
+    """Read set size, memory and references over netlink
+
+    Returns:
+        Dict with the same keys as `ipset list -t`, or None if the set
+        does not exist or netlink is unavailable
+    """
+    sock = netlink_open()
+    if sock is None:
+        return None
+
+    seq = int(time.time())
+    header = None
+    try:
+        sock.send(encode_ipset_list_header(setname, seq))
+        done = False
+        while not done:
+            for msg_type, _, _, payload in parse_nlmsgs(sock.recv(1 << 16)):
+                if msg_type == NLMSG_ERROR:
+                    if parse_nlmsg_error(payload)[0]:
+                        return None
+                elif msg_type == NLMSG_DONE:
+                    done = True
+                elif msg_type == (NFNL_SUBSYS_IPSET << 8) | IPSET_CMD_LIST:
+                    attrs = parse_nlattrs(payload[4:])
+                    data = parse_nlattrs(attrs.get(IPSET_ATTR_DATA, b""))
+                    u32 = lambda key: struct.unpack(">I", data[key])[0] if len(data.get(key, b"")) == 4 else 0
+                    family = {2: 'inet', 10: 'inet6'}.get(attrs.get(IPSET_ATTR_FAMILY, b"\0")[0], 'unknown')
+                    header = {
+                        'Name': attrs.get(IPSET_ATTR_SETNAME, b"").rstrip(b"\0").decode(),
+                        'Type': attrs.get(IPSET_ATTR_TYPENAME, b"").rstrip(b"\0").decode(),
+                        'Revision': str(attrs.get(IPSET_ATTR_REVISION, b"\0")[0]),
+                        'Header': f"family {family} hashsize {u32(IPSET_ATTR_HASHSIZE)} "
+                                  f"maxelem {u32(IPSET_ATTR_MAXELEM)}",
+                        'Size in memory': str(u32(IPSET_ATTR_MEMSIZE)),
+                        'References': str(u32(IPSET_ATTR_REFERENCES)),
+                        'Number of entries': str(u32(IPSET_ATTR_ELEMENTS)),
+                    }
+    except OSError:
+        return None
+    finally:
+        sock.close()
+    return header
+
+
+def nflog_msg(group, seq, *attrs):
+    """Encode an nfnetlink_log config message for one NFLOG group"""
+    payload = struct.pack("!BBH", socket.AF_UNSPEC, 0, group)
+    return nlmsg((NFNL_SUBSYS_ULOG << 8) | NFULNL_MSG_CONFIG, NLM_F_REQUEST | NLM_F_ACK, seq,
+                 payload + b"".join(attrs))
+
+
+def nflog_bind_msgs(group, copy_range=64):
+    """Messages that bind to an NFLOG group and copy packet headers only"""
+    return [
+        nflog_msg(group, 1, nla(NFULA_CFG_CMD, struct.pack("B", NFULNL_CFG_CMD_BIND))),
+        nflog_msg(group, 2, nla(NFULA_CFG_MODE, struct.pack("!IBB", copy_range, NFULNL_COPY_PACKET, 0))),
+    ]
+
+
+def nflog_source_prefix(packet):
+    """Source /24 (IPv4) or /48 (IPv6) of a raw IP packet, or None"""
+    if len(packet) >= 20 and packet[0] >> 4 == 4:
+        return format_prefix(int.from_bytes(packet[12:15], 'big') << 8, 24, 32)
+    if len(packet) >= 40 and packet[0] >> 4 == 6:
+        return format_prefix(int.from_bytes(packet[8:14], 'big') << 80, 48, 128)
+    return None
+
+
+def nflog_summary(group=None, interval=60, max_prefixes=10000, top=10):
+    """Listen on an NFLOG group and log periodic per-prefix drop summaries
+
+    Drops are aggregated in memory per source /24 or /48. At most
+    max_prefixes distinct prefixes are tracked per interval; the rest are
+    counted as 'other', so a flood from random sources can't exhaust memory.
+    When the socket buffer overruns (ENOBUFS) the kernel drops log events;
+    the number of overruns is reported as 'overruns'.
+    """
+    group = get_block_log()[3] if group is None else group
+    sock = netlink_open()
+    if sock is None:
+        print("❌ Cannot open netfilter netlink socket (root required)")
+        return False
+    sock.settimeout(1)
+    for msg in nflog_bind_msgs(group):
+        sock.send(msg)
+
+    print(f"📡 Summarising NFLOG group {group} every {interval}s (Ctrl+C to stop)")
+    counts = {}
+    other = overruns = 0
+    flush_at = time.time() + interval
+    try:
+        while True:
+            try:
+                data = sock.recv(1 << 16)
+            except socket.timeout:
+                data = b""
+            except OSError as e:
+                if e.errno != errno.ENOBUFS:
+                    raise
+                overruns += 1
+                data = b""
+            for msg_type, _, _, payload in parse_nlmsgs(data):
+                if msg_type != (NFNL_SUBSYS_ULOG << 8) | NFULNL_MSG_PACKET:
+                    continue
+                attrs = parse_nlattrs(payload[4:])
+                prefix = nflog_source_prefix(attrs.get(NFULA_PAYLOAD, b""))
+                if prefix is None:
+                    continue
+                if prefix in counts or len(counts) < max_prefixes:
+                    counts[prefix] = counts.get(prefix, 0) + 1
+                else:
+                    other += 1
+
+            if time.time() >= flush_at:
+                total = sum(counts.values()) + other
+                if total or overruns:
+                    ranked = sorted(counts.items(), key=lambda item: -item[1])[:top]
+                    summary = ", ".join(f"{prefix}={n}" for prefix, n in ranked)
+                    logging.info(f"Blocked {total} packets from {len(counts)} prefixes in {interval}s: {summary}"
+                                 + (f", other={other}" if other else "")
+                                 + (f", overruns={overruns} (log events lost)" if overruns else ""))
+                counts, other, overruns = {}, 0, 0
+                flush_at = time.time() + interval
+    except KeyboardInterrupt:
+        pass
+    finally:
+        try:
+            sock.send(nflog_msg(group, 3, nla(NFULA_CFG_CMD, struct.pack("B", NFULNL_CFG_CMD_UNBIND))))
+        except OSError:
+            pass
+        sock.close()
+    return True
+
+
+def ipset_size_params(ips, headroom=None):
+    """Pick hashsize and maxelem for a hash:net set from its contents
+
+    maxelem is the element count plus headroom (rounded up to 1024) so
+    incremental refreshes can grow the set. hash:net probes the table once
+    per distinct prefix length present, so the more lengths the feed mixes
+    (typical for IPv6), the fewer entries per bucket we aim for. Sizing
+    hashsize up front avoids repeated rehashing while the set loads.
+
+    Returns:
+        (hashsize, maxelem, number of distinct prefix lengths)
+    """
+    if headroom is None:
+        headroom = float(load_config().get('ipset_headroom', IPSET_HEADROOM))
+    target = int(len(ips) * (1 + headroom)) + 1
+    probes = len({ip.partition('/')[2] for ip in ips})
+    per_bucket = max(1, 4 - probes // 8)
+    hashsize = IPSET_MIN_HASHSIZE
+    while hashsize * per_bucket < target:
+        hashsize *= 2
+    maxelem = max(IPSET_MIN_MAXELEM, -(-target // 1024) * 1024)
+    return hashsize, maxelem, probes
+
+
+def record_ipset_stats(name, ips, elapsed):
+    """Log and store load time and kernel memory of a freshly loaded set
+
+    Kept under "ipset_stats" in config so sizing changes can be compared.
+    """
+    header = get_ipset_header(name) or {}
+    memory = header.get('Size in memory', '?')
+    hashsize, maxelem, probes = ipset_size_params(ips)
+    stats = {
+        'entries': len(ips),
+        'hashsize': hashsize,
+        'maxelem': maxelem,
+        'prefix_lengths': probes,
+        'load_seconds': round(elapsed, 3),
+        'memory_bytes': int(memory) if str(memory).isdigit() else None,
+        'header': header.get('Header'),
+    }
+    logging.info(f"ipset {name}: {len(ips)} entries, hashsize {hashsize}, maxelem {maxelem}, "
+                 f"{probes} prefix lengths, loaded in {elapsed:.2f}s, {memory} bytes in kernel")
+    config = load_config()
+    config.setdefault('ipset_stats', {})[name] = stats
+    save_config(config)
+    return stats
+
+
+def build_ipset_restore(name, ips, family='inet', create=True):
+    """Build the lines of an `ipset restore` script for one set
+
+    Args:
+        name: Name of the ipset
+        ips: List of IP ranges
+        family: 'inet' for IPv4, 'inet6' for IPv6
+        create: Emit the `create` line (False to only add members)
+    """
+    lines = []
+    if create:
+        hashsize, maxelem, _ = ipset_size_params(ips)
+        lines.append(f"create {name} hash:net family {family} hashsize {hashsize} maxelem {maxelem}")
+    lines.extend(f"add {name} {ip}" for ip in ips)
+    return lines
+
+
+def ipset_restore(lines, max_failures=100):
+    """Stream restore lines into a single `ipset restore` process
+
+    ipset aborts at the first bad line and reports it as "Error in line N".
+    Everything before that line is already applied, so we record the
+    failure and resume with the remaining lines.
+
+    Returns:
+        List of (line_number, line, error) tuples for rejected lines
+    """
+    failures = []
+    offset = 0
+    while offset < len(lines):
+        payload = "\n".join(lines[offset:]) + "\n"
+        success, _, error = run_cmd(["ipset", "restore", "-exist"], input=payload)
+        if success:
+            break
+
+        error = error.strip()
+        bad_line = None
+        marker = "Error in line "
+        if marker in error:
+            num = error.split(marker, 1)[1].split(':', 1)[0]
+            if num.isdigit():
+                bad_line = int(num)
+
+        if bad_line is None or bad_line < 1 or offset + bad_line > len(lines):
+            # Can't tell which line failed - nothing more we can do
+            failures.append((offset + 1, lines[offset], error[:100]))
+            break
+
+        idx = offset + bad_line - 1
+        failures.append((idx + 1, lines[idx], error.split(':', 2)[-1].strip()[:100]))
+        if len(failures) >= max_failures or lines[idx].startswith("create "):
+            break
+        offset = idx + 1
+
+    return failures
+
+
+def load_ipset_members(name, ips, family='inet'):
+    """Create an ipset and load its members in bulk
+
+    Uses netlink batches when "ipset_backend" is "netlink" and the kernel
+    socket is available, otherwise a single `ipset restore` process.
+
+    Returns:
+        Failures as (line_number, line, error) tuples, line 1 being `create`
+    """
+    lines = build_ipset_restore(name, ips, family=family)
+    if get_ipset_backend() == 'netlink':
+        success, _, error = run_cmd(lines[0].replace("create", "ipset create", 1))
+        if not success:
+            return [(1, lines[0], error.strip()[:100])]
+        failures = netlink_ipset_adt(IPSET_CMD_ADD, name, ips)
+        if failures is not None:
+            return [(idx + 2, lines[idx + 1], error) for idx, _, error in failures]
+        logging.warning("Netlink unavailable, falling back to ipset restore")
+        lines = lines[1:]
+        return [(n + 1, line, error) for n, line, error in ipset_restore(lines)]
+    return ipset_restore(lines)
+
+
+def create_ipset(name, ips, family='inet'):
+    """Create ipset for efficient IP matching
+
+    All members are loaded through one `ipset restore` process instead
+    of forking `ipset add` once per range.
+
+    Args:
+        name: Name of the ipset
+        ips: List of IP ranges
+        family: 'inet' for IPv4, 'inet6' for IPv6
+    """
+    # Delete if exists
+    run_cmd(f"ipset destroy {name}", check=False)
+
+    print(f"   Adding {len(ips)} ranges to ipset...")
+    start = time.time()
+    failures = load_ipset_members(name, ips, family=family)
+
+    if failures and failures[0][0] == 1:
+        # The create line itself was rejected
+        print(f"   ⚠️  Command failed: {failures[0][2]}")
+        return False
+
+    for line_no, line, error in failures[:10]:
+        print(f"   ⚠️  Line {line_no} ({line}): {error}")
+    if len(failures) > 10:
+        print(f"   ⚠️  ... and {len(failures) - 10} more rejected lines")
+
+    elapsed = time.time() - start
+    stats = record_ipset_stats(name, ips, elapsed)
+    memory = f", {stats['memory_bytes'] / 1024:.0f} KiB" if stats['memory_bytes'] else ""
+    print(f"   ✓ Loaded {len(ips) - len(failures)}/{len(ips)} ranges in {elapsed:.2f}s "
+          f"(hashsize {stats['hashsize']}{memory})")
+    if failures:
+        logging.warning(f"ipset {name}: {len(failures)} ranges rejected")
+    return True
+
+
+def swap_ipset(name, ips, family='inet'):
+    """Atomically replace the members of a live ipset
+
+    Loads the new ranges into a staging set `<name>_NEW`, swaps it with the
+    live set using `ipset swap` and destroys the old contents. iptables rules
+    keep referencing `name` throughout, so there is no enforcement gap.
+
+    Args:
+        name: Name of the live ipset (must already exist)
+        ips: List of IP ranges
+        family: 'inet' for IPv4, 'inet6' for IPv6
+    """
+    staging = f"{name}_NEW"
+    run_cmd(f"ipset destroy {staging}", check=False)
+
+    print(f"   Staging {len(ips)} ranges in {staging}...")
+    start = time.time()
+    failures = load_ipset_members(staging, ips, family=family)
+    if failures and failures[0][0] == 1:
+        print(f"   ⚠️  Command failed: {failures[0][2]}")
+        return False
+    if failures:
+        print(f"   ⚠️  {len(failures)} ranges rejected")
+
+    success, _, _ = run_cmd(f"ipset swap {staging} {name}", check=True)
+    run_cmd(f"ipset destroy {staging}", check=False)
+    if success:
+        record_ipset_stats(name, ips, time.time() - start)
+    return success
+
+
+def get_ipset_members(name):
+    """Read the current members of an ipset via `ipset save`
+
+    Returns:
+        List of member strings, or None if the set does not exist
+    """
+    success, out, _ = run_cmd(f"ipset save {name}")
+    if not success:
+        return None
+    prefix = f"add {name} "
+    return [line[len(prefix):].split()[0] for line in out.split('\n') if line.startswith(prefix)]
+
+
+def diff_ipset(current, ips):
+    """Compute the members to add and delete to turn `current` into `ips`
+
+    Entries are compared as integer intervals, so `1.2.3.4` and
+    `1.2.3.4/32` or differently written IPv6 addresses are equal.
+
+    Returns:
+        (to_add, to_del) lists of CIDR strings
+    """
+    def keyed(entries):
+        keys = {}
+        for entry in entries:
+            parsed = cidr_to_range(entry)
+            if parsed:
+                keys[parsed[:2]] = entry
+        return keys
+
+    old = keyed(current)
+    new = keyed(ips)
+    to_add = [new[key] for key in sorted(new.keys() - old.keys())]
+    to_del = [old[key] for key in sorted(old.keys() - new.keys())]
+    return to_add, to_del
+
+
+def update_ipset_incremental(name, ips, current=None, delta=None):
+    """Apply only the delta between a live ipset and the new ranges
+
+    Adds are applied before deletes in one restore batch, so a prefix that
+    is re-shaped (e.g. two /24s merged into a /23) never leaves a gap.
+    Callers that already read the members (and diffed them) pass them in
+    to skip a second `ipset save`.
+
+    Returns:
+        (added, removed) counts, or None if the set does not exist
+    """
+    if current is None:
+        current = get_ipset_members(name)
+    if current is None:
+        return None
+
+    to_add, to_del = delta or diff_ipset(current, ips)
+    failures = None
+    if get_ipset_backend() == 'netlink':
+        added = netlink_ipset_adt(IPSET_CMD_ADD, name, to_add) if to_add else []
+        removed = netlink_ipset_adt(IPSET_CMD_DEL, name, to_del) if to_del else []
+        if added is not None and removed is not None:
+            failures = added + removed
+    if failures is None:
+        lines = [f"add {name} {ip}" for ip in to_add] + [f"del {name} {ip}" for ip in to_del]
+        failures = ipset_restore(lines) if lines else []
+    if failures:
+        print(f"   ⚠️  {len(failures)} delta operations rejected")
+
+    print(f"   ✓ {name}: +{len(to_add)} / -{len(to_del)} ranges ({len(current)} → {len(ips)})")
+    logging.info(f"ipset {name} incremental update: added {len(to_add)}, removed {len(to_del)}")
+    return len(to_add), len(to_del)
+
+
+def refresh_ipset(name, ips, family='inet'):
+    """Bring a live ipset up to date with the new ranges
+
+    Uses the incremental delta path when the change is small and a full
+    staging-set swap when most of the set changes.
+    """
+    current = get_ipset_members(name)
+    if current is not None:
+        to_add, to_del = diff_ipset(current, ips)
+        if len(to_add) + len(to_del) <= max(len(ips), 1) // 2:
+            return update_ipset_incremental(name, ips, current, (to_add, to_del)) is not None
+    return swap_ipset(name, ips, family=family)
+
+
+def benchmark_ipset_load(count=5000):
+    """Compare per-range `ipset add` forks with a single `ipset restore`
+
+    Loads `count` synthetic /24 ranges into a scratch set both ways and
+    prints the wall-clock time of each. Requires root.
+    """
+    name = f"{RULE_PREFIX}_BENCH"
+    count = min(count, 65536)
+    ips = [f"10.{i // 256}.{i % 256}.0/24" for i in range(count)]
+
+    print(f"\n⏱️  Benchmarking ipset load with {count} ranges...")
+
+    # Legacy path: one shell + ipset fork per range
+    run_cmd(f"ipset destroy {name}")
+    run_cmd(f"ipset create {name} hash:net family inet maxelem 1000000")
+    start = time.time()
+    for ip in ips:
+        run_cmd(f"ipset add {name} {ip}", shell=True)
+    legacy = time.time() - start
+    run_cmd(f"ipset destroy {name}")
+
+    # Bulk path with the old fixed create line (default hashsize)
+    lines = build_ipset_restore(name, ips)
+    start = time.time()
+    ipset_restore([f"create {name} hash:net family inet maxelem 1000000"] + lines[1:])
+    unsized = time.time() - start
+    unsized_mem = (get_ipset_header(name) or {}).get('Size in memory', '?')
+    run_cmd(f"ipset destroy {name}")
+
+    # Bulk path: one restore process over stdin, sized from the data
+    start = time.time()
+    failures = ipset_restore(lines)
+    bulk = time.time() - start
+    sized_mem = (get_ipset_header(name) or {}).get('Size in memory', '?')
+    run_cmd(f"ipset destroy {name}")
+
+    legacy = max(legacy, 1e-6)
+    bulk = max(bulk, 1e-6)
+    print(format_cmd_stats())
+    print(f"   Per-range add: {legacy:.2f}s ({count / legacy:.0f} ranges/s)")
+    print(f"   ipset restore, default hashsize: {unsized:.2f}s, {unsized_mem} bytes")
+    print(f"   ipset restore, sized ({lines[0].split(' ', 4)[4]}): {bulk:.2f}s, {sized_mem} bytes "
+          f"({count / bulk:.0f} ranges/s)")
+    print(f"   Speedup: {legacy / bulk:.1f}x")
+    if failures:
+        print(f"   ⚠️  {len(failures)} lines rejected during restore")
+    return legacy, bulk
+
+
+def prefix_length_histogram(cidrs):
+    """Count CIDR strings per prefix length"""
+    hist = {}
+    for cidr in cidrs:
+        plen = int(cidr.partition('/')[2] or (128 if ':' in cidr else 32))
+        hist[plen] = hist.get(plen, 0) + 1
+    return hist
+
+
+def plan_prefix_lengths(hist, max_expansion=PREFIX_MAX_EXPANSION):
+    """Choose the fewest prefix lengths that keep the set within max_expansion
+
+    A prefix can only be rewritten onto a longer length (a /20 becomes
+    sixteen /24s), so the longest length present is always kept. For each
+    number of lengths k a small dynamic programme finds the grouping with
+    the fewest resulting entries; the smallest k within the budget wins.
+
+    Returns:
+        Sorted list of prefix lengths to use
+    """
+    lengths = sorted(hist)
+    if not lengths:
+        return []
+    total = sum(hist.values())
+    budget = total * max_expansion
+    m = len(lengths)
+
+    def group_cost(i, j):
+        # Entries when lengths[i..j] are all rewritten onto lengths[j]
+        return sum(hist[lengths[t]] << (lengths[j] - lengths[t]) for t in range(i, j + 1))
+
+    cost = [[group_cost(i, j) if i <= j else None for j in range(m)] for i in range(m)]
+    # best[j] = (entries, chosen lengths) covering lengths[0..j] with lengths[j] chosen
+    best = [(cost[0][j], [lengths[j]]) for j in range(m)]
+    for k in range(1, m + 1):
+        if best[m - 1][0] <= budget:
+            return best[m - 1][1]
+        best = [min(((best[i][0] + cost[i + 1][j], best[i][1] + [lengths[j]]) for i in range(j)),
+                    default=best[j], key=lambda item: item[0])
+                for j in range(m)]
+    return lengths
+
+
+def layout_size(hist, lengths):
+    """Entries a prefix length histogram grows to under apply_prefix_layout()"""
+    allowed = sorted(lengths)
+    return sum(count << (next((length for length in allowed if length >= plen), plen) - plen)
+               for plen, count in hist.items())
+
+
+def apply_prefix_layout(cidrs, lengths, bits=32):
+    """Rewrite CIDRs onto the given prefix lengths (same address coverage)
+
+    Each prefix is split into prefixes of the shortest allowed length that
+    is at least as long as its own. Prefixes longer than every allowed
+    length are kept as they are.
+    """
+    allowed = sorted(lengths)
+    result = []
+    for cidr in cidrs:
+        parsed = cidr_to_range(cidr)
+        if not parsed or parsed[2] != bits:
+            continue
+        start, end, _ = parsed
+        plen = bits - (end - start + 1).bit_length() + 1
+        target = next((length for length in allowed if length >= plen), plen)
+        step = 1 << (bits - target)
+        result.extend(format_prefix(network, target, bits) for network in range(start, end + 1, step))
+    return result
+
+
+def expected_probes(cidrs, bits=32):
+    """Expected hash:net probes per packet for a set holding cidrs
+
+    hash:net tries each prefix length present, most specific first, until
+    one matches. A non-matching packet (what the DROP path sees) costs one
+    probe per length; a matching one stops early, averaged here over the
+    covered address space.
+
+    Returns:
+        (probes per miss, average probes per match)
+    """
+    hist = prefix_length_histogram(cidrs)
+    order = sorted(hist, reverse=True)
+    covered = sum(count << (bits - plen) for plen, count in hist.items())
+    if not covered:
+        return 0, 0.0
+    weighted = sum((rank + 1) * (hist[plen] << (bits - plen)) for rank, plen in enumerate(order))
+    return len(order), weighted / covered
+
+
+def optimize_ipset_layout(cidrs, bits=32):
+    """Apply the configured prefix layout to a hash:net member list"""
+    config = load_config()
+    layout = config.get('ipset_prefix_layout', PREFIX_LAYOUT_DEFAULT)
+    if isinstance(layout, dict):
+        layout = layout.get('v4' if bits == 32 else 'v6', 'auto')
+    elif isinstance(layout, list) and bits != 32:
+        layout = 'auto'
+    if layout == 'off' or not cidrs:
+        return cidrs
+
+    max_expansion = float(config.get('ipset_max_expansion', PREFIX_MAX_EXPANSION))
+    hist = prefix_length_histogram(cidrs)
+    lengths = None
+    if layout != 'auto':
+        lengths = [int(length) for length in layout]
+        if layout_size(hist, lengths) > len(cidrs) * max_expansion:
+            print(f"   ⚠️  Prefix layout {lengths} would grow the /{bits} set past "
+                  f"{max_expansion}x - using the automatic plan")
+            logging.warning(f"Prefix layout {lengths} exceeds ipset_max_expansion for /{bits}, using auto")
+            lengths = None
+    if lengths is None:
+        lengths = plan_prefix_lengths(hist, max_expansion)
+
+    result = apply_prefix_layout(cidrs, lengths, bits)
+    before, after = expected_probes(cidrs, bits), expected_probes(result, bits)
+    print(f"   🧮 Prefix layout: {len(cidrs)} → {len(result)} entries, "
+          f"probes per miss {before[0]} → {after[0]}, per match {before[1]:.1f} → {after[1]:.1f}")
+    logging.info(f"Prefix layout /{bits}: lengths {lengths}, {len(cidrs)} -> {len(result)} entries, "
+                 f"probes miss {before[0]} -> {after[0]}, match {before[1]:.2f} -> {after[1]:.2f}")
+    return result
+
+
+def benchmark_set_lookup(name, packets, repeat):
+    """Time UDP sends to 127.0.0.1 through `repeat` set matches on the raw table
+
+    Returns seconds for `packets` sends, or None if the rules can't be added.
+    The destination misses the set, so each match costs a full probe walk.
+    """
+    chain = f"{RULE_PREFIX}_BENCH"
+    payload = ["*raw", f":{chain} - [0:0]"]
+    payload += [f"-A {chain} -m set --match-set {name} dst -j ACCEPT" for _ in range(repeat)]
+    payload += [f"-I OUTPUT 1 -d 127.0.0.1/32 -p udp --dport 9 -m comment --comment {RULE_PREFIX} -j {chain}",
+                "COMMIT"]
+    if repeat and not iptables_restore("\n".join(payload) + "\n"):
+        return None
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        start = time.time()
+        for _ in range(packets):
+            sock.sendto(b"x", ("127.0.0.1", 9))
+        return time.time() - start
+    finally:
+        sock.close()
+        if repeat:
+            iptables_restore("\n".join(["*raw", f"-D OUTPUT -d 127.0.0.1/32 -p udp --dport 9 -m comment "
+                                        f"--comment {RULE_PREFIX} -j {chain}",
+                                        f"-F {chain}", f"-X {chain}", "COMMIT"]) + "\n")
+
+
+def benchmark_prefix_layout(packets=20000, repeat=50):
+    """Measure in-kernel hash:net lookup cost before and after the prefix layout
+
+    Loads the cached Iran IPv4 ranges as collapsed and as laid out by
+    optimize_ipset_layout() into a scratch set, then times loopback UDP
+    sends through `repeat` set-match rules against a baseline without
+    them. Requires root.
+    """
+    index = build_lookup_index()
+    if index is None:
+        print("❌ No cached feeds - run enable or refresh once first")
+        return None
+    collapsed = intervals_to_cidrs(index_intervals(index, 32), 32)
+    name = f"{RULE_PREFIX}_BENCH_SET"
+
+    print(f"\n⏱️  Benchmarking set lookups: {packets} packets x {repeat} matches")
+    baseline = benchmark_set_lookup(name, packets, 0)
+    results = {}
+    for label, cidrs in (("collapsed", collapsed), ("laid out", optimize_ipset_layout(collapsed, 32))):
+        run_cmd(["ipset", "destroy", name])
+        if ipset_restore(build_ipset_restore(name, cidrs)):
+            print(f"   ⚠️  Could not load {label} set")
+            continue
+        elapsed = benchmark_set_lookup(name, packets, repeat)
+        run_cmd(["ipset", "destroy", name])
+        if elapsed is None:
+            print("   ❌ Could not add benchmark rules")
+            return None
+        per_lookup = max(elapsed - baseline, 0) / (packets * repeat) * 1e9
+        results[label] = per_lookup
+        print(f"   {label:>9}: {len(cidrs)} entries, {expected_probes(cidrs)[0]} prefix lengths, "
+              f"{per_lookup:.0f} ns per lookup")
+    if len(results) == 2 and results["laid out"]:
+        print(f"   Speedup: {results['collapsed'] / results['laid out']:.1f}x")
+    return results
+
+
+def get_block_log():
+    """Return (mode, rate, burst, nflog_group) from config"""
+    config = load_config()
+    mode = config.get('block_log', BLOCK_LOG_DEFAULT)
+    if mode not in BLOCK_LOG_MODES:
+        mode = BLOCK_LOG_DEFAULT
+    return (mode, config.get('block_log_rate', BLOCK_LOG_RATE),
+            int(config.get('block_log_burst', BLOCK_LOG_BURST)),
+            int(config.get('nflog_group', NFLOG_GROUP)))
+
+
+def build_block_log_rule(suffix):
+    """iptables rule spec that logs blocked packets, or None when off
+
+    'limit' samples globally, 'hashlimit' samples per source address and
+    'nflog' hands packets to a userspace listener (see nflog_summary())
+    instead of the kernel log.
+    """
+    mode, rate, burst, group = get_block_log()
+    prefix = f'"[IRAN-BLOCK-{suffix}] "'
+    # iptables spells rates with short units (10/min)
+    ipt_rate = rate.replace("minute", "min").replace("second", "sec")
+    if mode == 'off':
+        return None
+    if mode == 'nflog':
+        return f"-j NFLOG --nflog-group {group} --nflog-prefix {prefix}"
+    if mode == 'hashlimit':
+        # hashlimit names are limited to 15 characters
+        return (f"-m hashlimit --hashlimit-upto {ipt_rate} --hashlimit-burst {burst} "
+                f"--hashlimit-mode srcip --hashlimit-name ICLOG{suffix[1]} "
+                f"-j LOG --log-prefix {prefix} --log-level 4")
+    return f"-m limit --limit {ipt_rate} --limit-burst {burst} -j LOG --log-prefix {prefix} --log-level 4"
+
+
+def build_nft_block_log(family):
+    """nft statement that logs blocked packets of one family, or None when off
+
+    nft has no direct hashlimit equivalent here, so 'hashlimit' falls
+    back to a global rate limit.
+    """
+    mode, rate, burst, group = get_block_log()
+    suffix = "V6" if family == "ipv6" else "V4"
+    prefix = f'"[IRAN-BLOCK-{suffix}] "'
+    count, _, unit = rate.partition("/")
+    nft_rate = f"{count}/" + {"sec": "second", "min": "minute"}.get(unit, unit)
+    if mode == 'off':
+        return None
+    if mode == 'nflog':
+        return f"meta nfproto {family} log prefix {prefix} group {group}"
+    return f"meta nfproto {family} limit rate {nft_rate} burst {burst} packets log prefix {prefix} level warn"
+
+
+def build_iptables_rules(vpn_iface, vpn_port, admin_ips, strict_mode=False, ipv6=False, iran_present=True):
+    """Build the IRAN_CONDUIT chain rules and INPUT rules for one family
+
+    Returns:
+        (chain_rules, input_rules) lists of rule specs. input_rules are in
+        their final top-to-bottom order at the head of INPUT.
+    """
+    suffix = "V6" if ipv6 else "V4"
+
+    if ipv6 and not iran_present:
+        # No IPv6 Iran ranges - block ALL IPv6 to prevent bypass
+        return ["-j DROP"], []
+
+    # Established flows are accepted in INPUT before the jump (see below),
+    # so only new flows reach the set lookups
+    chain_rules = []
+    if not ipv6 or DNS_SERVERS_V6:
+        chain_rules.append(f"-m set --match-set {RULE_PREFIX}_DNS_{suffix} src -j ACCEPT")
+    chain_rules.append(f"-m set --match-set {RULE_PREFIX}_IRAN_{suffix} src -j ACCEPT")
+    log_rule = build_block_log_rule(suffix)
+    if log_rule:
+        chain_rules.append(log_rule)
+    chain_rules.append("-j DROP")
+
+    # Rules outside our chain carry a comment so disable can find them
+    mark = f"-m comment --comment {RULE_PREFIX}"
+
+    # HIGHEST PRIORITY: Allow admin IPs (FULL ACCESS - not just VPN)
+    input_rules = [] if ipv6 else [f"-s {admin_ip} {mark} -j ACCEPT" for admin_ip in admin_ips]
+
+    if vpn_port:
+        protocols = ['udp', 'tcp'] if strict_mode else ['udp']
+        matches = [f"-i {vpn_iface} -p {proto} --dport {vpn_port}" for proto in protocols]
+    elif strict_mode:
+        matches = [f"-i {vpn_iface}"]
+    else:
+        # No port specified - filter only UDP on the interface
+        matches = [f"-i {vpn_iface} -p udp"]
+
+    # Conntrack fast path: established flows of the filtered traffic skip
+    # the chain. Same matches as the jumps, so other INPUT policy still applies
+    input_rules += [f"{match} -m conntrack --ctstate ESTABLISHED,RELATED {mark} -j ACCEPT" for match in matches]
+    input_rules += [f"{match} {mark} -j {RULE_PREFIX}" for match in matches]
+
+    return chain_rules, input_rules
+
+
+def get_drop_stage():
+    """Return the configured drop stage (see DROP_STAGES)"""
+    stage = load_config().get('drop_stage', 'filter')
+    return stage if stage in DROP_STAGES else 'filter'
+
+
+def get_raw_mode():
+    """Return the pre-conntrack mode ('off', 'notrack' or 'drop')
+
+    drop_stage 'raw' implies 'drop'.
+    """
+    if get_drop_stage() == 'raw':
+        return 'drop'
+    mode = load_config().get('raw_mode', 'off')
+    return mode if mode in RAW_MODES else 'off'
+
+
+def build_raw_rules(vpn_iface, vpn_port, admin_ips, strict_mode=False, ipv6=False, iran_present=True,
+                    mode=None):
+    """Build raw-table PREROUTING rules for non-Iran sources on the VPN port
+
+    'notrack' keeps those packets out of conntrack (the filter chain still
+    drops them); 'drop' discards them before conntrack sees them at all.
+    The raw table runs before connection tracking, so established flows
+    cannot be told apart there. Rules are therefore only built when a VPN
+    port is configured; replies to the node's own outbound traffic don't
+    arrive on that port.
+
+    Returns:
+        List of rule specs in top-to-bottom order (empty when off)
+    """
+    mode = mode or get_raw_mode()
+    if mode == 'off' or (ipv6 and not iran_present):
+        return []
+    if not vpn_port:
+        logging.warning(f"raw_mode '{mode}' needs vpn_port to be set - skipped")
+        return []
+
+    suffix = "V6" if ipv6 else "V4"
+    mark = f"-m comment --comment {RULE_PREFIX}"
+    target = "-j CT --notrack" if mode == 'notrack' else "-j DROP"
+    sources = f"-m set ! --match-set {RULE_PREFIX}_IRAN_{suffix} src"
+    if not ipv6 or DNS_SERVERS_V6:
+        sources += f" -m set ! --match-set {RULE_PREFIX}_DNS_{suffix} src"
+
+    rules = [] if ipv6 else [f"-s {admin_ip} {mark} -j ACCEPT" for admin_ip in admin_ips]
+    protocols = ['udp', 'tcp'] if strict_mode else ['udp']
+    rules += [f"-i {vpn_iface} -p {proto} --dport {vpn_port} {sources} {mark} {target}" for proto in protocols]
+    return rules
+
+
+def build_ingress_ruleset(vpn_iface, vpn_port, iran_v4, iran_v6, admin_ips, strict_mode=False):
+    """Render a netdev table that drops non-Iran sources at ingress on vpn_iface
+
+    The ingress hook runs right after the driver, before conntrack and
+    routing. netdev tables can't use sets of other tables, so the Iran,
+    DNS and admin sets are loaded into this table as well.
+    """
+    table = f"netdev {NFT_INGRESS_TABLE}"
+    lines = [f"add table {table}", f"delete table {table}", f"add table {table}"]
+    lines += build_nft_set("iran_v4", "ipv4_addr", iran_v4, table)
+    lines += build_nft_set("dns_v4", "ipv4_addr", DNS_SERVERS, table)
+    if iran_v6:
+        lines += build_nft_set("iran_v6", "ipv6_addr", iran_v6, table)
+        if DNS_SERVERS_V6:
+            lines += build_nft_set("dns_v6", "ipv6_addr", DNS_SERVERS_V6, table)
+    if admin_ips:
+        lines += build_nft_set("admin_v4", "ipv4_addr", admin_ips, table)
+
+    chain = f"{table} ingress"
+    lines.append(f"add chain {chain} {{ type filter hook ingress device \"{vpn_iface}\" priority -500; policy accept; }}")
+    if admin_ips:
+        lines.append(f"add rule {chain} ip saddr @admin_v4 accept")
+    for proto in (['udp', 'tcp'] if strict_mode else ['udp']):
+        lines.append(f"add rule {chain} {proto} dport {vpn_port} ip saddr != @iran_v4 ip saddr != @dns_v4 counter drop")
+        if iran_v6:
+            dns = " ip6 saddr != @dns_v6" if DNS_SERVERS_V6 else ""
+            lines.append(f"add rule {chain} {proto} dport {vpn_port} ip6 saddr != @iran_v6{dns} counter drop")
+    return "\n".join(lines) + "\n"
+
+
+def build_tc_filters(vpn_iface, vpn_port, admin_present, strict_mode=False, iran_v6=True):
+    """Build `tc filter` commands that drop non-Iran sources at tc ingress
+
+    Uses the ipset ematch against our kernel ipsets, so it needs the
+    iptables backend. Protocol and port are read at fixed offsets, so IPv4
+    packets with options or IPv6 packets with extension headers are not
+    matched here and fall through to the filter chain.
+
+    Returns:
+        List of argv lists, the ingress qdisc first
+    """
+    commands = [["tc", "qdisc", "add", "dev", vpn_iface, "ingress"]]
+    families = [("ip", "V4", 9, 22)] + ([("ipv6", "V6", 6, 42)] if iran_v6 else [])
+    for f_index, (protocol, suffix, proto_at, port_at) in enumerate(families):
+        for p_index, proto in enumerate([17, 6] if strict_mode else [17]):
+            match = [f"cmp(u8 at {proto_at} layer network eq {proto})",
+                     f"cmp(u16 at {port_at} layer network eq {vpn_port})",
+                     f"not ipset({RULE_PREFIX}_IRAN_{suffix} src)"]
+            if suffix == "V4" or DNS_SERVERS_V6:
+                match.append(f"not ipset({RULE_PREFIX}_DNS_{suffix} src)")
+            if admin_present and suffix == "V4":
+                match.append(f"not ipset({RULE_PREFIX}_ADMIN src)")
+            commands.append(["tc", "filter", "add", "dev", vpn_iface, "ingress",
+                             "prio", str(TC_PRIO_BASE + 10 * f_index + p_index), "protocol", protocol,
+                             "basic", "match", " and ".join(match), "action", "drop"])
+    return commands
+
+
+def ingress_table_present():
+    """Return True if our netdev ingress table is loaded"""
+    if not shutil.which("nft"):
+        return False
+    success, out, _ = run_cmd(["nft", "list", "tables"])
+    return success and f"table netdev {NFT_INGRESS_TABLE}" in out.split('\n')
+
+
+def remove_drop_stage(vpn_iface=None):
+    """Remove the ingress table and tc filters of the early drop stages
+
+    Runs before ipsets are destroyed, since tc filters hold references to them.
+    """
+    removed = 0
+    if ingress_table_present():
+        run_cmd(["nft", "delete", "table", "netdev", NFT_INGRESS_TABLE])
+        removed += 1
+    vpn_iface = vpn_iface or load_config().get('vpn_interface')
+    for prio in tc_drop_prios(vpn_iface):
+        success, _, _ = run_cmd(["tc", "filter", "del", "dev", vpn_iface, "ingress", "prio", str(prio)])
+        removed += success
+    return removed
+
+
+def tc_drop_prios(vpn_iface):
+    """Priorities of our tc ingress filters present on vpn_iface (one `tc filter show`)"""
+    if not vpn_iface or not shutil.which("tc") or not os.path.exists(os.path.join(SYS_CLASS_NET, vpn_iface)):
+        return []
+    success, out, _ = run_cmd(["tc", "filter", "show", "dev", vpn_iface, "ingress"])
+    if not success:
+        return []
+    prios = set()
+    for line in out.split('\n'):
+        words = line.split()
+        if "pref" in words[:-1]:
+            prio = words[words.index("pref") + 1]
+            if prio.isdigit() and TC_PRIO_BASE <= int(prio) < TC_PRIO_BASE + 20:
+                prios.add(int(prio))
+    return sorted(prios)
+
+
+def build_drop_stage_payload(vpn_iface, vpn_port, iran_v4, iran_v6, admin_ips, strict_mode=False, stage=None):
+    """Payload of the ingress or tc drop stage (filter and raw need nothing extra)
+
+    tc's ipset ematch can't see nftables sets, so 'tc' becomes 'ingress'
+    on the nftables backend.
+
+    Returns:
+        {'ingress': nft text} or {'tc': argv lists}, or {} when the stage
+        needs nothing or can't be built without a VPN port
+    """
+    stage = stage or get_drop_stage()
+    if stage not in ('ingress', 'tc') or not vpn_port:
+        return {}
+    if stage == 'tc' and get_backend() != 'nftables':
+        return {'tc': build_tc_filters(vpn_iface, vpn_port, bool(admin_ips), strict_mode, bool(iran_v6))}
+    return {'ingress': build_ingress_ruleset(vpn_iface, vpn_port, iran_v4, iran_v6, admin_ips, strict_mode)}
+
+
+def stored_drop_stage_payload():
+    """Rebuild the configured drop stage offline from config and the compiled feed"""
+    config = load_config()
+    compiled = load_compiled_feed()
+    if not config.get('vpn_interface') or compiled is None:
+        return {}
+    iran_v4 = intervals_to_cidrs(compiled_intervals(compiled, 32), 32)
+    iran_v6 = intervals_to_cidrs(compiled_intervals(compiled, 128), 128) if config.get('ipv6_count') else []
+    return build_drop_stage_payload(config['vpn_interface'], config.get('vpn_port'), iran_v4, iran_v6,
+                                    config.get('admin_ips', []), config.get('strict_mode', False))
+
+
+def install_drop_stage(payload, vpn_iface):
+    """Load a drop stage payload; a failed tc stage is removed again"""
+    if payload.get('ingress'):
+        return nft_apply(payload['ingress'])
+    if not payload.get('tc'):
+        return True
+    commands = payload['tc']
+    success, out, _ = run_cmd(["tc", "qdisc", "show", "dev", vpn_iface, "ingress"])
+    if not (success and "qdisc ingress" in out):
+        run_cmd(commands[0])
+    for argv in commands[1:]:
+        success, _, error = run_cmd(argv)
+        if not success:
+            print(f"   ⚠️  tc filter failed: {error.strip()[:100]}")
+            remove_drop_stage(vpn_iface)
+            return False
+    return True
+
+
+def apply_drop_stage(vpn_iface, vpn_port, iran_v4, iran_v6, admin_ips, strict_mode=False, stage=None):
+    """Install the ingress or tc drop stage
+
+    Returns:
+        The installed payload ({} when nothing was needed), or None on failure
+    """
+    stage = stage or get_drop_stage()
+    if stage not in ('ingress', 'tc'):
+        return {}
+    if not vpn_port:
+        logging.warning(f"drop_stage '{stage}' needs vpn_port to be set - using filter")
+        print(f"   ⚠️  drop_stage '{stage}' needs a VPN port - dropping in filter INPUT instead")
+        return {}
+    if stage == 'tc' and get_backend() == 'nftables':
+        logging.warning("drop_stage 'tc' needs the iptables backend - using the nft ingress hook")
+        print("   ⚠️  drop_stage 'tc' needs the iptables backend - using the nft ingress hook instead")
+
+    payload = build_drop_stage_payload(vpn_iface, vpn_port, iran_v4, iran_v6, admin_ips, strict_mode, stage)
+    return payload if install_drop_stage(payload, vpn_iface) else None
+
+
+def ensure_drop_stage():
+    """Install the configured drop stage if it is missing and its interface exists
+
+    The VPN tun device often appears only after boot-time restore, so the
+    daemon calls this periodically to put the stage in place late.
+
+    Returns:
+        True if the stage was installed now
+    """
+    vpn_iface = load_config().get('vpn_interface')
+    if get_drop_stage() not in ('ingress', 'tc') or not vpn_iface:
+        return False
+    if not os.path.exists(os.path.join(SYS_CLASS_NET, vpn_iface)):
+        return False
+    if ingress_table_present() or tc_drop_prios(vpn_iface):
+        return False
+    payload = stored_drop_stage_payload()
+    if not payload or not install_drop_stage(payload, vpn_iface):
+        return False
+    logging.info(f"Drop stage installed on {vpn_iface}")
+    return True
+
+
+BENCH_NETNS = f"{RULE_PREFIX.lower()}_bench"
+BENCH_VETH = ("icb0", "icb1")
+BENCH_ADDR = ("198.18.0.1", "198.18.0.2")
+BENCH_PORT = 9
+
+# Runs inside the bench netns: blast UDP at the host side and report wall
+# time plus busy jiffies summed over all CPUs (softirq work lands on
+# whichever CPU the veth backlog is processed on)
+BENCH_SENDER = """
+import os, socket, sys, time
+def busy():
+    with open('/proc/stat') as f:
+        v = [int(x) for x in f.readline().split()[1:]]
+    return sum(v) - v[3] - v[4]
+n = int(sys.argv[1])
+s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+payload = b'x' * 64
+b0, t0 = busy(), time.time()
+for _ in range(n):
+    s.sendto(payload, (sys.argv[2], int(sys.argv[3])))
+print(time.time() - t0, busy() - b0)
+"""
+
+
+def bench_send(packets):
+    """Send packets from the bench netns, return (seconds, busy seconds) or None"""
+    success, out, _ = run_cmd(["ip", "netns", "exec", BENCH_NETNS, sys.executable, "-c", BENCH_SENDER,
+                               str(packets), BENCH_ADDR[0], str(BENCH_PORT)])
+    if not success:
+        return None
+    elapsed, jiffies = out.split()
+    return float(elapsed), int(jiffies) / os.sysconf("SC_CLK_TCK")
+
+
+def benchmark_drop_stages(packets=200000):
+    """Compare the CPU cost per dropped packet of each drop stage
+
+    Builds a veth pair into a scratch netns, loads the cached Iran IPv4
+    ranges into the live set names and sends UDP from a non-Iran source
+    to the host side, once per stage: no rules, filter INPUT, raw
+    PREROUTING, nft ingress and tc ingress. Stages whose tools are missing
+    are skipped. Requires root and refuses to run while enabled, since it
+    uses the same set and chain names.
+    """
+    if is_enabled():
+        print("❌ Disable Iran-only mode before benchmarking drop stages")
+        return None
+    index = build_lookup_index()
+    if index is None:
+        print("❌ No cached feeds - run enable or refresh once first")
+        return None
+    iran_v4 = intervals_to_cidrs(index_intervals(index, 32), 32)
+    iface, peer = BENCH_VETH
+
+    setup = [["ip", "netns", "add", BENCH_NETNS],
+             ["ip", "link", "add", iface, "type", "veth", "peer", "name", peer, "netns", BENCH_NETNS],
+             ["ip", "addr", "add", f"{BENCH_ADDR[0]}/30", "dev", iface],
+             ["ip", "link", "set", iface, "up"],
+             ["ip", "-n", BENCH_NETNS, "addr", "add", f"{BENCH_ADDR[1]}/30", "dev", peer],
+             ["ip", "-n", BENCH_NETNS, "link", "set", peer, "up"]]
+    for argv in setup:
+        success, _, error = run_cmd(argv)
+        if not success:
+            print(f"❌ Bench setup failed ({' '.join(argv[:4])}): {error.strip()[:100]}")
+            run_cmd(["ip", "netns", "del", BENCH_NETNS])
+            return None
+
+    chain_rules, input_rules = build_iptables_rules(iface, BENCH_PORT, [])
+    raw_rules = build_raw_rules(iface, BENCH_PORT, [], mode='drop')
+    stages = [
+        ("none", None, lambda: True, lambda: True),
+        ("filter", "iptables",
+         lambda: iptables_restore(render_iptables_restore(chain_rules, input_rules)),
+         lambda: iptables_restore(render_iptables_undo(input_rules))),
+        ("raw", "iptables",
+         lambda: iptables_restore(render_iptables_restore((), (), raw_rules)),
+         lambda: iptables_restore(render_iptables_undo((), raw_rules))),
+        ("ingress", "nft",
+         lambda: apply_drop_stage(iface, BENCH_PORT, iran_v4, [], [], stage='ingress') is not None,
+         lambda: remove_drop_stage(iface)),
+        ("tc", "tc",
+         lambda: apply_drop_stage(iface, BENCH_PORT, iran_v4, [], [], stage='tc') is not None,
+         lambda: remove_drop_stage(iface)),
+    ]
+
+    print(f"\n⏱️  Benchmarking drop stages: {packets} UDP packets from {BENCH_ADDR[1]} via {iface}")
+    results = {}
+    try:
+        lines = build_ipset_restore(f"{RULE_PREFIX}_IRAN_V4", iran_v4)
+        lines += build_ipset_restore(f"{RULE_PREFIX}_DNS_V4", DNS_SERVERS)
+        if ipset_restore(lines, max_failures=0):
+            print("❌ Could not load benchmark sets")
+            return None
+        bench_send(1000)     # warm up ARP and caches
+        for label, tool, apply, undo in stages:
+            if tool and not shutil.which(tool):
+                print(f"   {label:>8}: skipped ({tool} not installed)")
+                continue
+            if label == "tc" and get_backend() == 'nftables':
+                print(f"   {label:>8}: skipped (needs the iptables backend)")
+                continue
+            if not apply():
+                print(f"   {label:>8}: ⚠️  could not install rules")
+                undo()
+                continue
+            sample = bench_send(packets)
+            undo()
+            if sample is None:
+                print(f"   {label:>8}: ⚠️  sender failed")
+                continue
+            elapsed, busy = sample
+            results[label] = (elapsed / packets * 1e9, busy / packets * 1e9)
+            print(f"   {label:>8}: {results[label][1]:6.0f} ns CPU, {results[label][0]:6.0f} ns wall per packet")
+    finally:
+        disable_iran_only(quiet=True)
+        run_cmd(["ip", "link", "del", iface])
+        run_cmd(["ip", "netns", "del", BENCH_NETNS])
+
+    if "none" in results:
+        base = results["none"][1]
+        print("\n   CPU per packet relative to no rules (includes the sender):")
+        for label, (_, cpu) in results.items():
+            if label != "none":
+                print(f"   {label:>8}: {cpu - base:+6.0f} ns")
+    logging.info(f"Drop stage benchmark ({packets} packets): "
+                 + ", ".join(f"{label} {cpu:.0f}ns" for label, (_, cpu) in results.items()))
+    return results
+
+
+def render_iptables_restore(chain_rules, input_rules, raw_rules=()):
+    """Render an `iptables-restore --noflush` payload for the filter table
+
+    Declaring the chain creates it, or flushes it if it already exists.
+    raw_rules go to the head of raw PREROUTING in the same transaction.
+    """
+    lines = ["*filter", f":{RULE_PREFIX} - [0:0]"]
+    lines += [f"-A {RULE_PREFIX} {rule}" for rule in chain_rules]
+    lines += [f"-I INPUT {pos} {rule}" for pos, rule in enumerate(input_rules, 1)]
+    lines.append("COMMIT")
+    if raw_rules:
+        lines.append("*raw")
+        lines += [f"-I PREROUTING {pos} {rule}" for pos, rule in enumerate(raw_rules, 1)]
+        lines.append("COMMIT")
+    return "\n".join(lines) + "\n"
+
+
+def render_iptables_undo(input_rules, raw_rules=()):
+    """Render a payload that removes what render_iptables_restore() added"""
+    lines = ["*filter"]
+    lines += [f"-D INPUT {rule}" for rule in input_rules]
+    lines += [f"-F {RULE_PREFIX}", f"-X {RULE_PREFIX}", "COMMIT"]
+    if raw_rules:
+        lines.append("*raw")
+        lines += [f"-D PREROUTING {rule}" for rule in raw_rules]
+        lines.append("COMMIT")
+    return "\n".join(lines) + "\n"
+
+
+def iptables_restore(payload, ipv6=False):
+    """Commit a payload with `iptables-restore --noflush` in one transaction"""
+    tool = "ip6tables-restore" if ipv6 else "iptables-restore"
+    success, _, error = run_cmd([tool, "--noflush"], input=payload)
+    if not success:
+        print(f"   ⚠️  {tool} failed: {error.strip()[:100]}")
+    return success
+
+
+def apply_iptables_rules(vpn_iface, vpn_port, admin_ips, strict_mode=False, iran_v6=True):
+    """Apply the IPv4 and IPv6 rulesets, one restore transaction each
+
+    If the IPv6 commit fails, the already committed IPv4 rules are removed
+    again so the node is never left half-configured.
+    """
+    start = time.time()
+    v4_chain, v4_input = build_iptables_rules(vpn_iface, vpn_port, admin_ips, strict_mode, ipv6=False)
+    v6_chain, v6_input = build_iptables_rules(vpn_iface, vpn_port, admin_ips, strict_mode,
+                                              ipv6=True, iran_present=iran_v6)
+    v4_raw = build_raw_rules(vpn_iface, vpn_port, admin_ips, strict_mode, ipv6=False)
+    v6_raw = build_raw_rules(vpn_iface, vpn_port, admin_ips, strict_mode, ipv6=True, iran_present=iran_v6)
+
+    if not iptables_restore(render_iptables_restore(v4_chain, v4_input, v4_raw)):
+        return False
+
+    if not iptables_restore(render_iptables_restore(v6_chain, v6_input, v6_raw), ipv6=True):
+        logging.error("ip6tables-restore failed, rolling back IPv4 rules")
+        iptables_restore(render_iptables_undo(v4_input, v4_raw))
+        return False
+
+    print(f"   ✓ {len(v4_chain) + len(v4_input)} IPv4 + {len(v6_chain) + len(v6_input)} IPv6 "
+          f"rules committed in {time.time() - start:.2f}s")
+    return True
+
+
+def parse_iptables_save(text):
+    """Split `iptables-save` output into {table: (chains, rules)}"""
+    tables = {}
+    table = None
+    for line in text.split('\n'):
+        line = line.strip()
+        if line.startswith('*'):
+            table = line[1:]
+            tables[table] = ([], [])
+        elif table and line.startswith(':'):
+            tables[table][0].append(line[1:].split()[0])
+        elif table and line.startswith('-A '):
+            tables[table][1].append(line)
+    return tables
+
+
+def find_conduit_rules(save_text, admin_ips=()):
+    """Find the chains and rules that belong to this firewall
+
+    Our chains are the ones named with RULE_PREFIX. Rules elsewhere are
+    ours if they jump to such a chain, carry the RULE_PREFIX comment or
+    match one of our sets. Admin ACCEPT rules written before they carried
+    the comment are recognised from the configured admin IPs, but only in
+    a table with no tagged admin rule (an install from before the
+    comment); otherwise an untagged match is someone else's and is only
+    logged.
+
+    Returns:
+        {table: (own_chains, foreign_rules)} for tables with anything to remove
+    """
+    legacy_admin = set()
+    for ip in admin_ips:
+        cidr = ip if '/' in ip else f"{ip}/32"
+        legacy_admin.add(f"-A INPUT -s {cidr} -j ACCEPT")
+
+    found = {}
+    for table, (chains, rules) in parse_iptables_save(save_text).items():
+        own = [chain for chain in chains if chain.startswith(RULE_PREFIX)]
+        foreign = []
+        mark = f" -m comment --comment {RULE_PREFIX}"
+        tagged_admin = legacy_admin & {rule.replace(mark, "") for rule in rules if mark in rule}
+        for rule in rules:
+            chain = rule.split()[1]
+            if chain.startswith(RULE_PREFIX):
+                continue  # removed with the chain flush
+            words = rule.split()
+            if any(word.startswith(RULE_PREFIX) for word in words[2:]):
+                foreign.append(rule)
+            elif rule in legacy_admin:
+                if tagged_admin:
+                    logging.info(f"Leaving untagged admin rule in {table}: {rule}")
+                else:
+                    foreign.append(rule)
+        if own or foreign:
+            found[table] = (own, foreign)
+    return found
+
+
+def render_iptables_cleanup(found):
+    """Render one restore payload that removes everything found"""
+    lines = []
+    for table, (own, foreign) in found.items():
+        lines.append(f"*{table}")
+        lines += ["-D" + rule[2:] for rule in foreign]
+        lines += [f"-F {chain}" for chain in own]
+        lines += [f"-X {chain}" for chain in own]
+        lines.append("COMMIT")
+    return "\n".join(lines) + "\n"
+
+
+def get_backend():
+    """Return the configured firewall backend ('iptables' or 'nftables')"""
+    backend = load_config().get('backend', 'iptables')
+    return backend if backend in ('iptables', 'nftables') else 'iptables'
+
+
+def nft_elements(ips, chunk=4096):
+    """Yield comma-separated element chunks so nft never parses one huge line"""
+    for i in range(0, len(ips), chunk):
+        yield ", ".join(ips[i:i + chunk])
+
+
+def build_nft_set(name, addr_type, ips, table=None):
+    """Render an interval set definition plus its elements"""
+    table = table or f"inet {NFT_TABLE}"
+    lines = [f"add set {table} {name} {{ type {addr_type}; flags interval; }}"]
+    lines.extend(f"add element {table} {name} {{ {chunk} }}" for chunk in nft_elements(ips))
+    return lines
+
+
+def build_nft_ruleset(vpn_iface, vpn_port, iran_v4, iran_v6, admin_ips, strict_mode=False):
+    """Render the complete nftables ruleset as one `nft -f` transaction
+
+    Mirrors the iptables layout: admin IPs and established flows accepted
+    first, then new traffic from the VPN interface jumps to the
+    IRAN_CONDUIT chain which accepts DNS and Iran sources, logs and drops
+    the rest. A single inet table covers both address families.
+    """
+    lines = [
+        # Create-then-delete makes the replace work whether or not the table exists
+        f"add table inet {NFT_TABLE}",
+        f"delete table inet {NFT_TABLE}",
+        f"add table inet {NFT_TABLE}",
+    ]
+
+    lines += build_nft_set("iran_v4", "ipv4_addr", iran_v4)
+    lines += build_nft_set("dns_v4", "ipv4_addr", DNS_SERVERS)
+    if iran_v6:
+        lines += build_nft_set("iran_v6", "ipv6_addr", iran_v6)
+        if DNS_SERVERS_V6:
+            lines += build_nft_set("dns_v6", "ipv6_addr", DNS_SERVERS_V6)
+    if admin_ips:
+        lines += build_nft_set("admin_v4", "ipv4_addr", admin_ips)
+
+    chain = f"inet {NFT_TABLE} {RULE_PREFIX}"
+    lines.append(f"add chain {chain}")
+    lines.append(f"add rule {chain} ip saddr @dns_v4 counter accept")
+    lines.append(f"add rule {chain} ip saddr @iran_v4 counter accept")
+    if build_nft_block_log("ipv4"):
+        lines.append(f"add rule {chain} {build_nft_block_log('ipv4')}")
+    if iran_v6:
+        if DNS_SERVERS_V6:
+            lines.append(f"add rule {chain} ip6 saddr @dns_v6 counter accept")
+        lines.append(f"add rule {chain} ip6 saddr @iran_v6 counter accept")
+        if build_nft_block_log("ipv6"):
+            lines.append(f"add rule {chain} {build_nft_block_log('ipv6')}")
+    lines.append(f"add rule {chain} meta nfproto ipv4 counter drop")
+    lines.append(f"add rule {chain} meta nfproto ipv6 counter drop")
+
+    lines.append(f"add chain inet {NFT_TABLE} input {{ type filter hook input priority 0; policy accept; }}")
+    if admin_ips:
+        lines.append(f"add rule inet {NFT_TABLE} input ip saddr @admin_v4 counter accept")
+
+    # Without IPv6 ranges only IPv4 is filtered, as in the iptables path
+    family = "" if iran_v6 else "meta nfproto ipv4 "
+    protocols = ['udp', 'tcp'] if strict_mode else ['udp']
+
+    # Optional pre-conntrack stage, same rules as build_raw_rules()
+    raw_mode = get_raw_mode()
+    if raw_mode != 'off' and vpn_port:
+        raw = f"inet {NFT_TABLE} prerouting"
+        verdict = "notrack" if raw_mode == 'notrack' else "counter drop"
+        lines.append(f"add chain {raw} {{ type filter hook prerouting priority -300; policy accept; }}")
+        if admin_ips:
+            lines.append(f"add rule {raw} ip saddr @admin_v4 accept")
+        for proto in protocols:
+            match = f"iifname \"{vpn_iface}\" {proto} dport {vpn_port}"
+            lines.append(f"add rule {raw} {match} ip saddr != @iran_v4 ip saddr != @dns_v4 {verdict}")
+            if iran_v6:
+                dns = " ip6 saddr != @dns_v6" if DNS_SERVERS_V6 else ""
+                lines.append(f"add rule {raw} {match} ip6 saddr != @iran_v6{dns} {verdict}")
+    elif raw_mode != 'off':
+        logging.warning(f"raw_mode '{raw_mode}' needs vpn_port to be set - skipped")
+    for proto in protocols:
+        if vpn_port:
+            match = f"{proto} dport {vpn_port} "
+        elif strict_mode:
+            match = ""
+        else:
+            match = "meta l4proto udp "
+        # Conntrack fast path: only new flows jump to the set lookups
+        lines.append(f"add rule inet {NFT_TABLE} input iifname \"{vpn_iface}\" {family}{match}"
+                     "ct state established,related counter accept")
+        lines.append(f"add rule inet {NFT_TABLE} input iifname \"{vpn_iface}\" {family}{match}jump {RULE_PREFIX}")
+        if strict_mode and not vpn_port:
+            # Interface-wide jump already covers every protocol
+            break
+
+    return "\n".join(lines) + "\n"
 
 
-def create_ipset(name, ips, family='inet'):
-    """Create ipset for efficient IP matching
+def nft_apply(payload):
+    """Apply an nft script atomically in one `nft -f -` transaction"""
+    success, _, _ = run_cmd(["nft", "-f", "-"], check=True, input=payload)
+    return success
 
-    Args:
-        name: Name of the ipset
-        ips: List of IP ranges
-        family: 'inet' for IPv4, 'inet6' for IPv6
-    """
-    # Delete if exists
-    run_cmd(f"ipset destroy {name}", check=False)
 
-    # Create new set
-    success, _, _ = run_cmd(f"ipset create {name} hash:net family {family} maxelem 1000000", check=True)
-    if not success:
+def apply_nftables(vpn_iface, vpn_port, iran_v4, iran_v6, admin_ips, strict_mode=False):
+    """Build and atomically apply the nftables ruleset"""
+    start = time.time()
+    payload = build_nft_ruleset(vpn_iface, vpn_port, iran_v4, iran_v6, admin_ips, strict_mode)
+    if not nft_apply(payload):
         return False
+    print(f"   ✓ Table inet {NFT_TABLE} applied in {time.time() - start:.2f}s")
+    return True
 
-    # Add IPs in batches
-    print(f"   Adding {len(ips)} ranges to ipset...")
-    batch_size = 1000
-    for i in range(0, len(ips), batch_size):
-        batch = ips[i:i+batch_size]
-
-        progress = min(i + batch_size, len(ips))
-        pct = int(progress / len(ips) * 100)
-        print(f"\r   Progress: [{'█' * (pct//5):20}] {pct}% ({progress}/{len(ips)})", end="", flush=True)
-
-        for ip in batch:
-            run_cmd(f"ipset add {name} {ip}", check=False)
 
-    print()
-    return True
+def refresh_nft_set(name, addr_type, ips, table=None):
+    """Atomically replace the elements of one nftables set"""
+    table = table or f"inet {NFT_TABLE}"
+    lines = [f"flush set {table} {name}"]
+    lines.extend(f"add element {table} {name} {{ {chunk} }}" for chunk in nft_elements(ips))
+    return nft_apply("\n".join(lines) + "\n")
 
 
 def get_admin_ips():
@@ -317,14 +2686,12 @@ def get_admin_ips():
         print("   (highest priority, bypasses VPN firewall)")
 
     print("\n💡 You can add your current IP to always access web services")
-    # add_ip = input("   Add admin IP now? (y/n): ").strip().lower()
-    add_ip = "y"
+    add_ip = ask("   Add admin IP now? (y/n): ", "n").lower()
 
     if add_ip == 'y':
         print("\n   Your current IP might be one of these:")
         print("   (Check your SSH connection or use: curl ifconfig.me)")
-        # new_ip = input("\n   Enter admin IP to whitelist (or press Enter to skip): ").strip()
-        new_ip = "99.253.248.93"
+        new_ip = ask("\n   Enter admin IP to whitelist (or press Enter to skip): ")
         if new_ip:
             # Basic IP validation
             parts = new_ip.split('.')
@@ -404,7 +2771,7 @@ def manage_admin_ips():
 
 def enable_iran_only(strict_mode=False):
     """
-    Enable Iran-only mode using iptables
+    Enable Iran-only mode using iptables (or nftables, see `backend` in config)
 
     strict_mode: If True, also restricts TCP to Iran (may break broker visibility)
     """
@@ -416,7 +2783,7 @@ def enable_iran_only(strict_mode=False):
     vpn_iface = detect_vpn_interface()
     if not vpn_iface:
         print("   ❌ Cannot proceed without VPN interface")
-        input("\n   Press Enter to go back...")
+        pause("\n   Press Enter to go back...")
         return False
 
     # Detect VPN port (optional)
@@ -429,7 +2796,7 @@ def enable_iran_only(strict_mode=False):
     iran_v4, iran_v6 = download_iran_ips(include_ipv6=True)
     if not iran_v4:
         print("\n❌ Failed to download Iran IP ranges")
-        input("   Press Enter to go back...")
+        pause("   Press Enter to go back...")
         return False
 
     # Clean up old rules
@@ -437,139 +2804,79 @@ def enable_iran_only(strict_mode=False):
     disable_iran_only(quiet=True)
     time.sleep(0.5)
 
-    # ═══════════════════════════════════════════════════════════════
-    # CREATE IPSETS FOR EFFICIENT IP MATCHING
-    # ═══════════════════════════════════════════════════════════════
-
-    # Create ipset for Iran IPv4
-    print("\n📦 Creating IP set for Iran IPv4...")
-    if not create_ipset(f"{RULE_PREFIX}_IRAN_V4", iran_v4, family='inet'):
-        print("   ❌ Failed to create IPv4 ipset")
-        input("   Press Enter to go back...")
-        return False
-
-    # Create ipset for Iran IPv6 (if available)
-    if iran_v6:
-        print("\n📦 Creating IP set for Iran IPv6...")
-        if not create_ipset(f"{RULE_PREFIX}_IRAN_V6", iran_v6, family='inet6'):
-            print("   ⚠️  Warning: Failed to create IPv6 ipset")
-            print("   Continuing without IPv6 support...")
-            iran_v6 = []
-
-    # Create ipset for DNS IPv4
-    print("\n🌐 Creating IP set for DNS IPv4...")
-    if not create_ipset(f"{RULE_PREFIX}_DNS_V4", DNS_SERVERS, family='inet'):
-        print("   ❌ Failed to create DNS ipset")
-        input("   Press Enter to go back...")
-        return False
-
-    # Create ipset for DNS IPv6
-    if DNS_SERVERS_V6:
-        print("\n🌐 Creating IP set for DNS IPv6...")
-        if not create_ipset(f"{RULE_PREFIX}_DNS_V6", DNS_SERVERS_V6, family='inet6'):
-            print("   ⚠️  Warning: Failed to create DNS IPv6 ipset")
-
-    # Create ipset for admin IPs if any exist
-    if admin_ips:
-        print("\n🔐 Creating IP set for admin whitelist...")
-        if not create_ipset(f"{RULE_PREFIX}_ADMIN", admin_ips, family='inet'):
-            print("   ⚠️  Warning: Failed to create admin ipset")
-            print("   Continuing without admin whitelist...")
-            admin_ips = []
-
-    # ═══════════════════════════════════════════════════════════════
-    # CREATE CUSTOM CHAINS FOR IPv4 AND IPv6
-    # ═══════════════════════════════════════════════════════════════
-
-    print("\n🔗 Creating firewall chains...")
-    run_cmd(f"iptables -N {RULE_PREFIX}", check=False)
-    run_cmd(f"ip6tables -N {RULE_PREFIX}", check=False)
-
-    # ═══════════════════════════════════════════════════════════════
-    # BUILD IPv4 FIREWALL RULES
-    # ═══════════════════════════════════════════════════════════════
-
-    print("🔒 Building IPv4 firewall rules...")
-
-    # HIGHEST PRIORITY: Allow admin IPs (FULL ACCESS - not just VPN)
-    if admin_ips:
-        print(f"   ✓ Adding admin IP whitelist (highest priority)")
-        for admin_ip in admin_ips:
-            run_cmd(f"iptables -I INPUT 1 -s {admin_ip} -j ACCEPT", check=True)
-
-    # Allow established connections
-    run_cmd(f"iptables -A {RULE_PREFIX} -m state --state ESTABLISHED,RELATED -j ACCEPT", check=True)
-
-    # Allow DNS IPv4
-    run_cmd(f"iptables -A {RULE_PREFIX} -m set --match-set {RULE_PREFIX}_DNS_V4 src -j ACCEPT", check=True)
-
-    # Allow Iran IPv4
-    run_cmd(f"iptables -A {RULE_PREFIX} -m set --match-set {RULE_PREFIX}_IRAN_V4 src -j ACCEPT", check=True)
-
-    # Log blocked connections (optional - useful for monitoring)
-    run_cmd(f"iptables -A {RULE_PREFIX} -j LOG --log-prefix '[IRAN-BLOCK-V4] ' --log-level 4", check=False)
-
-    # EXPLICIT DROP rule for everything else (KEY SECURITY IMPROVEMENT)
-    run_cmd(f"iptables -A {RULE_PREFIX} -j DROP", check=True)
-
-    # ═══════════════════════════════════════════════════════════════
-    # BUILD IPv6 FIREWALL RULES (if IPv6 support is available)
-    # ═══════════════════════════════════════════════════════════════
-
-    if iran_v6:
-        print("🔒 Building IPv6 firewall rules...")
-
-        # Allow established connections
-        run_cmd(f"ip6tables -A {RULE_PREFIX} -m state --state ESTABLISHED,RELATED -j ACCEPT", check=True)
-
-        # Allow DNS IPv6
+    if get_backend() == 'nftables':
+        print("\n🧱 Applying nftables ruleset...")
+        if not apply_nftables(vpn_iface, vpn_port, iran_v4, iran_v6, admin_ips, strict_mode):
+            print("   ❌ Failed to apply nftables ruleset")
+            pause("   Press Enter to go back...")
+            return False
+    else:
+        # ═══════════════════════════════════════════════════════════════
+        # CREATE IPSETS FOR EFFICIENT IP MATCHING
+        # ═══════════════════════════════════════════════════════════════
+
+        # Create ipset for Iran IPv4
+        print("\n📦 Creating IP set for Iran IPv4...")
+        if not create_ipset(f"{RULE_PREFIX}_IRAN_V4", optimize_ipset_layout(iran_v4, 32), family='inet'):
+            print("   ❌ Failed to create IPv4 ipset")
+            pause("   Press Enter to go back...")
+            return False
+
+        # Create ipset for Iran IPv6 (if available)
+        if iran_v6:
+            print("\n📦 Creating IP set for Iran IPv6...")
+            if not create_ipset(f"{RULE_PREFIX}_IRAN_V6", optimize_ipset_layout(iran_v6, 128), family='inet6'):
+                print("   ⚠️  Warning: Failed to create IPv6 ipset")
+                print("   Continuing without IPv6 support...")
+                iran_v6 = []
+
+        # Create ipset for DNS IPv4
+        print("\n🌐 Creating IP set for DNS IPv4...")
+        if not create_ipset(f"{RULE_PREFIX}_DNS_V4", DNS_SERVERS, family='inet'):
+            print("   ❌ Failed to create DNS ipset")
+            pause("   Press Enter to go back...")
+            return False
+
+        # Create ipset for DNS IPv6
         if DNS_SERVERS_V6:
-            run_cmd(f"ip6tables -A {RULE_PREFIX} -m set --match-set {RULE_PREFIX}_DNS_V6 src -j ACCEPT", check=True)
-
-        # Allow Iran IPv6
-        run_cmd(f"ip6tables -A {RULE_PREFIX} -m set --match-set {RULE_PREFIX}_IRAN_V6 src -j ACCEPT", check=True)
+            print("\n🌐 Creating IP set for DNS IPv6...")
+            if not create_ipset(f"{RULE_PREFIX}_DNS_V6", DNS_SERVERS_V6, family='inet6'):
+                print("   ⚠️  Warning: Failed to create DNS IPv6 ipset")
 
-        # Log blocked connections
-        run_cmd(f"ip6tables -A {RULE_PREFIX} -j LOG --log-prefix '[IRAN-BLOCK-V6] ' --log-level 4", check=False)
+        # Create ipset for admin IPs if any exist
+        if admin_ips:
+            print("\n🔐 Creating IP set for admin whitelist...")
+            if not create_ipset(f"{RULE_PREFIX}_ADMIN", admin_ips, family='inet'):
+                print("   ⚠️  Warning: Failed to create admin ipset")
+                print("   Continuing without admin whitelist...")
+                admin_ips = []
 
-        # EXPLICIT DROP rule for everything else
-        run_cmd(f"ip6tables -A {RULE_PREFIX} -j DROP", check=True)
-    else:
-        # No IPv6 Iran ranges - block ALL IPv6 to prevent bypass
-        print("🚫 No IPv6 ranges - blocking ALL IPv6 traffic to VPN interface...")
-        run_cmd(f"ip6tables -A {RULE_PREFIX} -j DROP", check=True)
+        # ═══════════════════════════════════════════════════════════════
+        # APPLY CHAINS AND INPUT JUMPS (one transaction per family)
+        # ═══════════════════════════════════════════════════════════════
 
-    # ═══════════════════════════════════════════════════════════════
-    # APPLY CHAINS TO INPUT (with protocol filtering)
-    # ═══════════════════════════════════════════════════════════════
+        print("\n🔒 Building firewall rules...")
+        if admin_ips:
+            print(f"   ✓ Adding admin IP whitelist (highest priority)")
+        if not iran_v6:
+            print("🚫 No IPv6 ranges - blocking ALL IPv6 traffic to VPN interface...")
+        if strict_mode:
+            print("   STRICT MODE: TCP+UDP restricted to Iran only")
+        else:
+            print("   NORMAL MODE: UDP Iran-only, TCP global (for broker visibility)")
 
-    print("\n🌍 Configuring protocol access...")
+        if not apply_iptables_rules(vpn_iface, vpn_port, admin_ips, strict_mode, bool(iran_v6)):
+            print("   ❌ Failed to apply firewall rules - rolled back")
+            disable_iran_only(quiet=True)
+            pause("   Press Enter to go back...")
+            return False
 
-    if strict_mode:
-        print("   STRICT MODE: TCP+UDP restricted to Iran only")
-        # In strict mode, apply filtering to both TCP and UDP
-        if vpn_port:
-            run_cmd(f"iptables -I INPUT -i {vpn_iface} -p udp --dport {vpn_port} -j {RULE_PREFIX}", check=True)
-            run_cmd(f"iptables -I INPUT -i {vpn_iface} -p tcp --dport {vpn_port} -j {RULE_PREFIX}", check=True)
-            if iran_v6:
-                run_cmd(f"ip6tables -I INPUT -i {vpn_iface} -p udp --dport {vpn_port} -j {RULE_PREFIX}", check=True)
-                run_cmd(f"ip6tables -I INPUT -i {vpn_iface} -p tcp --dport {vpn_port} -j {RULE_PREFIX}", check=True)
-        else:
-            run_cmd(f"iptables -I INPUT -i {vpn_iface} -j {RULE_PREFIX}", check=True)
-            if iran_v6:
-                run_cmd(f"ip6tables -I INPUT -i {vpn_iface} -j {RULE_PREFIX}", check=True)
-    else:
-        print("   NORMAL MODE: UDP Iran-only, TCP global (for broker visibility)")
-        # Normal mode: Only filter UDP (data tunnel), allow TCP globally (broker checks)
-        if vpn_port:
-            run_cmd(f"iptables -I INPUT -i {vpn_iface} -p udp --dport {vpn_port} -j {RULE_PREFIX}", check=True)
-            if iran_v6:
-                run_cmd(f"ip6tables -I INPUT -i {vpn_iface} -p udp --dport {vpn_port} -j {RULE_PREFIX}", check=True)
-        else:
-            # No port specified - filter only UDP on the interface
-            run_cmd(f"iptables -I INPUT -i {vpn_iface} -p udp -j {RULE_PREFIX}", check=True)
-            if iran_v6:
-                run_cmd(f"ip6tables -I INPUT -i {vpn_iface} -p udp -j {RULE_PREFIX}", check=True)
+    stage = get_drop_stage()
+    if stage != 'filter':
+        print(f"\n⚡ Early drop stage: {stage}")
+        if apply_drop_stage(vpn_iface, vpn_port, iran_v4, iran_v6, admin_ips, strict_mode) is None:
+            print("   ⚠️  Could not install the early drop stage - filter chain still applies")
+            print("      (the daemon installs it once the VPN interface exists)")
 
     # ═══════════════════════════════════════════════════════════════
     # SUMMARY
@@ -608,78 +2915,891 @@ def enable_iran_only(strict_mode=False):
     config['strict_mode'] = strict_mode
     config['ipv4_count'] = len(iran_v4)
     config['ipv6_count'] = len(iran_v6) if iran_v6 else 0
+    compiled = load_compiled_feed()
+    config['feed_digest'] = compiled['digest'] if compiled else None
     save_config(config)
 
     # Save rules
-    print("\n💾 Saving rules...")
-    print("   To make rules persistent across reboots:")
-    print("   • Ubuntu/Debian: apt install iptables-persistent")
-    print("   • Then run: netfilter-persistent save")
+    print("\n💾 Saving snapshot...")
+    if write_snapshot():
+        print(f"   ✓ {SNAPSHOT_FILE}")
+        print("   Run `iran_firewall_linux.py restore` at boot to reload it offline")
+    else:
+        print("   ⚠️  Could not write snapshot (see log)")
 
     logging.info(f"Iran-only mode enabled. IPv4: {len(iran_v4)}, IPv6: {len(iran_v6) if iran_v6 else 0}, Strict: {strict_mode}")
+    logging.info("Command latency:\n" + format_cmd_stats())
 
-    input("\n   Press Enter to go back to menu...")
+    pause("\n   Press Enter to go back to menu...")
     return True
 
 
-def disable_iran_only(quiet=False):
-    """Disable Iran-only mode"""
-    if not quiet:
-        print("\n🔓 Disabling Iran-only mode...\n")
+def is_enabled():
+    """Check whether our chain and Iran set are live for the configured backend"""
+    if get_backend() == 'nftables':
+        enabled, _, _ = run_cmd(f"nft list set inet {NFT_TABLE} iran_v4")
+        return enabled
+    chain_ok, _, _ = run_cmd(f"iptables -n -L {RULE_PREFIX}")
+    set_ok, _, _ = run_cmd(f"ipset list -n {RULE_PREFIX}_IRAN_V4")
+    return chain_ok and set_ok
 
-    config = load_config()
 
-    # Remove admin IP rules from INPUT chain
-    admin_ips = config.get('admin_ips', [])
-    for admin_ip in admin_ips:
-        run_cmd(f"iptables -D INPUT -s {admin_ip} -j ACCEPT", check=False)
+def refresh_iran_only():
+    """Refresh Iran IP ranges in place without touching chains or rules"""
+    print("\n" + "=" * 60)
+    print("🔄 REFRESHING IRAN IP RANGES")
+    print("=" * 60 + "\n")
 
-    # Remove rules by interface (cleanup all protocol rules)
-    vpn_iface = config.get('vpn_interface')
-    vpn_port = config.get('vpn_port')
+    nftables = get_backend() == 'nftables'
 
-    if vpn_iface:
-        if vpn_port:
-            # Remove port-specific rules
-            run_cmd(f"iptables -D INPUT -i {vpn_iface} -p udp --dport {vpn_port} -j {RULE_PREFIX}", check=False)
-            run_cmd(f"iptables -D INPUT -i {vpn_iface} -p tcp --dport {vpn_port} -j {RULE_PREFIX}", check=False)
-            run_cmd(f"ip6tables -D INPUT -i {vpn_iface} -p udp --dport {vpn_port} -j {RULE_PREFIX}", check=False)
-            run_cmd(f"ip6tables -D INPUT -i {vpn_iface} -p tcp --dport {vpn_port} -j {RULE_PREFIX}", check=False)
+    # Refresh only makes sense when the firewall is already enabled
+    if not is_enabled():
+        print("   ❌ Iran-only mode is not enabled - enable it first")
+        pause("\n   Press Enter to go back...")
+        return False
+
+    iran_v4, iran_v6 = download_iran_ips(include_ipv6=True)
+    if not iran_v4:
+        print("\n❌ Failed to download Iran IP ranges - keeping current sets")
+        pause("   Press Enter to go back...")
+        return False
+
+    # The compiled feed digest tells us whether anything changed since the last apply
+    compiled = load_compiled_feed()
+    if compiled and compiled['digest'] == load_config().get('feed_digest'):
+        print("\n✅ Sources unchanged since last apply - live sets already current")
+        logging.info("Refresh skipped, feed digest unchanged")
+        pause("\n   Press Enter to go back to menu...")
+        return True
+
+    print("\n📦 Updating Iran IPv4 set...")
+    if nftables:
+        v4_ok = refresh_nft_set("iran_v4", "ipv4_addr", iran_v4)
+    else:
+        v4_ok = refresh_ipset(f"{RULE_PREFIX}_IRAN_V4", optimize_ipset_layout(iran_v4, 32), family='inet')
+    if not v4_ok:
+        print("   ❌ Failed to refresh IPv4 set - current set left in place")
+        pause("   Press Enter to go back...")
+        return False
+
+    if iran_v6:
+        if nftables:
+            v6_ok, _, _ = run_cmd(f"nft list set inet {NFT_TABLE} iran_v6")
         else:
-            # Remove interface-wide rules
-            run_cmd(f"iptables -D INPUT -i {vpn_iface} -j {RULE_PREFIX}", check=False)
-            run_cmd(f"iptables -D INPUT -i {vpn_iface} -p udp -j {RULE_PREFIX}", check=False)
-            run_cmd(f"ip6tables -D INPUT -i {vpn_iface} -j {RULE_PREFIX}", check=False)
-            run_cmd(f"ip6tables -D INPUT -i {vpn_iface} -p udp -j {RULE_PREFIX}", check=False)
-
-    # Flush and delete custom chains (IPv4)
-    run_cmd(f"iptables -D INPUT -j {RULE_PREFIX}", check=False)
-    run_cmd(f"iptables -F {RULE_PREFIX}", check=False)
-    run_cmd(f"iptables -X {RULE_PREFIX}", check=False)
-
-    # Flush and delete custom chains (IPv6)
-    run_cmd(f"ip6tables -D INPUT -j {RULE_PREFIX}", check=False)
-    run_cmd(f"ip6tables -F {RULE_PREFIX}", check=False)
-    run_cmd(f"ip6tables -X {RULE_PREFIX}", check=False)
-
-    # Destroy ipsets (IPv4)
-    run_cmd(f"ipset destroy {RULE_PREFIX}_IRAN_V4", check=False)
-    run_cmd(f"ipset destroy {RULE_PREFIX}_DNS_V4", check=False)
-    run_cmd(f"ipset destroy {RULE_PREFIX}_ADMIN", check=False)
-
-    # Destroy ipsets (IPv6)
-    run_cmd(f"ipset destroy {RULE_PREFIX}_IRAN_V6", check=False)
-    run_cmd(f"ipset destroy {RULE_PREFIX}_DNS_V6", check=False)
-
-    # Legacy cleanup (for old version compatibility)
-    run_cmd(f"ipset destroy {RULE_PREFIX}_IRAN", check=False)
-    run_cmd(f"ipset destroy {RULE_PREFIX}_DNS", check=False)
+            v6_ok, _, _ = run_cmd(f"ipset list -n {RULE_PREFIX}_IRAN_V6")
+        if v6_ok:
+            print("\n📦 Updating Iran IPv6 set...")
+            if nftables:
+                v6_ok = refresh_nft_set("iran_v6", "ipv6_addr", iran_v6)
+            else:
+                v6_ok = refresh_ipset(f"{RULE_PREFIX}_IRAN_V6", optimize_ipset_layout(iran_v6, 128), family='inet6')
+            if not v6_ok:
+                print("   ⚠️  Warning: Failed to refresh IPv6 set")
+        else:
+            print("\n   ℹ️  No live IPv6 set - re-enable to add IPv6 support")
+            iran_v6 = []
+
+    # The ingress stage keeps its own copies of the sets
+    if ingress_table_present():
+        print("\n📦 Updating ingress drop sets...")
+        table = f"netdev {NFT_INGRESS_TABLE}"
+        ingress_ok = refresh_nft_set("iran_v4", "ipv4_addr", iran_v4, table)
+        if ingress_ok and iran_v6:
+            ingress_ok = refresh_nft_set("iran_v6", "ipv6_addr", iran_v6, table)
+        if not ingress_ok:
+            print("   ⚠️  Warning: Failed to refresh ingress sets")
+
+    config = load_config()
+    config['last_update'] = time.strftime("%Y-%m-%d %H:%M:%S")
+    config['ipv4_count'] = len(iran_v4)
+    if iran_v6:
+        config['ipv6_count'] = len(iran_v6)
+    config['feed_digest'] = compiled['digest'] if compiled else None
+    save_config(config)
+
+    if not write_snapshot():
+        print("   ⚠️  Could not update snapshot (see log)")
+
+    print("\n✅ Iran IP ranges refreshed (no rule changes)")
+    logging.info(f"Iran ranges refreshed. IPv4: {len(iran_v4)}, IPv6: {len(iran_v6) if iran_v6 else 0}")
+    logging.info("Command latency:\n" + format_cmd_stats())
+    pause("\n   Press Enter to go back to menu...")
+    return True
+
+
+def disable_iran_only(quiet=False):
+    """Disable Iran-only mode"""
+    if not quiet:
+        print("\n🔓 Disabling Iran-only mode...\n")
+
+    start = time.time()
+    admin_ips = load_config().get('admin_ips', [])
+
+    # Early drop stages first: tc filters keep our ipsets referenced
+    removed = remove_drop_stage()
+
+    # One snapshot per family, then one restore transaction per family
+    for save_tool, restore_ipv6 in (("iptables-save", False), ("ip6tables-save", True)):
+        if not shutil.which(save_tool):
+            continue
+        success, out, _ = run_cmd([save_tool])
+        if not success:
+            continue
+        found = find_conduit_rules(out, admin_ips if not restore_ipv6 else ())
+        if found:
+            removed += sum(len(chains) + len(rules) for chains, rules in found.values())
+            iptables_restore(render_iptables_cleanup(found), ipv6=restore_ipv6)
+
+    # Destroy our ipsets (including staging and legacy names) once nothing references them
+    if shutil.which("ipset"):
+        success, out, _ = run_cmd(["ipset", "list", "-n"])
+        names = [n.strip() for n in out.split('\n') if n.strip().startswith(f"{RULE_PREFIX}_")] if success else []
+        if names:
+            ipset_restore([f"destroy {name}" for name in names])
+            removed += len(names)
+
+    # nftables backend keeps everything in one table
+    if shutil.which("nft"):
+        success, out, _ = run_cmd(["nft", "list", "tables"])
+        if success and f"table inet {NFT_TABLE}" in out.split('\n'):
+            run_cmd(["nft", "delete", "table", "inet", NFT_TABLE], check=True)
+            removed += 1
+
+    logging.info(f"Disable removed {removed} chains/rules/sets in {time.time() - start:.2f}s")
 
     if not quiet:
         print("✅ Iran-only mode DISABLED")
         print("   VPN now accepts connections from all countries.")
         logging.info("Iran-only mode disabled")
-        input("\n   Press Enter to go back to menu...")
+        pause("\n   Press Enter to go back to menu...")
+
+
+def render_conduit_snapshot(save_text, admin_ips=()):
+    """Turn `iptables-save` output into a restore payload for our rules only
+
+    Our chains are declared and filled; our rules in built-in chains are
+    inserted at the top in their current order, the same way
+    render_iptables_restore() places them.
+    """
+    found = find_conduit_rules(save_text, admin_ips)
+    tables = parse_iptables_save(save_text)
+    lines = []
+    for table, (own, foreign) in found.items():
+        lines.append(f"*{table}")
+        lines += [f":{chain} - [0:0]" for chain in own]
+        lines += [rule for rule in tables[table][1] if rule.split()[1] in own]
+        positions = {}
+        for rule in foreign:
+            chain = rule.split()[1]
+            positions[chain] = positions.get(chain, 0) + 1
+            lines.append(f"-I {chain} {positions[chain]}{rule[3 + len(chain):]}")
+        lines.append("COMMIT")
+    return "\n".join(lines) + "\n" if lines else ""
+
+
+def snapshot_checksum(payloads):
+    """SHA-256 over the snapshot payloads in a stable order"""
+    return hashlib.sha256(json.dumps(payloads, sort_keys=True).encode()).hexdigest()
+
+
+def write_snapshot():
+    """Save the live sets and rules as a compiled snapshot for `restore`
+
+    iptables backend: `ipset save` lines for our sets plus one
+    iptables-restore payload per family. nftables backend: the listed
+    table, which `nft -f` loads as is. Written atomically next to the
+    config so a crash never leaves a truncated snapshot.
+    """
+    start = time.time()
+    backend = get_backend()
+    payloads = {}
+    if backend == 'nftables':
+        success, out, _ = run_cmd(["nft", "list", "table", "inet", NFT_TABLE])
+        if not success:
+            return False
+        payloads['nft'] = (f"add table inet {NFT_TABLE}\ndelete table inet {NFT_TABLE}\n" + out)
+    else:
+        success, out, _ = run_cmd(["ipset", "save"])
+        if not success:
+            return False
+        # Skip staging sets left behind by an interrupted swap
+        payloads['ipset'] = "\n".join(
+            line for line in out.split('\n')
+            if line.split()[1:2] and line.split()[1].startswith(f"{RULE_PREFIX}_")
+            and not line.split()[1].endswith("_NEW")) + "\n"
+        admin_ips = load_config().get('admin_ips', [])
+        for key, save_tool in (('iptables', "iptables-save"), ('ip6tables', "ip6tables-save")):
+            success, out, _ = run_cmd([save_tool])
+            if not success:
+                return False
+            payloads[key] = render_conduit_snapshot(out, admin_ips if key == 'iptables' else ())
+
+    # Early drop stage, rebuilt from config and the compiled feed so it
+    # is saved even when its interface was missing at enable time
+    payloads.update(stored_drop_stage_payload())
+
+    snapshot = {
+        'version': VERSION,
+        'backend': backend,
+        'created': time.strftime("%Y-%m-%d %H:%M:%S"),
+        'payloads': payloads,
+        'sha256': snapshot_checksum(payloads),
+    }
+    tmp = SNAPSHOT_FILE + ".tmp"
+    try:
+        with open(tmp, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp, SNAPSHOT_FILE)
+    except OSError as e:
+        logging.error(f"Failed to write snapshot: {e}")
+        return False
+    logging.info(f"Snapshot written in {time.time() - start:.2f}s ({backend})")
+    return True
+
+
+def restore_snapshot():
+    """Load the compiled snapshot without any network access
+
+    Meant for boot, before the VPN service starts. The checksum is verified
+    first; any previous rules of ours are removed, then sets and rules are
+    committed with one ipset restore and one iptables-restore per family
+    (or a single nft transaction). On failure everything is rolled back.
+    """
+    start = time.time()
+    try:
+        with open(SNAPSHOT_FILE, 'r') as f:
+            snapshot = json.load(f)
+        payloads = snapshot['payloads']
+    except (OSError, ValueError, KeyError) as e:
+        print(f"❌ No usable snapshot at {SNAPSHOT_FILE}: {e}")
+        return False
+    if snapshot.get('sha256') != snapshot_checksum(payloads):
+        print("❌ Snapshot checksum mismatch - refusing to load it")
+        logging.error("Snapshot checksum mismatch")
+        return False
+
+    disable_iran_only(quiet=True)
+    if 'nft' in payloads:
+        ok = nft_apply(payloads['nft'])
+    else:
+        lines = [line for line in payloads.get('ipset', '').split('\n') if line]
+        ok = not ipset_restore(lines, max_failures=0)
+        ok = ok and iptables_restore(payloads.get('iptables', ''))
+        if ok and payloads.get('ip6tables'):
+            ok = iptables_restore(payloads['ip6tables'], ipv6=True)
+    if not ok:
+        disable_iran_only(quiet=True)
+        print("❌ Snapshot restore failed - rolled back")
+        logging.error("Snapshot restore failed")
+        return False
+
+    # The drop stage is an optimisation on top of the rules above. At boot
+    # the VPN interface may not exist yet; the daemon installs it later
+    stage = {key: payloads[key] for key in ('ingress', 'tc') if payloads.get(key)}
+    if stage and not install_drop_stage(stage, load_config().get('vpn_interface')):
+        print("⚠️  Early drop stage not installed (VPN interface missing?) - filter rules are active")
+        logging.warning("Snapshot drop stage failed to apply, left to the daemon")
+
+    elapsed = time.time() - start
+    print(f"✅ Restored snapshot from {snapshot.get('created')} in {elapsed:.2f}s")
+    logging.info(f"Snapshot restored in {elapsed:.2f}s ({snapshot.get('backend')})")
+    return True
+
+
+def read_iptables_counters(ipv6=False):
+    """Read per-rule packet/byte counters with one `iptables-save -c`
+
+    Returns:
+        (chain_rules, input_rules) lists of {'rule', 'packets', 'bytes'}
+        for the IRAN_CONDUIT chain and our rules in INPUT, or None if the
+        chain does not exist
+    """
+    success, out, _ = run_cmd(["ip6tables-save" if ipv6 else "iptables-save", "-c", "-t", "filter"])
+    if not success or f":{RULE_PREFIX} " not in out:
+        return None
+
+    chain_rules, input_rules = [], []
+    for line in out.split('\n'):
+        if not line.startswith('['):
+            continue
+        counters, _, rule = line.partition('] ')
+        packets, _, nbytes = counters[1:].partition(':')
+        words = rule.split()
+        entry = {'rule': rule, 'packets': int(packets), 'bytes': int(nbytes)}
+        if len(words) > 1 and words[1] == RULE_PREFIX:
+            chain_rules.append(entry)
+        elif len(words) > 1 and words[1] == 'INPUT' and RULE_PREFIX in words[2:]:
+            input_rules.append(entry)
+    return chain_rules, input_rules
+
+
+def read_nft_counters(table=None, chain=RULE_PREFIX):
+    """Read rule counters from one nftables chain (`nft -j`, no set elements)
+
+    Defaults to the IRAN_CONDUIT chain; the early drop stages live in the
+    prerouting chain and in the netdev ingress table.
+
+    Returns:
+        {'ipv4': [...], 'ipv6': [...]} lists of {'rule', 'verdict', 'packets',
+        'bytes'}, or None if the table or chain does not exist
+    """
+    table = table or f"inet {NFT_TABLE}"
+    success, out, _ = run_cmd(["nft", "-j", "list", "chain"] + table.split() + [chain])
+    if not success:
+        return None
+    try:
+        items = json.loads(out).get('nftables', [])
+    except ValueError:
+        return None
+
+    families = {'ipv4': [], 'ipv6': []}
+    for item in items:
+        rule = item.get('rule')
+        if not rule:
+            continue
+        text = json.dumps(rule.get('expr', []))
+        counter = next((e['counter'] for e in rule.get('expr', []) if 'counter' in e), None)
+        if counter is None:
+            continue
+        verdict = 'accept' if '"accept"' in text else 'drop'
+        entry = {'rule': text, 'verdict': verdict,
+                 'packets': counter.get('packets', 0), 'bytes': counter.get('bytes', 0)}
+        # Rules that match one address family only
+        if '"ip6"' in text or '"ipv6"' in text:
+            families['ipv6'].append(entry)
+        elif '"ip"' in text or '"ipv4"' in text:
+            families['ipv4'].append(entry)
+        else:
+            # Rules without an address family match
+            families['ipv4'].append(entry)
+    return families
+
+
+def read_iptables_raw_drops(ipv6=False):
+    """Packets/bytes dropped by our rules in raw PREROUTING (`iptables-save -c -t raw`)
+
+    Returns:
+        {'packets', 'bytes'}, or None if none of our DROP rules are loaded
+    """
+    success, out, _ = run_cmd(["ip6tables-save" if ipv6 else "iptables-save", "-c", "-t", "raw"])
+    if not success:
+        return None
+    totals = None
+    for line in out.split('\n'):
+        if not line.startswith('[') or RULE_PREFIX not in line or not line.endswith('-j DROP'):
+            continue
+        counters, _, rule = line.partition('] ')
+        if rule.split()[1:2] != ['PREROUTING']:
+            continue
+        packets, _, nbytes = counters[1:].partition(':')
+        totals = totals or {'packets': 0, 'bytes': 0}
+        totals['packets'] += int(packets)
+        totals['bytes'] += int(nbytes)
+    return totals
+
+
+def read_tc_drops(vpn_iface):
+    """Packets/bytes dropped by our tc ingress filters (`tc -s filter show`)
+
+    Returns:
+        {'ipv4': {'packets', 'bytes'}, 'ipv6': {...}}, or None without filters
+    """
+    if not tc_drop_prios(vpn_iface):
+        return None
+    success, out, _ = run_cmd(["tc", "-s", "filter", "show", "dev", vpn_iface, "ingress"])
+    if not success:
+        return None
+    families = {}
+    family = None
+    for line in out.split('\n'):
+        words = line.split()
+        if "pref" in words[:-1] and "protocol" in words[:-1]:
+            prio = words[words.index("pref") + 1]
+            ours = prio.isdigit() and TC_PRIO_BASE <= int(prio) < TC_PRIO_BASE + 20
+            protocol = words[words.index("protocol") + 1]
+            family = ('ipv6' if protocol == 'ipv6' else 'ipv4') if ours else None
+        elif family and words[:1] == ["Sent"] and len(words) >= 5 and words[1].isdigit() and words[3].isdigit():
+            # "Sent <bytes> bytes <packets> pkt (dropped ...)"
+            totals = families.setdefault(family, {'packets': 0, 'bytes': 0})
+            totals['bytes'] += int(words[1])
+            totals['packets'] += int(words[3])
+            family = None   # one action statistics line per filter
+    return families
+
+
+def read_drop_stages(backend, vpn_iface):
+    """Drops counted by the early stages, outside the IRAN_CONDUIT chain
+
+    Packets dropped there never reach the chain, so these add to its
+    'dropped' totals rather than overlap them.
+
+    Returns:
+        {stage: {family: {'packets', 'bytes'}}} for the stages that are loaded
+    """
+    stages = {}
+
+    def add_nft(stage, counters):
+        if counters is None:
+            return
+        for family, rules in counters.items():
+            dropped = sum_verdicts(rules)['dropped']
+            if rules:
+                stages.setdefault(stage, {})[family] = dropped
+
+    if backend == 'nftables':
+        add_nft('raw', read_nft_counters(chain="prerouting"))
+    else:
+        for family, ipv6 in (('ipv4', False), ('ipv6', True)):
+            dropped = read_iptables_raw_drops(ipv6)
+            if dropped is not None:
+                stages.setdefault('raw', {})[family] = dropped
+    if ingress_table_present():
+        add_nft('ingress', read_nft_counters(f"netdev {NFT_INGRESS_TABLE}", "ingress"))
+    tc = read_tc_drops(vpn_iface) if vpn_iface else None
+    if tc:
+        stages['tc'] = tc
+    return stages
+
+
+def read_ipset_headers():
+    """Read all of our set headers with one `ipset list -t` (no members)
+
+    Returns:
+        {name: {'type', 'entries', 'memory_bytes', 'references', 'header'}}
+    """
+    success, out, _ = run_cmd(["ipset", "list", "-t"])
+    if not success:
+        return {}
+
+    sets = {}
+    current = None
+    for line in out.split('\n'):
+        key, sep, value = line.partition(':')
+        key, value = key.strip(), value.strip()
+        if not sep:
+            continue
+        if key == 'Name':
+            current = value if value.startswith(f"{RULE_PREFIX}_") else None
+            if current:
+                sets[current] = {}
+        elif current:
+            if key == 'Type':
+                sets[current]['type'] = value
+            elif key == 'Header':
+                sets[current]['header'] = value
+            elif key == 'Size in memory':
+                sets[current]['memory_bytes'] = int(value) if value.isdigit() else None
+            elif key == 'References':
+                sets[current]['references'] = int(value) if value.isdigit() else None
+            elif key == 'Number of entries':
+                sets[current]['entries'] = int(value) if value.isdigit() else None
+    return sets
+
+
+def sum_verdicts(rules):
+    """Total packets/bytes per verdict for a list of counter entries"""
+    totals = {'accepted': {'packets': 0, 'bytes': 0}, 'dropped': {'packets': 0, 'bytes': 0}}
+    for entry in rules:
+        verdict = entry.get('verdict')
+        if verdict is None:
+            rule = entry['rule']
+            verdict = 'accept' if rule.endswith('-j ACCEPT') else 'drop' if rule.endswith('-j DROP') else None
+        if verdict in ('accept', 'drop'):
+            bucket = totals['accepted' if verdict == 'accept' else 'dropped']
+            bucket['packets'] += entry['packets']
+            bucket['bytes'] += entry['bytes']
+    return totals
+
+
+def collect_status():
+    """Collect firewall status and kernel counters as a plain dict
+
+    Only headers and counters are read - set members are never listed,
+    so this stays fast with tens of thousands of ranges.
+    """
+    config = load_config()
+    backend = get_backend()
+    status = {
+        'version': VERSION,
+        'timestamp': int(time.time()),
+        'backend': backend,
+        'enabled': False,
+        'config': {
+            'vpn_interface': config.get('vpn_interface'),
+            'vpn_port': config.get('vpn_port'),
+            'strict_mode': config.get('strict_mode', False),
+            'last_update': config.get('last_update'),
+            'ipv4_count': config.get('ipv4_count'),
+            'ipv6_count': config.get('ipv6_count'),
+            'admin_ips': len(config.get('admin_ips', [])),
+        },
+        'families': {},
+        'sets': {},
+    }
+
+    # Established flows are accepted by the conntrack fast path in INPUT,
+    # before the jump, so those rules count towards 'accepted' as well
+    if backend == 'nftables':
+        families = read_nft_counters()
+        if families is not None:
+            status['enabled'] = True
+            fast_path = read_nft_counters(chain="input") or {}
+            for family, rules in families.items():
+                input_rules = [rule for rule in fast_path.get(family, []) if '"ct"' in rule['rule']]
+                status['families'][family] = dict(rules=rules, input_rules=input_rules,
+                                                  **sum_verdicts(rules + input_rules))
+    else:
+        for family, ipv6 in (('ipv4', False), ('ipv6', True)):
+            counters = read_iptables_counters(ipv6)
+            if counters is None:
+                continue
+            chain_rules, input_rules = counters
+            fast_path = [rule for rule in input_rules if "--ctstate" in rule['rule']]
+            status['enabled'] = status['enabled'] or (not ipv6 and bool(chain_rules))
+            status['families'][family] = dict(rules=chain_rules, input_rules=input_rules,
+                                              **sum_verdicts(chain_rules + fast_path))
+        status['sets'] = read_ipset_headers()
+
+    vpn_iface = config.get('vpn_interface')
+    # Drops per stage: 'filter' is the chain, the rest happen before it
+    status['drop_stages'] = {'filter': {family: data['dropped'] for family, data in status['families'].items()}}
+    status['drop_stages'].update(read_drop_stages(backend, vpn_iface))
+    if vpn_iface:
+        status['interface'] = {'name': vpn_iface, 'state': interface_state(vpn_iface) or 'missing'}
+    status['established_connections'] = count_established()
+    return status
+
+
+def show_status_json():
+    """Print collect_status() as JSON (non-interactive)"""
+    print(json.dumps(collect_status(), indent=2))
+
+
+def feed_ages():
+    """Return {url: seconds since the cached copy was fetched}"""
+    ages = {}
+    for url in IP_SOURCES_V4 + IP_SOURCES_V6:
+        cached = load_feed_cache(url)
+        if cached and cached.get('fetched_at'):
+            ages[url] = time.time() - cached['fetched_at']
+    return ages
+
+
+def format_metrics(status, ages=None, last_refresh=None):
+    """Render a status dict as Prometheus text exposition format"""
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            label_text = ",".join(f'{key}="{escape(val)}"' for key, val in labels.items())
+            lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+    metric("iran_conduit_enabled", "gauge", "Whether Iran-only mode is active",
+           [({'backend': status['backend']}, int(status['enabled']))])
+
+    packets, nbytes = [], []
+    for family, data in sorted(status['families'].items()):
+        labels = {'family': family, 'verdict': 'accept', 'stage': 'filter'}
+        packets.append((labels, data['accepted']['packets']))
+        nbytes.append((labels, data['accepted']['bytes']))
+    drop_stages = status.get('drop_stages') or {
+        'filter': {family: data['dropped'] for family, data in status['families'].items()}}
+    for stage, families in sorted(drop_stages.items()):
+        for family, data in sorted(families.items()):
+            labels = {'family': family, 'verdict': 'drop', 'stage': stage}
+            packets.append((labels, data['packets']))
+            nbytes.append((labels, data['bytes']))
+    metric("iran_conduit_packets_total", "counter",
+           "Packets accepted or dropped, by the stage that decided (filter chain, raw, ingress, tc)", packets)
+    metric("iran_conduit_bytes_total", "counter",
+           "Bytes accepted or dropped, by the stage that decided (filter chain, raw, ingress, tc)", nbytes)
+
+    sets = sorted(status['sets'].items())
+    metric("iran_conduit_set_entries", "gauge", "Number of entries in each ipset",
+           [({'set': name}, info['entries']) for name, info in sets if info.get('entries') is not None])
+    metric("iran_conduit_set_memory_bytes", "gauge", "Kernel memory used by each ipset",
+           [({'set': name}, info['memory_bytes']) for name, info in sets if info.get('memory_bytes') is not None])
+
+    if last_refresh:
+        metric("iran_conduit_last_refresh_timestamp_seconds", "gauge",
+               "Unix time of the last enable or refresh", [({}, int(last_refresh))])
+    if ages:
+        metric("iran_conduit_feed_age_seconds", "gauge", "Age of the cached copy of each feed",
+               [({'source': url}, int(age)) for url, age in sorted(ages.items())])
+
+    metric("iran_conduit_established_connections", "gauge",
+           "Established TCP and connected UDP sockets", [({}, status['established_connections'])])
+    return "\n".join(lines) + "\n"
+
+
+def last_refresh_time(config):
+    """Parse config['last_update'] into a Unix timestamp (or None)"""
+    try:
+        return time.mktime(time.strptime(config['last_update'], "%Y-%m-%d %H:%M:%S"))
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def make_metrics_source(collect=collect_status, cache_seconds=METRICS_CACHE_SECONDS):
+    """Return a function producing metrics text, cached for cache_seconds
+
+    Kernel counters are only re-read once the cache expires, so frequent
+    scrapes don't fork iptables every time. `collect` can be replaced by
+    a fake counter source.
+    """
+    cache = {'time': 0.0, 'text': ""}
+    lock = threading.Lock()
+
+    def source():
+        with lock:
+            now = time.time()
+            if not cache['text'] or now - cache['time'] >= cache_seconds:
+                cache['text'] = format_metrics(collect(), feed_ages(), last_refresh_time(load_config()))
+                cache['time'] = now
+            return cache['text']
+    return source
+
+
+def make_metrics_server(source, addr=METRICS_ADDR, port=METRICS_PORT):
+    """Build an HTTP server that serves source() on /metrics"""
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            try:
+                body = source().encode('utf-8')
+            except Exception as e:
+                logging.error(f"Metrics collection failed: {e}")
+                self.send_error(500)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return http.server.HTTPServer((addr, port), MetricsHandler)
+
+
+def serve_metrics():
+    """Serve Prometheus metrics on localhost until interrupted"""
+    config = load_config()
+    addr = config.get('metrics_addr', METRICS_ADDR)
+    port = int(config.get('metrics_port', METRICS_PORT))
+    cache_seconds = float(config.get('metrics_cache_seconds', METRICS_CACHE_SECONDS))
+
+    server = make_metrics_server(make_metrics_source(cache_seconds=cache_seconds), addr, port)
+    print(f"📈 Serving metrics on http://{addr}:{port}/metrics (cache {cache_seconds:g}s)")
+    logging.info(f"Metrics exporter listening on {addr}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def log_source_prefix(key):
+    """Format a scan key as a /24 (IPv4) or /48 (IPv6) source prefix"""
+    if b"/" in key:
+        return key.decode()     # already a prefix
+    if b":" not in key:
+        return key.decode() + ".0/24"
+    try:
+        packed = socket.inet_pton(socket.AF_INET6, key.decode())
+    except (OSError, ValueError):
+        return key.decode(errors="replace")
+    return format_prefix(int.from_bytes(packed[:6], "big") << 80, 48, 128)
+
+
+def merge_bounded(counts, window, capacity, floor, errors):
+    """Merge exact window counts into a table of at most ~2*capacity counters
+
+    Space-saving in batches: when the table overflows, only the top
+    `capacity` keys survive and floor[0] becomes the largest count
+    discarded so far. A key that is not in the table starts from floor[0],
+    which is at least its true count before, and errors[key] records that
+    inherited part. So every count is an overestimate: the true count lies
+    in [count - errors[key], count].
+
+    Only the top capacity + 1 new keys of the window can survive a prune,
+    so the rest are never inserted. Consumes window.
+    """
+    base = floor[0]
+    for key in counts.keys() & window.keys():
+        counts[key] += window.pop(key)
+    overflow = len(counts) + len(window) > 2 * capacity
+    new = heapq.nlargest(capacity + 1, window.items(), key=operator.itemgetter(1)) if overflow else window.items()
+    for key, hits in new:
+        counts[key] = base + hits
+        if base:
+            errors[key] = base
+    if overflow:
+        # The (capacity + 1)th count is >= every new key left out above
+        keep = heapq.nlargest(capacity + 1, counts.items(), key=operator.itemgetter(1))
+        floor[0] = max(base, keep[-1][1])
+        counts.clear()
+        counts.update(keep[:capacity])
+        for stale in errors.keys() - counts.keys():
+            del errors[stale]
+
+
+def scan_block_chunk(chunk, srcs, ports):
+    """Count sources and (PROTO, DPT) of every IRAN-BLOCK line in a chunk
+
+    One findall() over the whole chunk with BLOCK_LINE; the counts are
+    taken with Counter.update() on the match tuples, so no Python code runs
+    per line. IPv4 sources are keyed by their first three octets so the
+    tables stay small; IPv6 sources are kept whole.
+    """
+    rows = BLOCK_LINE.findall(chunk)
+    srcs.update(map(operator.itemgetter(0), rows))
+    ports.update(map(operator.itemgetter(1, 2), rows))
+
+
+def open_log_stream(path):
+    """Open a plain or gzip-rotated log file, or '-' for stdin, as bytes"""
+    if path == "-":
+        return sys.stdin.buffer
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+def default_log_paths():
+    """Rotations of the first kernel log file present, oldest first
+
+    Only one of KERN_LOG_FILES is read: some distros write kernel messages
+    to both, which would count every hit twice.
+    """
+    for base in KERN_LOG_FILES:
+        directory, name = os.path.split(base)
+        if not os.path.exists(base):
+            continue
+        rotated = [f for f in os.listdir(directory) if f.startswith(name + ".")]
+        rotated.sort(key=lambda f: int(f[len(name) + 1:].split(".")[0])
+                     if f[len(name) + 1:].split(".")[0].isdigit() else 0, reverse=True)
+        return [os.path.join(directory, f) for f in rotated] + [base]
+    return []
+
+
+def analyze_block_logs(paths=None, follow=False, capacity=ANALYZE_CAPACITY):
+    """Stream IRAN-BLOCK log lines and count top source prefixes and ports
+
+    Reads the given files (plain, .gz or '-'), the rotated kernel logs, or
+    the kernel journal when no log files exist. With follow=True the live
+    journal is tailed until Ctrl+C. Returns a summary dict.
+    """
+    streams = []
+    if follow:
+        streams.append(("journal", ["journalctl", "-k", "-f", "-o", "cat", "-n", "0"]))
+    else:
+        paths = paths or default_log_paths()
+        if paths:
+            streams.extend((path, None) for path in paths)
+        else:
+            streams.append(("journal", ["journalctl", "-k", "-o", "cat", "--no-pager"]))
+
+    # Bounded tables keyed like the scan (IPv4 /24 as raw bytes), so
+    # only the reported top entries are ever formatted
+    prefixes, ports = {}, {}
+    prefix_floor, port_floor = [0], [0]
+    prefix_err, port_err = {}, {}
+    # Exact per-window tables, folded into the bounded ones when they grow
+    srcs, raw_ports = collections.Counter(), collections.Counter()
+    totals = [0, 0]     # packets, of which IPv6
+
+    def fold():
+        totals[0] += sum(srcs.values())
+        v6 = [src for src in srcs if b":" in src]
+        for src in v6:
+            hits = srcs.pop(src)
+            totals[1] += hits
+            key = log_source_prefix(src).encode()
+            srcs[key] = srcs.get(key, 0) + hits
+        merge_bounded(prefixes, srcs, capacity, prefix_floor, prefix_err)
+        merge_bounded(ports, raw_ports, capacity, port_floor, port_err)
+        srcs.clear()
+        raw_ports.clear()
+
+    started = time.time()
+    try:
+        for name, argv in streams:
+            proc = None
+            try:
+                if argv:
+                    proc = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+                    stream = proc.stdout
+                else:
+                    stream = open_log_stream(name)
+            except OSError as e:
+                logging.warning(f"Cannot read {name}: {e}")
+                continue
+            try:
+                tail = b""
+                while True:
+                    # read1() returns what is available, so live pipes aren't held back
+                    data = stream.read1(ANALYZE_CHUNK)
+                    if not data:
+                        chunk, tail = tail, b""
+                    else:
+                        cut = data.rfind(b"\n") + 1
+                        if cut:
+                            chunk, tail = tail + data[:cut], data[cut:]
+                        else:
+                            # No line end yet - keep accumulating the partial line
+                            chunk, tail = b"", tail + data
+                    if chunk:
+                        scan_block_chunk(chunk, srcs, raw_ports)
+                        if len(srcs) > 16 * capacity or len(raw_ports) > 16 * capacity:
+                            fold()
+                    if not data:
+                        break
+            finally:
+                if proc:
+                    proc.terminate()
+                    proc.wait()
+                elif stream is not sys.stdin.buffer:
+                    stream.close()
+    except KeyboardInterrupt:
+        pass
+    fold()
+
+    return {
+        "lines": totals[0],
+        "ipv6": totals[1],
+        "seconds": round(time.time() - started, 2),
+        # (key, count, error): the true count is between count - error and count
+        "top_prefixes": [(log_source_prefix(key), count, prefix_err.get(key, 0)) for key, count in
+                         heapq.nlargest(ANALYZE_TOP, prefixes.items(), key=operator.itemgetter(1))],
+        "top_ports": [(f"{key[0].decode()}/{key[1].decode() or '-'}", count, port_err.get(key, 0)) for key, count in
+                      heapq.nlargest(ANALYZE_TOP, ports.items(), key=operator.itemgetter(1))],
+        "approximate": bool(prefix_floor[0] or port_floor[0]),
+    }
+
+
+def show_block_analysis(paths=None, follow=False):
+    """Print top blocked source prefixes and destination ports"""
+    summary = analyze_block_logs(paths, follow)
+    print(f"\n📊 {summary['lines']} blocked packets logged "
+          f"({summary['ipv6']} IPv6), parsed in {summary['seconds']}s")
+    if summary["approximate"]:
+        print("   (approximate: some counts are overestimates, by at most the amount shown)")
+    print("\nTop source prefixes:")
+    for prefix, count, error in summary["top_prefixes"]:
+        print(f"  {count:>10}  {prefix}" + (f"  (over by ≤{error})" if error else ""))
+    print("\nTop destination ports:")
+    for port, count, error in summary["top_ports"]:
+        print(f"  {count:>10}  {port}" + (f"  (over by ≤{error})" if error else ""))
 
 
 def show_status():
@@ -688,17 +3808,34 @@ def show_status():
     print("📊 CURRENT STATUS")
     print("=" * 50 + "\n")
 
+    # Check nftables table (nftables backend)
+    nft_ok, nft_out, _ = run_cmd(f"nft list chain inet {NFT_TABLE} {RULE_PREFIX}")
+
     # Check iptables rules (IPv4)
-    success, out, _ = run_cmd(f"iptables -L {RULE_PREFIX} -n -v 2>/dev/null")
+    success, out, _ = run_cmd(f"iptables -L {RULE_PREFIX} -n -v")
+
+    if nft_ok and nft_out:
+        rule_count = len([l for l in nft_out.split('\n') if l.strip().endswith(('accept', 'drop', '" level warn'))])
+        config = load_config()
+        print(f"   ✅ IRAN-ONLY MODE ENABLED (nftables)")
+        print(f"   📋 Rules in inet {NFT_TABLE}: {rule_count}")
+        print(f"\n   🇮🇷 IP Range Statistics:")
+        print(f"      • IPv4: {config.get('ipv4_count', 'unknown')} Iran ranges")
+        print(f"      • IPv6: {config.get('ipv6_count', 0)} Iran ranges")
+        print(f"\n   🕒 Last updated: {config.get('last_update', 'Unknown')}")
+        if config.get('strict_mode', False):
+            print(f"   ⚠️  Mode: STRICT (TCP+UDP restricted)")
+        else:
+            print(f"   🌍 Mode: Normal (UDP Iran-only, TCP global)")
 
-    if success and out and RULE_PREFIX in out:
+    elif success and out and RULE_PREFIX in out:
         # Count IPv4 rules
         ipv4_rule_count = len([l for l in out.split('\n') if l and not l.startswith('Chain') and not l.startswith('target')])
         print(f"   ✅ IRAN-ONLY MODE ENABLED")
         print(f"   📋 IPv4 rules: {ipv4_rule_count}")
 
         # Check IPv6 rules
-        success_v6, out_v6, _ = run_cmd(f"ip6tables -L {RULE_PREFIX} -n -v 2>/dev/null")
+        success_v6, out_v6, _ = run_cmd(f"ip6tables -L {RULE_PREFIX} -n -v")
         if success_v6 and out_v6 and RULE_PREFIX in out_v6:
             ipv6_rule_count = len([l for l in out_v6.split('\n') if l and not l.startswith('Chain') and not l.startswith('target')])
             print(f"   📋 IPv6 rules: {ipv6_rule_count}")
@@ -709,22 +3846,19 @@ def show_status():
         print(f"\n   🇮🇷 IP Range Statistics:")
 
         # IPv4 ranges
-        success, out, _ = run_cmd(f"ipset list {RULE_PREFIX}_IRAN_V4 2>/dev/null | grep 'Number of entries'")
-        if success and out:
-            entries = out.split(':')[1].strip() if ':' in out else 'unknown'
-            print(f"      • IPv4: {entries} Iran ranges")
+        header = get_ipset_header(f"{RULE_PREFIX}_IRAN_V4")
+        if header:
+            print(f"      • IPv4: {header.get('Number of entries', 'unknown')} Iran ranges")
         else:
             # Try legacy name
-            success, out, _ = run_cmd(f"ipset list {RULE_PREFIX}_IRAN 2>/dev/null | grep 'Number of entries'")
-            if success and out:
-                entries = out.split(':')[1].strip() if ':' in out else 'unknown'
-                print(f"      • IPv4: {entries} Iran ranges (legacy)")
+            header = get_ipset_header(f"{RULE_PREFIX}_IRAN")
+            if header:
+                print(f"      • IPv4: {header.get('Number of entries', 'unknown')} Iran ranges (legacy)")
 
         # IPv6 ranges
-        success, out, _ = run_cmd(f"ipset list {RULE_PREFIX}_IRAN_V6 2>/dev/null | grep 'Number of entries'")
-        if success and out:
-            entries = out.split(':')[1].strip() if ':' in out else '0'
-            print(f"      • IPv6: {entries} Iran ranges")
+        header = get_ipset_header(f"{RULE_PREFIX}_IRAN_V6")
+        if header:
+            print(f"      • IPv6: {header.get('Number of entries', '0')} Iran ranges")
         else:
             print(f"      • IPv6: 0 ranges")
 
@@ -747,11 +3881,11 @@ def show_status():
     config = load_config()
     vpn_iface = config.get('vpn_interface')
     if vpn_iface:
-        success, out, _ = run_cmd(f"ip link show {vpn_iface} 2>/dev/null")
+        state = interface_state(vpn_iface)
         print(f"\n   🌐 VPN Interface: {vpn_iface}")
-        if success and 'state UP' in out:
+        if state == 'up':
             print(f"      Status: 🟢 UP")
-        elif success:
+        elif state:
             print(f"      Status: 🟡 Exists but DOWN")
         else:
             print(f"      Status: ⚪ Not found")
@@ -767,11 +3901,142 @@ def show_status():
 
     # Show active connections
     print(f"\n   📊 Connection Statistics:")
-    success, out, _ = run_cmd("ss -tunp 2>/dev/null | grep -c ESTAB")
-    if success and out.strip().isdigit():
-        print(f"      Active: {out.strip()} established connections")
+    print(f"      Active: {count_established()} established connections")
+
+    pause("\n   Press Enter to go back to menu...")
+
+
+def sd_notify(state):
+    """Send a state line (READY=1, WATCHDOG=1, ...) to systemd, if supervised"""
+    address = os.environ.get('NOTIFY_SOCKET')
+    if not address:
+        return False
+    if address.startswith('@'):
+        address = '\0' + address[1:]
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            # Never stall the daemon on a slow or wedged supervisor
+            sock.sendto(state.encode(), socket.MSG_DONTWAIT, address)
+        finally:
+            sock.close()
+        return True
+    except OSError as e:
+        logging.warning(f"sd_notify failed: {e}")
+        return False
 
-    input("\n   Press Enter to go back to menu...")
+
+def run_with_watchdog(tick, func, *args, **kwargs):
+    """Call func while a helper thread sends WATCHDOG=1 every tick seconds
+
+    A refresh or re-enable (feed deadline, set loads, rule restores) can
+    outlast WatchdogSec, and systemd would kill the daemon mid-transaction.
+    """
+    if not tick:
+        return func(*args, **kwargs)
+    done = threading.Event()
+
+    def ping():
+        while not done.wait(tick):
+            sd_notify("WATCHDOG=1")
+
+    pinger = threading.Thread(target=ping, daemon=True)
+    pinger.start()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        done.set()
+        pinger.join()
+
+
+def next_refresh_delay(interval, jitter):
+    """Refresh interval with +/- jitter so a fleet doesn't hit feeds in lockstep"""
+    return max(60.0, interval * (1 + random.uniform(-jitter, jitter)))
+
+
+def run_daemon():
+    """Enable from config, then refresh feeds on a schedule until stopped
+
+    Meant to run under systemd (Type=notify, optional WatchdogSec=): READY=1
+    is sent once the firewall is up and WATCHDOG=1 while waiting or working
+    (see run_with_watchdog). Refreshes
+    go through the same staging-set swap as menu option 8, so a failed
+    download or load leaves the live sets untouched. Rules stay in place on
+    exit; use the `disable` command to remove them.
+    """
+    config = load_config()
+    interval = float(config.get('refresh_interval', REFRESH_INTERVAL))
+    jitter = float(config.get('refresh_jitter', REFRESH_JITTER))
+    watchdog_usec = int(os.environ.get('WATCHDOG_USEC', 0) or 0)
+    tick = watchdog_usec / 2e6 if watchdog_usec else 60.0
+    work_tick = tick if watchdog_usec else None
+
+    # Keep SIGTERM/SIGHUP pending while applying rules and pick them up
+    # only while idle, so a stop never interrupts a half-done refresh
+    stop_signals = {signal.SIGTERM, signal.SIGHUP, signal.SIGINT}
+    signal.pthread_sigmask(signal.SIG_BLOCK, stop_signals)
+
+    if not is_enabled() and not run_with_watchdog(work_tick, enable_iran_only,
+                                                  strict_mode=config.get('strict_mode', False)):
+        logging.error("Daemon could not enable Iran-only mode")
+        sd_notify("STATUS=enable failed")
+        return False
+    sd_notify("READY=1")
+    logging.info(f"Daemon started, refresh every {interval:.0f}s ±{jitter:.0%}")
+
+    stopped = False
+    while not stopped:
+        due = time.time() + next_refresh_delay(interval, jitter)
+        sd_notify(f"STATUS=Next refresh at {time.strftime('%H:%M:%S', time.localtime(due))}")
+        while time.time() < due:
+            sd_notify("WATCHDOG=1")
+            # Late VPN interfaces: the drop stage could not be loaded at boot
+            ensure_drop_stage()
+            if signal.sigtimedwait(stop_signals, min(tick, max(due - time.time(), 0.01))):
+                stopped = True
+                break
+        if stopped:
+            break
+        if is_enabled():
+            ok = run_with_watchdog(work_tick, refresh_iran_only)
+        else:
+            # Rules vanished (e.g. a manual flush) - put them back
+            logging.warning("Firewall not active, re-enabling")
+            ok = run_with_watchdog(work_tick, enable_iran_only,
+                                   strict_mode=load_config().get('strict_mode', False))
+        if not ok:
+            logging.warning("Scheduled refresh failed, keeping current sets")
+
+    sd_notify("STOPPING=1")
+    logging.info("Daemon stopped (firewall left in place)")
+    return True
+
+
+def run_cli(command, args):
+    """Run one non-interactive command; returns a process exit code"""
+    global HEADLESS
+    HEADLESS = True
+    setup_logging()
+    if not is_root():
+        print("❌ ERROR: This command must be run as root!")
+        return 1
+
+    if command == "enable":
+        strict = "--strict" in args or load_config().get('strict_mode', False)
+        ok = enable_iran_only(strict_mode=strict)
+    elif command == "disable":
+        disable_iran_only()
+        ok = True
+    elif command == "refresh":
+        ok = refresh_iran_only()
+    elif command == "restore":
+        ok = restore_snapshot()
+    elif command == "status":
+        show_status()
+        ok = True
+    else:
+        ok = run_daemon()
+    return 0 if ok else 1
 
 
 def show_help():
@@ -793,7 +4058,7 @@ WHAT THIS DOES:
 HOW IT WORKS (Rule Priority):
   1. ALLOW admin IPs (full server access, highest priority)
   2. ALLOW DNS servers (required for operation)
-  3. ALLOW established/related connections
+  3. ALLOW established/related connections to the VPN port
   4. ALLOW UDP from Iran IP ranges (IPv4 + IPv6)
   5. EXPLICIT DROP all other traffic
 
@@ -804,6 +4069,43 @@ MODES:
   • Strict Mode: TCP Iran-only, UDP Iran-only
     - Best for: Maximum restriction (may affect broker visibility)
 
+FIREWALL BACKEND:
+  • Default: iptables + ipset
+  • Set "ipset_backend": "netlink" to load set members over netlink
+    in large batches instead of `ipset restore` (falls back to the
+    ipset tool when netlink is unavailable)
+  • Set "backend": "nftables" in config.json to use one native
+    `inet {NFT_TABLE}` table with interval sets, applied atomically
+    with a single `nft -f` transaction (requires the nft tool)
+  • hash:net sets probe once per prefix length they hold. By default
+    ("ipset_prefix_layout": "auto") ranges are split onto a few prefix
+    lengths, growing the set by at most "ipset_max_expansion" (2x).
+    Use "off" or explicit lengths per family such as
+    {"v4": [16, 20, 24], "v6": [32, 48]} (a plain list is IPv4 only).
+    Layouts past the expansion budget fall back to "auto". nftables
+    interval sets don't need this.
+    Measure it: sudo python3 iran_firewall_linux.py benchmark layout
+  • Established flows are accepted before the jump, so only new flows
+    hit the set lookups. Under floods set "raw_mode": "notrack" (blocked
+    sources never get conntrack entries) or "drop" (dropped in raw
+    PREROUTING / prerouting priority -300). Requires vpn_port to be set
+  • "drop_stage" picks where non-Iran packets to the VPN port die:
+    "filter" (INPUT, default), "raw" (raw PREROUTING), "ingress" (nft
+    netdev ingress hook on the VPN interface, before conntrack and
+    routing) or "tc" (tc ingress filter matching our ipsets; iptables
+    backend only, nftables falls back to "ingress"). Requires vpn_port.
+    The filter chain stays in place behind every stage.
+    Measure it: sudo python3 iran_firewall_linux.py benchmark stages
+
+REFRESHING IP RANGES:
+  • Menu option 8 downloads fresh ranges and applies only the
+    added/removed prefixes. Large changes go through a staging set
+    swapped in with `ipset swap`. Chains and rules are untouched,
+    so there is no window where traffic is unfiltered.
+  • Merged ranges are compiled to feed_cache/iran_ranges.bin. If no
+    source changed, enable reuses it without re-parsing and refresh
+    leaves the live sets alone.
+
 IMPROVEMENTS IN v{VERSION}:
   ✓ Explicit DROP rules (doesn't rely on implicit deny)
   ✓ IPv6 support for Iran ranges
@@ -826,21 +4128,54 @@ INSTALLATION:
   sudo python3 iran_firewall_linux.py
 
 MAKING RULES PERSISTENT:
-  # After enabling Iran-only mode:
-  sudo apt install iptables-persistent
-  sudo netfilter-persistent save
-
-  # Rules will survive reboots
+  # Enable and refresh write snapshot.json (sets + rules + checksum).
+  # Reload it at boot, offline, before the VPN service starts:
+  sudo python3 iran_firewall_linux.py restore
+
+  # e.g. a oneshot systemd unit with Before=conduit.service
+  # (netfilter-persistent alone does not restore the ipsets first)
+  # An ingress/tc drop stage whose VPN interface doesn't exist yet is
+  # skipped; the daemon installs it once the interface appears
+
+BLOCK LOGGING ("block_log" in config.json):
+  • "limit" (default): sampled kernel LOG, block_log_rate/burst
+  • "hashlimit": sampled per source address
+  • "nflog": send to NFLOG group nflog_group, then run
+    sudo python3 iran_firewall_linux.py nflog-summary [seconds]
+    to log per-prefix drop summaries
+  • "off": no logging
+
+SCRIPTING:
+  • sudo python3 iran_firewall_linux.py status --json
+    Prints status, per-rule packet/byte counters, accept/drop totals
+    (drops per stage: filter, raw, ingress, tc)
+    and set sizes as JSON without listing set members (cron-friendly)
+  • sudo python3 iran_firewall_linux.py metrics
+    Serves Prometheus metrics on http://127.0.0.1:9781/metrics
+    (metrics_addr / metrics_port / metrics_cache_seconds in config)
+  • sudo python3 iran_firewall_linux.py enable [--strict] | disable |
+    refresh | status
+    Runs one action without prompts, using config.json only
+  • python3 iran_firewall_linux.py lookup <ip> [ip...]
+    Offline, no root: is the address covered, by which prefix and
+    which feeds list it. `lookup -` reads one IP per line from stdin
+    and prints "ip<TAB>prefix" ("-" = not covered)
+  • sudo python3 iran_firewall_linux.py daemon
+    Enables, then refreshes every refresh_interval seconds (default
+    21600, ±refresh_jitter). For systemd use Type=notify and optionally
+    WatchdogSec=; replaces cron jobs that re-run the script
 
 TROUBLESHOOTING:
   • "Permission denied" → Run with sudo
   • "Command not found" → Install iptables/ipset/ip6tables
   • "Interface not found" → Check VPN is running
-  • Check logs: journalctl -k | grep IRAN-BLOCK
+  • Summarise blocked traffic:
+    sudo python3 iran_firewall_linux.py analyze [--follow] [files...]
+    (reads rotated kernel logs incl. .gz, or the journal; '-' = stdin)
   • Check {LOG_FILE} for detailed logs
 
 Press Enter to go back to menu...""")
-    input()
+    pause("")
 
 
 def main():
@@ -854,7 +4189,7 @@ def main():
         print("❌ ERROR: This script must be run as root!")
         print("\n   Run with: sudo python3 iran_firewall_linux.py")
         logging.error("Not running as root")
-        input("\nPress Enter to exit...")
+        pause("\nPress Enter to exit...")
         sys.exit(1)
 
     print("✅ Running as root")
@@ -863,9 +4198,13 @@ def main():
     print("🔍 Checking dependencies...")
     deps_ok = True
 
-    for cmd in ['iptables', 'ip6tables', 'ipset', 'ip']:
-        success, _, _ = run_cmd(f"which {cmd}")
-        if success:
+    if get_backend() == 'nftables':
+        required = ['nft']
+    else:
+        required = ['iptables', 'ip6tables', 'iptables-restore', 'ip6tables-restore', 'ipset']
+
+    for cmd in required:
+        if shutil.which(cmd):
             print(f"   ✓ {cmd} found")
         else:
             print(f"   ✗ {cmd} NOT found")
@@ -873,11 +4212,10 @@ def main():
 
     if not deps_ok:
         print("\n   ⚠️  Missing dependencies!")
-        print("   Install with: sudo apt install iptables ipset iproute2")
-        input("\n   Press Enter to continue anyway...")
+        print("   Install with: sudo apt install iptables ipset nftables")
+        pause("\n   Press Enter to continue anyway...")
 
     time.sleep(1)
-    choice ="1"
     while True:
         print_header()
         print("─" * 50)
@@ -890,13 +4228,14 @@ def main():
         print("  5. ⚙️  Configure VPN interface/port")
         print("  6. 🔐 Manage admin IP whitelist")
         print("  7. ❓ Help")
+        print("  8. 🔄 Refresh Iran IP ranges (no downtime)")
         print("  0. 🚪 Exit")
         print("─" * 50)
         print("  Normal: TCP global, UDP Iran-only")
         print("  Strict: TCP+UDP Iran-only (may affect visibility)")
         print("─" * 50)
 
-
+        choice = input("\n  Enter choice: ").strip()
 
         if choice == "1":
             enable_iran_only(strict_mode=False)
@@ -914,11 +4253,13 @@ def main():
             print("\n⚙️  Configuration\n")
             detect_vpn_interface()
             detect_vpn_port()
-            input("\n   Configuration saved! Press Enter to continue...")
+            pause("\n   Configuration saved! Press Enter to continue...")
         elif choice == "6":
             manage_admin_ips()
         elif choice == "7":
             show_help()
+        elif choice == "8":
+            refresh_iran_only()
         elif choice == "0":
             clear_screen()
             print("\n👋 Thank you for helping Iran!")
@@ -926,10 +4267,40 @@ def main():
             logging.info("=== Iran Firewall exited ===")
             break
         else:
-            print("   Invalid choice. Enter 0-7.")
-
-        choice = input("\n  Enter choice: ").strip()
+            print("   Invalid choice. Enter 0-8.")
+            time.sleep(1)
 
 
 if __name__ == "__main__":
-    main()
+    if sys.argv[1:] == ["status", "--json"]:
+        show_status_json()
+    elif sys.argv[1:] == ["metrics"]:
+        setup_logging()
+        serve_metrics()
+    elif len(sys.argv) > 1 and sys.argv[1] == "nflog-summary":
+        setup_logging()
+        nflog_summary(interval=int(sys.argv[2]) if len(sys.argv) > 2 else 60)
+    elif len(sys.argv) > 1 and sys.argv[1] == "analyze":
+        args = sys.argv[2:]
+        show_block_analysis([a for a in args if a != "--follow"], follow="--follow" in args)
+    elif len(sys.argv) > 2 and sys.argv[1] == "lookup":
+        sys.exit(show_lookup(sys.argv[2:]))
+    elif len(sys.argv) > 1 and sys.argv[1] in ("enable", "disable", "refresh", "restore", "status", "daemon"):
+        sys.exit(run_cli(sys.argv[1], sys.argv[2:]))
+    elif sys.argv[1:3] == ["benchmark", "stages"]:
+        if not is_root():
+            print("❌ ERROR: Benchmark must be run as root!")
+            sys.exit(1)
+        benchmark_drop_stages(int(sys.argv[3]) if len(sys.argv) > 3 else 200000)
+    elif sys.argv[1:] == ["benchmark", "layout"]:
+        if not is_root():
+            print("❌ ERROR: Benchmark must be run as root!")
+            sys.exit(1)
+        benchmark_prefix_layout()
+    elif len(sys.argv) > 1 and sys.argv[1] == "benchmark":
+        if not is_root():
+            print("❌ ERROR: Benchmark must be run as root!")
+            sys.exit(1)
+        benchmark_ipset_load(int(sys.argv[2]) if len(sys.argv) > 2 else 5000)
+    else:
+        main()
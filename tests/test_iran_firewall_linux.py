@@ -0,0 +1,344 @@
+"""Tests for the pure and locally testable parts of iran_firewall_linux.py
+
+No root, firewall tools or network access needed: feeds are served by a
+local http.server, netlink messages are only encoded and decoded, and
+metrics are rendered from a fake counter source.
+
+Run with: python3 -m unittest discover -s tests
+"""
+
+import http.server
+import io
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import iran_firewall_linux as fw  # noqa: E402
+
+
+class FeedServer:
+    """Serve fixed feed bodies on 127.0.0.1, optionally sleeping per path"""
+
+    def __init__(self, bodies, delays=None):
+        self.bodies = bodies
+        self.delays = delays or {}
+        self.release = threading.Event()
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                delay = server.delays.get(self.path)
+                if delay:
+                    server.release.wait(delay)
+                body = server.bodies.get(self.path)
+                if body is None:
+                    self.send_error(404)
+                    return
+                data = body.encode()
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def url(self, path):
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}{path}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.release.set()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class FetchTests(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self._saved = fw.FEED_CACHE_DIR
+        fw.FEED_CACHE_DIR = self.cache_dir
+
+    def tearDown(self):
+        fw.FEED_CACHE_DIR = self._saved
+        shutil.rmtree(self.cache_dir)
+
+    def test_fast_sources_are_fetched_and_cached(self):
+        with FeedServer({"/a.zone": "2.144.0.0/14\n"}) as server:
+            url = server.url("/a.zone")
+            results = fw.fetch_sources([url], deadline=5)
+        body, _, error = results[url]
+        self.assertEqual(body, "2.144.0.0/14\n")
+        self.assertIsNone(error)
+        self.assertEqual(fw.load_feed_cache(url)['body'], body)
+
+    def test_deadline_reports_stalled_source_without_cache(self):
+        with FeedServer({"/slow.zone": "5.22.0.0/16\n"}, {"/slow.zone": 10}) as server:
+            url = server.url("/slow.zone")
+            start = time.time()
+            results = fw.fetch_sources([url], deadline=1)
+            self.assertLess(time.time() - start, 3)
+        body, _, error = results[url]
+        self.assertIsNone(body)
+        self.assertIn("deadline", error)
+
+    def test_deadline_falls_back_to_cached_copy(self):
+        with FeedServer({"/fast.zone": "2.144.0.0/14\n", "/slow.zone": "new\n"},
+                        {"/slow.zone": 10}) as server:
+            fast, slow = server.url("/fast.zone"), server.url("/slow.zone")
+            fw.save_feed_cache(slow, "5.22.0.0/16\n")
+            start = time.time()
+            results = fw.fetch_sources([fast, slow], deadline=1)
+            self.assertLess(time.time() - start, 3)
+        self.assertEqual(results[fast][0], "2.144.0.0/14\n")
+        self.assertEqual(results[slow][0], "5.22.0.0/16\n")
+        self.assertIsNone(results[slow][2])
+
+
+class NetlinkTests(unittest.TestCase):
+    def test_attribute_round_trip(self):
+        data = (fw.nla_u8(1, 7) + fw.nla_str(2, "IRAN_CONDUIT_IRAN_V4")
+                + fw.nla_u32be(3, 0xDEADBEEF))
+        attrs = fw.parse_nlattrs(data)
+        self.assertEqual(attrs[1], b"\x07")
+        self.assertEqual(attrs[2], b"IRAN_CONDUIT_IRAN_V4\0")
+        self.assertEqual(struct.unpack(">I", attrs[3])[0], 0xDEADBEEF)
+
+    def test_adt_message_round_trip(self):
+        cidrs = ["2.144.0.0/14", "5.22.0.0/16", "2a01:5ec0::/29"]
+        data = fw.encode_ipset_adt(fw.IPSET_CMD_ADD, "IRAN_CONDUIT_IRAN_V4", cidrs, seq=42)
+        msgs = fw.parse_nlmsgs(data + data)
+        self.assertEqual(len(msgs), 2)
+        msg_type, _, seq, payload = msgs[0]
+        self.assertEqual(msg_type, (fw.NFNL_SUBSYS_IPSET << 8) | fw.IPSET_CMD_ADD)
+        self.assertEqual(seq, 42)
+
+        attrs = fw.parse_nlattrs(payload[4:])
+        self.assertEqual(attrs[fw.IPSET_ATTR_SETNAME], b"IRAN_CONDUIT_IRAN_V4\0")
+        elements = fw.parse_nlattrs(attrs[fw.IPSET_ATTR_ADT])
+        # Every element is an IPSET_ATTR_DATA; parse_nlattrs keeps the last
+        data_attrs = fw.parse_nlattrs(elements[fw.IPSET_ATTR_DATA])
+        self.assertEqual(data_attrs[fw.IPSET_ATTR_CIDR], b"\x1d")
+        self.assertEqual(struct.unpack(">I", data_attrs[fw.IPSET_ATTR_LINENO])[0], 3)
+        ip = fw.parse_nlattrs(data_attrs[fw.IPSET_ATTR_IP])[fw.IPSET_ATTR_IPADDR_IPV6]
+        self.assertEqual(ip, fw.socket.inet_pton(fw.socket.AF_INET6, "2a01:5ec0::"))
+
+    def test_error_reports_failed_lineno(self):
+        request = fw.encode_ipset_adt(fw.IPSET_CMD_ADD, "X", ["10.0.0.0/8"], seq=1)
+        # Rewrite the top-level LINENO the way the kernel does on failure
+        attrs = fw.nla_str(fw.IPSET_ATTR_SETNAME, "X") + fw.nla_u32be(fw.IPSET_ATTR_LINENO, 2)
+        echo = request[:16] + request[16:20] + attrs
+        error, lineno = fw.parse_nlmsg_error(struct.pack("=i", -17) + echo)
+        self.assertEqual((error, lineno), (17, 2))
+
+
+BLOCK_LOG = (
+    b"Oct  1 12:00:00 host kernel: [IRAN-BLOCK-V4] IN=eth0 OUT= MAC=00:11 SRC=1.2.3.4 DST=10.0.0.1 "
+    b"LEN=60 TTL=50 ID=1 DF PROTO=UDP SPT=5000 DPT=443 LEN=40 \n"
+    b"Oct  1 12:00:01 host sshd[1]: Accepted publickey for root from 1.2.3.4 port 22 ssh2\n"
+    b"Oct  1 12:00:02 host kernel: [IRAN-BLOCK-V4] IN=eth0 OUT= MAC=00:11 SRC=1.2.3.9 DST=10.0.0.1 "
+    b"LEN=60 TTL=50 ID=1 PROTO=ICMP TYPE=8 CODE=0 \n"
+    b"Oct  1 12:00:03 host kernel: [IRAN-BLOCK-V6] IN=eth0 OUT= MAC=00:11 SRC=2a02:0db8:0001:0000:0000:0000:0000:0001 "
+    b"DST=2001:0db8:0000:0000:0000:0000:0000:0001 LEN=60 TC=0 HOPLIMIT=64 FLOWLBL=0 PROTO=UDP SPT=1 DPT=443 LEN=8 \n"
+)
+
+
+class ReadsInPieces:
+    """Byte stream whose read1() returns fixed-size pieces, like a slow pipe"""
+
+    def __init__(self, data, size):
+        self.pieces = [data[i:i + size] for i in range(0, len(data), size)]
+
+    def read1(self, size):
+        return self.pieces.pop(0) if self.pieces else b""
+
+    def close(self):
+        pass
+
+
+class AnalyzeTests(unittest.TestCase):
+    def analyze(self, piece_size):
+        saved = fw.open_log_stream
+        fw.open_log_stream = lambda path: ReadsInPieces(BLOCK_LOG, piece_size)
+        try:
+            return fw.analyze_block_logs(["split.log"])
+        finally:
+            fw.open_log_stream = saved
+
+    def test_lines_split_across_reads(self):
+        for piece_size in (3, 17, 64, len(BLOCK_LOG)):
+            summary = self.analyze(piece_size)
+            self.assertEqual((summary['lines'], summary['ipv6']), (3, 1), piece_size)
+            self.assertEqual(sorted(summary['top_prefixes']),
+                             [("1.2.3.0/24", 2, 0), ("2a02:db8:1::/48", 1, 0)])
+            self.assertEqual(sorted(summary['top_ports']), [("ICMP/-", 1, 0), ("UDP/443", 2, 0)])
+
+    def test_merge_bounded_error_bound(self):
+        rng = fw.random.Random(299)
+        counts, errors, floor, true = {}, {}, [0], {}
+        for _ in range(60):
+            window = fw.collections.Counter()
+            for _ in range(rng.randint(1, 80)):
+                key = int(rng.paretovariate(1.1)) if rng.random() < 0.5 else rng.randint(0, 500)
+                window[key] += rng.randint(1, 4)
+            for key, hits in window.items():
+                true[key] = true.get(key, 0) + hits
+            fw.merge_bounded(counts, window, 10, floor, errors)
+        for key, count in counts.items():
+            self.assertLessEqual(count - errors.get(key, 0), true[key])
+            self.assertLessEqual(true[key], count)
+        for key, total in true.items():
+            self.assertTrue(key in counts or total <= floor[0])
+
+
+def fake_status():
+    return {
+        'version': fw.VERSION,
+        'timestamp': 0,
+        'backend': 'iptables',
+        'enabled': True,
+        'config': {},
+        'families': {
+            'ipv4': {'rules': [], 'accepted': {'packets': 10, 'bytes': 1000},
+                     'dropped': {'packets': 4, 'bytes': 240}},
+        },
+        'drop_stages': {'filter': {'ipv4': {'packets': 4, 'bytes': 240}},
+                        'raw': {'ipv4': {'packets': 7, 'bytes': 420}}},
+        'sets': {'IRAN_CONDUIT_IRAN_V4': {'entries': 1800, 'memory_bytes': 65536}},
+        'established_connections': 3,
+    }
+
+
+class LookupTests(unittest.TestCase):
+    # 5.0.0.0-5.0.1.255, 6.0.0.0/8 and 2a02::/16
+    V4 = [(0x05000000, 0x050001FF), (0x06000000, 0x06FFFFFF)]
+    V6 = [(0x2A02 << 112, (0x2A03 << 112) - 1)]
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.saved = fw.FEED_CACHE_DIR, fw.COMPILED_FEED_FILE
+        fw.FEED_CACHE_DIR = self.tmp
+        fw.COMPILED_FEED_FILE = os.path.join(self.tmp, "iran_ranges.bin")
+
+    def tearDown(self):
+        fw.FEED_CACHE_DIR, fw.COMPILED_FEED_FILE = self.saved
+        shutil.rmtree(self.tmp)
+
+    def index(self, compiled):
+        if compiled:
+            fw.write_compiled_feed([b"\0" * 32], self.V4, self.V6)
+            return fw.build_lookup_index([], [])
+        return {bits: {'feed': None, 'count': len(ranges), 'starts': [start for start, _ in ranges],
+                       'ends': [end for _, end in ranges], 'seg_starts': [], 'seg_ends': [],
+                       'seg_masks': [], 'sources': []}
+                for bits, ranges in ((32, self.V4), (128, self.V6))}
+
+    def test_blank_chunk_does_not_end_stream(self):
+        lines = ["5.0.0.1\n", "\n", "  \n", "\n", "8.8.8.8\n", "2a02::1\n", "bogus\n"]
+        out = io.StringIO()
+        fw.lookup_stream(self.index(False), lines, out, chunk_size=2)
+        self.assertEqual(out.getvalue().splitlines(), [
+            "5.0.0.1\t5.0.0.0/23", "8.8.8.8\t-", "2a02::1\t2a02::/16", "bogus\t?"])
+
+    def test_compiled_feed_matches_lists(self):
+        mapped, listed = self.index(True), self.index(False)
+        self.assertTrue(mapped[32]['feed'])
+        for ip in ("4.255.255.255", "5.0.0.0", "5.0.1.255", "5.0.2.0", "6.128.0.1", "7.0.0.0",
+                   "2a01:ffff::1", "2a02::", "2a02:ffff::1", "2a03::"):
+            self.assertEqual(fw.lookup_ip(mapped, ip), fw.lookup_ip(listed, ip), ip)
+        self.assertEqual(fw.lookup_ip(mapped, "6.128.0.1")['prefix'], "6.0.0.0/8")
+        self.assertEqual(list(fw.index_intervals(mapped, 32)), self.V4)
+
+
+IPTABLES_SAVE = """*filter
+:INPUT ACCEPT [0:0]
+:IRAN_CONDUIT - [0:0]
+[5:500] -A INPUT -s 1.2.3.4/32 -m comment --comment IRAN_CONDUIT -j ACCEPT
+[90:9000] -A INPUT -i tun0 -p udp -m udp --dport 443 -m conntrack --ctstate RELATED,ESTABLISHED -m comment --comment IRAN_CONDUIT -j ACCEPT
+[12:1200] -A INPUT -i tun0 -p udp -m udp --dport 443 -m comment --comment IRAN_CONDUIT -j IRAN_CONDUIT
+[1:60] -A IRAN_CONDUIT -m set --match-set IRAN_CONDUIT_DNS_V4 src -j ACCEPT
+[8:800] -A IRAN_CONDUIT -m set --match-set IRAN_CONDUIT_IRAN_V4 src -j ACCEPT
+[3:180] -A IRAN_CONDUIT -j DROP
+COMMIT
+"""
+
+
+class StatusTests(unittest.TestCase):
+    def test_fast_path_counts_as_accepted(self):
+        def run_cmd(argv, **kwargs):
+            if argv[0] == "iptables-save" and "filter" in argv:
+                return True, IPTABLES_SAVE, ""
+            return False, "", ""
+
+        patches = {'run_cmd': run_cmd, 'load_config': lambda: {}, 'get_backend': lambda: 'iptables',
+                   'read_ipset_headers': dict, 'count_established': lambda: 0,
+                   'read_drop_stages': lambda backend, iface: {}}
+        saved = {name: getattr(fw, name) for name in patches}
+        try:
+            for name, value in patches.items():
+                setattr(fw, name, value)
+            status = fw.collect_status()
+        finally:
+            for name, value in saved.items():
+                setattr(fw, name, value)
+        ipv4 = status['families']['ipv4']
+        # DNS + Iran accepts in the chain plus the conntrack fast path, not admin
+        self.assertEqual(ipv4['accepted'], {'packets': 99, 'bytes': 9860})
+        self.assertEqual(ipv4['dropped'], {'packets': 3, 'bytes': 180})
+
+
+class CleanupTests(unittest.TestCase):
+    LEGACY = "-A INPUT -s 1.2.3.4/32 -j ACCEPT"
+    TAGGED = "-A INPUT -s 1.2.3.4/32 -m comment --comment IRAN_CONDUIT -j ACCEPT"
+
+    def found(self, *rules):
+        save = "*filter\n:INPUT ACCEPT [0:0]\n" + "".join(rule + "\n" for rule in rules) + "COMMIT\n"
+        return fw.find_conduit_rules(save, ["1.2.3.4"]).get('filter', ([], []))[1]
+
+    def test_legacy_admin_rule_removed_from_untagged_install(self):
+        self.assertEqual(self.found(self.LEGACY), [self.LEGACY])
+
+    def test_untagged_admin_rule_kept_next_to_tagged_one(self):
+        self.assertEqual(self.found(self.LEGACY, self.TAGGED), [self.TAGGED])
+
+
+class MetricsTests(unittest.TestCase):
+    def test_format_metrics_from_fake_counters(self):
+        text = fw.format_metrics(fake_status(), {"http://x/ir.zone": 60.5}, 1700000000)
+        lines = text.splitlines()
+        self.assertIn('iran_conduit_enabled{backend="iptables"} 1', lines)
+        self.assertIn('iran_conduit_packets_total{family="ipv4",verdict="accept",stage="filter"} 10', lines)
+        self.assertIn('iran_conduit_packets_total{family="ipv4",verdict="drop",stage="raw"} 7', lines)
+        self.assertIn('iran_conduit_set_entries{set="IRAN_CONDUIT_IRAN_V4"} 1800', lines)
+        self.assertIn('iran_conduit_feed_age_seconds{source="http://x/ir.zone"} 60', lines)
+        self.assertIn('iran_conduit_last_refresh_timestamp_seconds 1700000000', lines)
+        self.assertIn('iran_conduit_established_connections 3', lines)
+
+    def test_metrics_source_caches_collection(self):
+        calls = []
+
+        def collect():
+            calls.append(1)
+            return fake_status()
+
+        source = fw.make_metrics_source(collect=collect, cache_seconds=60)
+        self.assertEqual(source(), source())
+        self.assertEqual(len(calls), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()